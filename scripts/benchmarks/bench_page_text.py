@@ -0,0 +1,150 @@
+"""
+prepdocs の Form Recognizer の結果からページのテキストを組み立てる処理のベンチマーク。
+1文字ずつ表の番号を付けて += で連結していた従来の実装と、区間ごとに切り出して1回だけ join する page_map_from_analyze_result を比較し、結果が同じことも確認する。
+
+フィクスチャは AnalyzeResult.to_dict() を JSON(.json.gz も可)にしたもの。実際の文書の結果は次のように記録できる。
+
+    poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document=f)
+    json.dump(poller.result().to_dict(), open("manual.json", "w", encoding="utf-8"), ensure_ascii=False)
+
+    python scripts/benchmarks/bench_page_text.py
+    python scripts/benchmarks/bench_page_text.py --fixture manual.json --repeat 3
+    # 同梱のフィクスチャ(表の多い合成データ)を作り直す場合
+    python scripts/benchmarks/bench_page_text.py --record scripts/benchmarks/fixtures/formrecognizer_tables.json.gz
+"""
+import os
+import sys
+import gzip
+import html
+import json
+import time
+import random
+import argparse
+
+from azure.ai.formrecognizer import AnalyzeResult
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+from documenttext import page_map_from_analyze_result
+
+DEFAULT_FIXTURE = os.path.join(SCRIPTS_DIR, "benchmarks", "fixtures", "formrecognizer_tables.json.gz")
+WORDS = ["休暇", "申請", "承認", "経費", "精算", "規程", "手順", "勤怠", "Azure", "portal", "設定", "確認", "。", "、"]
+
+def legacy_table_to_html(table):
+    table_html = "<table>"
+    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html +="</tr>"
+    table_html += "</table>"
+    return table_html
+
+def legacy_page_map(form_recognizer_results):
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_chars = [-1]*page_length
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                for i in range(span.length):
+                    idx = span.offset - page_offset + i
+                    if idx >=0 and idx < page_length:
+                        table_chars[idx] = table_id
+        page_text = ""
+        added_tables = set()
+        for idx, table_id in enumerate(table_chars):
+            if table_id == -1:
+                page_text += form_recognizer_results.content[page_offset + idx]
+            elif table_id not in added_tables:
+                page_text += legacy_table_to_html(tables_on_page[table_id])
+                added_tables.add(table_id)
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def synthetic_result(pages: int, tables_per_page: int, seed: int) -> dict:
+    # AnalyzeResult.to_dict() と同じ形の、表の多い文書の結果を作る
+    rng = random.Random(seed)
+    text = lambda n: "".join(rng.choice(WORDS) for _ in range(n))
+    content = []
+    length = 0
+    result_pages = []
+    tables = []
+    def add(s):
+        nonlocal length
+        content.append(s)
+        length += len(s)
+    for page_number in range(1, pages + 1):
+        page_start = length
+        for _ in range(tables_per_page):
+            add(text(rng.randint(80, 400)) + "\n")
+            rows, columns = rng.randint(4, 12), rng.randint(3, 7)
+            table_start = length
+            cells = []
+            for row in range(rows):
+                for column in range(columns):
+                    cell_start = length
+                    add(text(rng.randint(1, 6)) + "\n")
+                    cells.append({"kind": "columnHeader" if row == 0 else "content", "row_index": row, "column_index": column,
+                                  "row_span": 1, "column_span": 1, "content": "".join(content[-1].split()),
+                                  "bounding_regions": [], "spans": [{"offset": cell_start, "length": length - cell_start - 1}]})
+            tables.append({"row_count": rows, "column_count": columns, "cells": cells,
+                           "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                           "spans": [{"offset": table_start, "length": length - table_start}]})
+        add(text(rng.randint(80, 400)) + "\n")
+        result_pages.append({"page_number": page_number, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+                             "spans": [{"offset": page_start, "length": length - page_start}], "lines": [], "words": []})
+    return {"api_version": "2023-07-31", "model_id": "prebuilt-layout", "content": "".join(content),
+            "pages": result_pages, "tables": tables}
+
+def open_fixture(path: str, mode: str):
+    return gzip.open(path, mode + "t", encoding="utf-8") if path.endswith(".gz") else open(path, mode, encoding="utf-8")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixture", action="append", help="AnalyzeResult.to_dict() を保存した JSON(複数指定可)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--record", help="合成したフィクスチャをこのパスに書き出して終了する")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--tables", type=int, default=3, help="1ページあたりの表の数(--record 用)")
+    args = parser.parse_args()
+
+    if args.record:
+        with open_fixture(args.record, "w") as f:
+            json.dump(synthetic_result(args.pages, args.tables, seed=0), f, ensure_ascii=False)
+        print(f"wrote {args.record}")
+        return
+
+    for path in args.fixture or [DEFAULT_FIXTURE]:
+        with open_fixture(path, "r") as f:
+            result = AnalyzeResult.from_dict(json.load(f))
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            legacy = legacy_page_map(result)
+        legacy_elapsed = (time.perf_counter() - start) / args.repeat
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            page_map = page_map_from_analyze_result(result)
+        span_elapsed = (time.perf_counter() - start) / args.repeat
+
+        assert page_map == legacy, "page text differs from the legacy implementation"
+        characters = sum(len(p[2]) for p in page_map)
+        print(f"{os.path.basename(path)}: {len(result.pages)} pages, {len(result.tables or [])} tables, {characters} characters")
+        print(f"{'legacy':<14} {legacy_elapsed * 1000:9.1f} ms")
+        print(f"{'span-based':<14} {span_elapsed * 1000:9.1f} ms")
+        print(f"speedup {legacy_elapsed / span_elapsed:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+prepdocs のセクション分割(split_text)のベンチマーク。
+文書全体を連結してセクションごとに page_map を線形に探していた従来の実装と、ページを読み込みながら二分探索でページを求める documenttext.split_text を、
+合成した 5,000 ページの文書(表を含む)で比較し、分割結果が同じことも確認する。
+
+    python scripts/benchmarks/bench_split_text.py
+    python scripts/benchmarks/bench_split_text.py --pages 20000 --table-ratio 0.3
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+from documenttext import split_text, MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP
+
+SENTENCES = ["Submit the leave request from the attendance system.", "The manager approves it within three days!",
+             "Expenses are settled on the 25th of each month.", "See the employment rules for details (section 4; appendix B).",
+             "Can remote work be requested for a single day?", "有給休暇の申請は勤怠システムから行います。"]
+
+def legacy_split_text(page_map):
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        l = len(page_map)
+        for i in range(l - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return l - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+def synthetic_page_map(pages: int, table_ratio: float, seed: int) -> list:
+    rng = random.Random(seed)
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        parts = [rng.choice(SENTENCES) + " " for _ in range(rng.randint(10, 40))]
+        if rng.random() < table_ratio:
+            rows = "".join(f"<tr><td>{rng.choice(SENTENCES)}</td><td>{rng.randint(1, 999)}</td></tr>" for _ in range(rng.randint(3, 30)))
+            parts.insert(rng.randint(0, len(parts)), f"<table>{rows}</table>")
+        page_text = "".join(parts)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def measure(func, page_map) -> tuple:
+    start = time.perf_counter()
+    sections = list(func(page_map))
+    elapsed = time.perf_counter() - start
+    # tracemalloc は処理を遅くするので、メモリは時間とは別に測る。結果のセクション自体を除いた、分割中に確保したメモリのピーク
+    tracemalloc.start()
+    peak_sections = list(func(page_map))
+    peak = tracemalloc.get_traced_memory()[1] - sum(sys.getsizeof(s[0]) for s in peak_sections)
+    tracemalloc.stop()
+    return sections, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument("--table-ratio", type=float, default=0.2, help="表を含むページの割合")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    page_map = synthetic_page_map(args.pages, args.table_ratio, args.seed)
+    characters = sum(len(p[2]) for p in page_map)
+
+    legacy, legacy_elapsed, legacy_peak = measure(legacy_split_text, page_map)
+    # ページをイテレータで渡す(抽出しながら分割する場合と同じ)
+    streamed, stream_elapsed, stream_peak = measure(lambda pages: split_text(iter(pages)), page_map)
+
+    assert streamed == legacy, "sections differ from the legacy implementation"
+    print(f"{args.pages} pages, {characters} characters, {len(streamed)} sections")
+    print(f"{'legacy':<14} {legacy_elapsed * 1000:9.1f} ms  peak {legacy_peak / 1024:8.0f} KiB")
+    print(f"{'streaming':<14} {stream_elapsed * 1000:9.1f} ms  peak {stream_peak / 1024:8.0f} KiB")
+    print(f"speedup {legacy_elapsed / stream_elapsed:.1f}x")
+
+if __name__ == "__main__":
+    main()
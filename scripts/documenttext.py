@@ -0,0 +1,167 @@
+import html
+from bisect import bisect_right
+from collections import defaultdict
+
+# prepdocs.py から使う、抽出結果をページごとのテキストにしてセクションに分ける処理(ネットワークを使わないのでベンチマークからも読み込める)
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+def table_to_html(table):
+    # セルを一度だけ走査して行ごとに振り分ける
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    parts = ["<table>"]
+    for row_cells in rows:
+        parts.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
+            parts.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
+def table_segments(tables, page_offset, page_length):
+    # ページ内の [開始, 終了) の区間ごとに、その範囲を占める表の番号(表で無ければ -1)を返す。
+    # 表の範囲が重なる場合は後の表を優先する(1文字ずつ表の番号を上書きしていた以前の実装と同じ)
+    ranges = []
+    for table_id, table in enumerate(tables):
+        for span in table.spans:
+            start = max(span.offset - page_offset, 0)
+            end = min(span.offset - page_offset + span.length, page_length)
+            if start < end:
+                ranges.append((start, end, table_id))
+    if not ranges:
+        return [(0, page_length, -1)] if page_length > 0 else []
+    points = sorted({0, page_length}.union(r[0] for r in ranges).union(r[1] for r in ranges))
+    segments = []
+    for start, end in zip(points, points[1:]):
+        # 1ページの表の範囲は多くても数十なので、区間ごとに全部見ても文字数に比べて十分小さい
+        owner = max((table_id for s, e, table_id in ranges if s <= start < e), default=-1)
+        segments.append((start, end, owner))
+    return segments
+
+def page_map_from_analyze_result(form_recognizer_results):
+    # Form Recognizer の結果から (ページ番号, 文書全体でのオフセット, ページのテキスト) のリストを作る。
+    # 表以外の範囲はまとめて切り出し、表は最初に現れた位置に HTML として1回だけ入れる
+    tables_by_page = defaultdict(list)
+    for table in form_recognizer_results.tables or []:
+        tables_by_page[table.bounding_regions[0].page_number].append(table)
+    content = form_recognizer_results.content
+
+    offset = 0
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page[page_num + 1]
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+
+        parts = []
+        added_tables = set()
+        for start, end, table_id in table_segments(tables_on_page, page_offset, page_length):
+            if table_id == -1:
+                parts.append(content[page_offset + start:page_offset + end])
+            elif table_id not in added_tables:
+                parts.append(table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+        parts.append(" ")
+
+        page_text = "".join(parts)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+def split_text(page_map, verbose = False, filename = ""):
+    # page_map は (ページ番号, オフセット, テキスト) のリストかイテレータ。
+    # 文書全体を連結せず、セクションの前後を探すのに必要な範囲だけをページから読み込んで保持する
+    if verbose: print(f"Splitting '{filename}' into sections")
+    pages = iter(page_map)
+    page_offsets = []
+    text = ""
+    text_start = 0
+    exhausted = False
+
+    def load(position):
+        # 文書の position の文字まで(文書が短ければ最後まで)読み込み、読み込んだ範囲の終わりを返す
+        nonlocal text, exhausted
+        loaded = text_start + len(text)
+        parts = [text]
+        while loaded <= position and not exhausted:
+            page = next(pages, None)
+            if page is None:
+                exhausted = True
+                break
+            page_offsets.append(page[1])
+            parts.append(page[2])
+            loaded += len(page[2])
+        if len(parts) > 1:
+            text = "".join(parts)
+        return loaded
+
+    def find_page(offset):
+        return max(bisect_right(page_offsets, offset) - 1, 0)
+
+    # 1つのセクションで参照するのは start - (MAX_SECTION_LENGTH + 2 * SENTENCE_SEARCH_LIMIT) から start + MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT まで。
+    # 読み込みが足りていなければ length は読み込んだ範囲の終わりになるが、その位置まで探すことは無いので文書全体の長さと同じ結果になる
+    lookahead = MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT + 1
+    lookbehind = MAX_SECTION_LENGTH + 2 * SENTENCE_SEARCH_LIMIT
+    start = 0
+    length = load(start + lookahead)
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and text[end - text_start] not in SENTENCE_ENDINGS:
+                if text[end - text_start] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and text[end - text_start] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and text[start - text_start] not in SENTENCE_ENDINGS:
+            if text[start - text_start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if text[start - text_start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = text[start - text_start:end - text_start]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside SECTION_OVERLAP, keep overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+        # 次のセクションで参照しない前の部分を捨て、足りない後ろの部分を読み込む
+        if start - lookbehind > text_start:
+            text = text[start - lookbehind - text_start:]
+            text_start = start - lookbehind
+        length = load(start + lookahead)
+
+    if start + SECTION_OVERLAP < end:
+        yield (text[start - text_start:end - text_start], find_page(start))
@@ -1,23 +1,30 @@
 import os
 import argparse
 import glob
-import html
 import io
 import re
+import json
 import time
+import queue
+import hashlib
+import threading
+import requests
+import openai
+import openai.error
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pypdf import PdfReader, PdfWriter
 from azure.identity import AzureDeveloperCliCredential
 from azure.identity import ManagedIdentityCredential
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import *
 from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
-
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+from documenttext import page_map_from_analyze_result, split_text
 
 parser = argparse.ArgumentParser(
     description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
@@ -38,6 +45,24 @@ parser.add_argument("--removeall", action="store_true", help="Remove all blobs f
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--workers", type=int, default=1, help="Number of files to extract concurrently. Values above 1 run the extract, split, embed and index stages as a pipeline connected by bounded queues")
+parser.add_argument("--queuesize", type=int, default=4, help="Maximum number of files waiting between two pipeline stages (used with --workers)")
+parser.add_argument("--manifest", required=False, help="Optional. Path of a local checkpoint manifest. Files already indexed with the same content are skipped, so an interrupted run resumes where it stopped")
+parser.add_argument("--uploadconcurrency", type=int, default=8, help="Number of page blobs uploaded concurrently, shared by all workers")
+parser.add_argument("--indexbatchsize", type=int, default=1000, help="Maximum number of sections sent to the search index in one request")
+parser.add_argument("--indexbatchbytes", type=int, default=8 * 1024 * 1024, help="Maximum JSON payload size in bytes of one indexing request (the service rejects requests over 16 MB)")
+parser.add_argument("--indexconcurrency", type=int, default=4, help="Maximum number of indexing requests in flight. Lowered automatically while the service throttles")
+parser.add_argument("--indexretries", type=int, default=5, help="Number of times a failed or throttled section is sent again")
+parser.add_argument("--openaiservice", required=False, help="Optional. Name of the Azure OpenAI service used to generate section embeddings. Embeddings are not generated when this is not set")
+parser.add_argument("--openaideployment", default="text-embedding-ada-002", help="Name of the Azure OpenAI embedding deployment")
+parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--openaiapiversion", default="2023-05-15", help="Azure OpenAI API version used for embeddings")
+parser.add_argument("--vectorfield", default="vector", help="Name of the vector field in the search index (the app searches the field named by KB_FIELDS_CONTENT)")
+parser.add_argument("--embeddingdimensions", type=int, default=1536, help="Number of dimensions of the embedding model")
+parser.add_argument("--embeddingbatchsize", type=int, default=16, help="Maximum number of sections sent in one embedding request")
+parser.add_argument("--embeddingconcurrency", type=int, default=4, help="Number of embedding requests in flight")
+parser.add_argument("--embeddingcache", required=False, help="Optional. Directory of a local cache of section embeddings keyed by content hash, so unchanged sections are not embedded again")
+parser.add_argument("--incremental", action="store_true", help="Use content-hash section ids and the --manifest to upload only changed page blobs and sections, and delete sections that no longer exist")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
 parser.add_argument('--managedidentitycredential', action='store_true', help='Use Managed Identity (e.g., Cloud Shell) credentials')
 args = parser.parse_args()
@@ -50,7 +75,8 @@ else:
     default_creds = azd_credential if args.searchkey is None or args.storagekey is None else None
 search_creds = default_creds if args.searchkey is None else AzureKeyCredential(args.searchkey)
 
-if not args.skipblobs:
+# --skipblobs でもインデックスの版のマーカー(mark_index_version)は Blob Storage に書き込む
+if args.storageaccount:
     storage_creds = default_creds if args.storagekey is None else args.storagekey
 if not args.localpdfparser:
     # check if Azure Form Recognizer credentials are provided
@@ -58,41 +84,105 @@ if not args.localpdfparser:
         print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
         exit(1)
     formrecognizer_creds = default_creds if args.formrecognizerkey is None else AzureKeyCredential(args.formrecognizerkey)
+if args.openaiservice:
+    openai.api_base = f"https://{args.openaiservice}.openai.azure.com"
+    openai.api_version = args.openaiapiversion
+    if args.openaikey is None:
+        openai.api_type = "azure_ad"
+        openai_creds = default_creds or azd_credential
+    else:
+        openai.api_type = "azure"
+        openai.api_key = args.openaikey
+if args.incremental and args.manifest is None:
+    print("Error: --incremental requires --manifest to remember the content hashes of the previous run.")
+    exit(1)
+
+def is_pdf(filename):
+    return os.path.splitext(filename)[1].lower() == ".pdf"
 
 def blob_name_from_file_page(filename, page = 0):
-    if os.path.splitext(filename)[1].lower() == ".pdf":
+    if is_pdf(filename):
         return os.path.splitext(os.path.basename(filename))[0] + f"-{page}" + ".pdf"
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if not blob_container.exists():
-        blob_container.create_container()
+# Blob Storage のクライアントはすべてのファイルとワーカーで共有し、コンテナーの確認も1回だけ行う
+blob_container_client = None
+blob_container_ready = False
+blob_container_lock = threading.Lock()
+upload_executor = ThreadPoolExecutor(max_workers=max(1, args.uploadconcurrency), thread_name_prefix="blob-upload")
+
+def pooled_transport(concurrency):
+    # 同時に送る数だけ接続を使い回せるように、コネクションプールの大きさを合わせる
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(10, concurrency)))
+    return RequestsTransport(session=session, session_owner=False)
+
+def get_blob_container():
+    global blob_container_client
+    with blob_container_lock:
+        if blob_container_client is None:
+            blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds,
+                                             transport=pooled_transport(args.uploadconcurrency))
+            blob_container_client = blob_service.get_container_client(args.container)
+        return blob_container_client
+
+def ensure_blob_container():
+    global blob_container_ready
+    blob_container = get_blob_container()
+    with blob_container_lock:
+        if not blob_container_ready:
+            if not blob_container.exists():
+                blob_container.create_container()
+            blob_container_ready = True
+    return blob_container
+
+def upload_blobs(filename, known_pages = None, reader = None):
+    # ページごとの内容のハッシュを返す。known_pages(前回のハッシュ)と同じページはアップロードしない
+    blob_container = ensure_blob_container()
 
     # if file is PDF split into pages and upload each page as a separate blob
-    if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
+    if is_pdf(filename):
+        # ページの書き出しは PdfReader を共有するこのスレッドで行い、アップロードだけを upload_executor で並行に行う
+        reader = reader or PdfReader(filename)
         pages = reader.pages
+        uploads = []
+        page_hashes = []
         for i in range(len(pages)):
             blob_name = blob_name_from_file_page(filename, i)
-            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
             f = io.BytesIO()
             writer = PdfWriter()
             writer.add_page(pages[i])
             writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
+            page_hashes.append(hashlib.sha256(f.getbuffer()).hexdigest())
+            if known_pages is not None and i < len(known_pages) and known_pages[i] == page_hashes[i]:
+                if args.verbose: print(f"\tSkipping unchanged page {i} -> {blob_name}")
+                continue
+            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
+            uploads.append(upload_executor.submit(blob_container.upload_blob, blob_name, f.getvalue(), overwrite=True))
+            # 書き出したページをメモリに溜めすぎないように、同時にアップロードする数の2倍を超えたら終わるのを待つ
+            if len(uploads) >= 2 * args.uploadconcurrency:
+                done, pending = wait(uploads, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                uploads = list(pending)
+        for future in uploads:
+            future.result()
+        # ページが減った場合は残っている後ろのページを消す
+        for i in range(len(pages), len(known_pages or [])):
+            blob_name = blob_name_from_file_page(filename, i)
+            if args.verbose: print(f"\tRemoving blob for removed page {i} -> {blob_name}")
+            blob_container.delete_blob(blob_name)
+        return page_hashes
     else:
         blob_name = blob_name_from_file_page(filename)
         with open(filename,"rb") as data:
             blob_container.upload_blob(blob_name, data, overwrite=True)
+        return None
 
 def remove_blobs(filename):
     if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
+    blob_container = get_blob_container()
     if blob_container.exists():
         if filename is None:
             blobs = blob_container.list_blob_names()
@@ -103,26 +193,37 @@ def remove_blobs(filename):
             if args.verbose: print(f"\tRemoving blob {b}")
             blob_container.delete_blob(b)
 
-def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
-    for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
-            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
-            cell_spans = ""
-            if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
-            if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
-
-def get_document_text(filename):
+def mark_index_version(filename, removed = False):
+    # アプリの回答キャッシュ(src/backend/core/answercache.py)は、このマーカーの ETag が変わるとこのファイルを根拠にした回答を無効にする
+    if args.storageaccount is None:
+        return
+    blob_container = get_blob_container()
+    blob_name = f"index-versions/{os.path.basename(filename)}"
+    if removed:
+        if blob_container.exists() and blob_container.get_blob_client(blob_name).exists():
+            if args.verbose: print(f"\tRemoving index version marker {blob_name}")
+            blob_container.delete_blob(blob_name)
+        else:
+            # マーカーの無いファイルを根拠にした回答はどれか分からないので、すべての回答を無効にする
+            bump_index_version()
+        return
+    ensure_blob_container()
+    if args.verbose: print(f"\tUpdating index version marker {blob_name}")
+    blob_container.upload_blob(blob_name, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), overwrite=True)
+
+def bump_index_version():
+    # インデックス全体の版(index-version)。これが変わるとアプリの回答キャッシュはすべての回答を無効にする
+    if args.storageaccount is None:
+        return
+    blob_container = ensure_blob_container()
+    if args.verbose: print("\tUpdating index version marker index-version")
+    blob_container.upload_blob("index-version", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), overwrite=True)
+
+def get_document_text(filename, reader = None):
     offset = 0
     page_map = []
     if args.localpdfparser:
-        reader = PdfReader(filename)
+        reader = reader or PdfReader(filename)
         pages = reader.pages
         for page_num, p in enumerate(pages):
             page_text = p.extract_text()
@@ -135,107 +236,40 @@ def get_document_text(filename):
             poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
         form_recognizer_results = poller.result()
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif table_id not in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        page_map = page_map_from_analyze_result(form_recognizer_results)
 
     return page_map
 
-def split_text(page_map):
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-    if args.verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-        
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+def section_id(filename, i, section, sourcepage, seen):
+    if not args.incremental:
+        return re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}")
+    # 内容から id を作るので、前後に文章が増減しても変わっていないセクションは同じ id になる
+    digest = hashlib.sha256(json.dumps([section, sourcepage, args.category], ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+    id = re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{digest}")
+    # 同じ内容のセクションが複数ある場合は出現順の番号を付ける
+    seen[id] = seen.get(id, 0) + 1
+    return id if seen[id] == 1 else f"{id}-{seen[id]}"
 
 def create_sections(filename, page_map):
-    for i, (section, pagenum) in enumerate(split_text(page_map)):
+    seen = {}
+    for i, (section, pagenum) in enumerate(split_text(page_map, args.verbose, filename)):
+        sourcepage = blob_name_from_file_page(filename, pagenum)
         yield {
-            "id": re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}"),
+            "id": section_id(filename, i, section, sourcepage, seen),
             "content": section,
             "category": args.category,
-            "sourcepage": blob_name_from_file_page(filename, pagenum),
+            "sourcepage": sourcepage,
             "sourcefile": filename
         }
 
+def vector_field():
+    # アプリは KB_FIELDS_CONTENT のフィールドをベクトル検索する(vector_fields)
+    return SearchField(name=args.vectorfield, type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                       searchable=True, vector_search_dimensions=args.embeddingdimensions, vector_search_configuration="default")
+
+def vector_search():
+    return VectorSearch(algorithm_configurations=[VectorSearchAlgorithmConfiguration(name="default", kind="hnsw", hnsw_parameters=HnswParameters(metric="cosine"))])
+
 def create_search_index():
     if args.verbose: print(f"Ensuring search index {args.index} exists")
     index_client = SearchIndexClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
@@ -248,8 +282,10 @@ def create_search_index():
                 SearchableField(name="content", type="Edm.String", analyzer_name="ja.microsoft"),
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
-                SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True)
+                SimpleField(name="sourcefile", type="Edm.String", filterable=True, facetable=True),
+                vector_field()
             ],
+            vector_search=vector_search(),
             semantic_settings=SemanticSettings(
                 configurations=[SemanticConfiguration(
                     name='default',
@@ -260,27 +296,328 @@ def create_search_index():
         index_client.create_index(index)
     else:
         if args.verbose: print(f"Search index {args.index} already exists")
+        if args.openaiservice:
+            # 以前のスキーマで作ったインデックスにはベクトルのフィールドを追加する
+            index = index_client.get_index(args.index)
+            if all(field.name != args.vectorfield for field in index.fields):
+                if args.verbose: print(f"Adding vector field {args.vectorfield} to search index {args.index}")
+                index.fields.append(vector_field())
+                if index.vector_search is None or not index.vector_search.algorithm_configurations:
+                    index.vector_search = vector_search()
+                index_client.create_or_update_index(index)
+
+class EmbeddingCache:
+    """
+      セクションの埋め込みベクトルのディスクキャッシュ。
+      vectors.f32 に float32 のベクトルを行ごとに追記し、keys.txt に同じ順序でキーを保存する(アプリの EmbeddingDiskStore と同じ形式)。
+      Methods:
+          get(self, key: str): ベクトルを返す。無ければ None を返す。
+          put_many(self, items): (キー, ベクトル) をまとめて追記する。
+      """
+
+    def __init__(self, directory: str, dimensions: int):
+        os.makedirs(directory, exist_ok=True)
+        self.dimensions = dimensions
+        self.row_bytes = dimensions * array("f").itemsize
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self._lock = threading.Lock()
+        self._rows = {}
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, encoding="utf-8") as f:
+                keys = f.read().splitlines()
+        # 書き込み中に止まった場合は、ベクトルとキーの両方が揃っている行までを使う
+        rows = min(len(keys), os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0)
+        if rows < len(keys) or (os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != rows * self.row_bytes):
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(rows * self.row_bytes)
+            with open(self.keys_path, "w", encoding="utf-8") as f:
+                f.write("".join(key + "\n" for key in keys[:rows]))
+        for row, key in enumerate(keys[:rows]):
+            self._rows[key] = row
+        self._reader = open(self.vectors_path, "a+b")
+
+    def get(self, key: str):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        vector = array("f")
+        with self._lock:
+            self._reader.seek(row * self.row_bytes)
+            vector.frombytes(self._reader.read(self.row_bytes))
+        return vector.tolist()
+
+    def put_many(self, items):
+        with self._lock:
+            items = [(key, vector) for key, vector in items if key not in self._rows and len(vector) == self.dimensions]
+            if not items:
+                return
+            # ベクトルを先に書き出すので、途中で止まってもキーがずれることは無い
+            with open(self.vectors_path, "ab") as f:
+                for _, vector in items:
+                    f.write(array("f", vector).tobytes())
+            with open(self.keys_path, "a", encoding="utf-8") as f:
+                for key, _ in items:
+                    f.write(key + "\n")
+            for key, _ in items:
+                self._rows[key] = len(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+openai_token = None
+openai_token_lock = threading.Lock()
+
+def ensure_openai_key():
+    # キーを指定しない場合は Azure AD のトークンを使い、期限が切れる5分前に取り直す
+    global openai_token
+    if args.openaikey is not None:
+        return
+    with openai_token_lock:
+        if openai_token is None or openai_token.expires_on < time.time() + 300:
+            openai_token = openai_creds.get_token("https://cognitiveservices.azure.com/.default")
+            openai.api_key = openai_token.token
+
+class SectionEmbedder:
+    """
+      セクションの埋め込みベクトルを作る。複数のセクションを1回のリクエストにまとめ、複数のリクエストを同時に送る。
+      ベクトルは本文のハッシュをキーに EmbeddingCache に保存するので、変わっていないセクションは問い合わせない。
+      Methods:
+          embed_sections(self, sections: list): 各セクションにベクトルのフィールドを追加する。
+          report(self): 問い合わせた数とキャッシュのヒット数を表示する。
+      """
+
+    RETRY_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError)
+
+    def __init__(self, deployment: str, batch_size: int, concurrency: int, cache: EmbeddingCache = None, max_retries: int = 5):
+        self.deployment = deployment
+        self.batch_size = max(1, batch_size)
+        self.cache = cache
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="embedding")
+        self._lock = threading.Lock()
+        self.metrics = {"sections": 0, "reused": 0, "embedded": 0, "requests": 0, "retried": 0}
+
+    def make_key(self, text: str) -> str:
+        # アプリの EmbeddingService と同じキー(デプロイ名と本文のハッシュ)
+        return hashlib.sha256(f"{self.deployment}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed_sections(self, sections: list):
+        keys = [self.make_key(s["content"]) for s in sections]
+        vectors = {}
+        missing = {}
+        for key, section in zip(keys, sections):
+            if key in vectors or key in missing:
+                continue
+            vector = self.cache.get(key) if self.cache is not None else None
+            if vector is not None:
+                vectors[key] = vector
+            else:
+                missing[key] = section["content"]
+        missing = list(missing.items())
+        futures = [self._executor.submit(self._request, missing[i:i + self.batch_size]) for i in range(0, len(missing), self.batch_size)]
+        for future in futures:
+            vectors.update(future.result())
+        for key, section in zip(keys, sections):
+            section[args.vectorfield] = vectors[key]
+        with self._lock:
+            self.metrics["sections"] += len(sections)
+            self.metrics["reused"] += len(sections) - len(missing)
+
+    def _request(self, batch: list) -> dict:
+        for attempt in range(self.max_retries + 1):
+            try:
+                ensure_openai_key()
+                response = openai.Embedding.create(input=[text for _, text in batch], engine=self.deployment)
+                break
+            except self.RETRY_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.metrics["retried"] += 1
+                delay = min(2 ** attempt, 60)
+                if args.verbose: print(f"\tEmbedding request failed: {str(e)}, retrying in {delay} s")
+                time.sleep(delay)
+        data = sorted(response["data"], key=lambda d: d["index"])
+        vectors = {key: d["embedding"] for (key, _), d in zip(batch, data)}
+        if self.cache is not None:
+            self.cache.put_many(vectors.items())
+        with self._lock:
+            self.metrics["requests"] += 1
+            self.metrics["embedded"] += len(batch)
+        return vectors
+
+    def report(self):
+        if self.metrics["sections"]:
+            print(f"Embedded {self.metrics['embedded']} sections in {self.metrics['requests']} requests, "
+                  f"{self.metrics['reused']} of {self.metrics['sections']} from cache or duplicates, {self.metrics['retried']} retried")
+
+class SectionIndexer:
+    """
+      セクションをまとめて検索インデックスに登録する。すべてのファイルとワーカーで共有する。
+      バッチは件数と JSON のバイト数の両方で区切り、複数のバッチを同時に送る。
+      リクエストが 429/503 で断られると同時に送る数を半分にして間隔を空け、一部のセクションだけが 429/503 の場合は同時に送る数だけを減らす。
+      成功が続くと同時に送る数を1つずつ戻して間隔を縮める。失敗したセクションだけを送り直す。
+      Methods:
+          index(self, sections: list): セクションを登録し、(成功した数, 失敗した数) を返す。
+          report(self): 登録したセクション数とスループットを表示する。
+      """
+
+    # ドキュメント単位で送り直すステータス(400 などは送り直しても変わらない)
+    RETRY_STATUS_CODES = {409, 422, 429, 500, 502, 503, 504}
+    THROTTLE_STATUS_CODES = {429, 503}
+    MAX_DELAY = 60
+
+    def __init__(self, search_client, batch_size: int, batch_bytes: int, concurrency: int, max_retries: int):
+        self.search_client = search_client
+        self.batch_size = max(1, batch_size)
+        self.batch_bytes = batch_bytes
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.limit = self.concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.delay = 0
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="index-upload")
+        self.metrics = {"sections": 0, "bytes": 0, "batches": 0, "retried": 0, "throttled": 0, "failed": 0}
+        self.started = None
+        self.finished = None
+
+    def batches(self, sections):
+        # (バッチ, セクションの id ごとの JSON のバイト数) を返す
+        batch = []
+        sizes = {}
+        batch_bytes = 0
+        for section in sections:
+            size = len(json.dumps(section, ensure_ascii=False).encode("utf-8"))
+            if batch and (len(batch) >= self.batch_size or batch_bytes + size > self.batch_bytes):
+                yield batch, sizes
+                batch = []
+                sizes = {}
+                batch_bytes = 0
+            batch.append(section)
+            sizes[section["id"]] = size
+            batch_bytes += size
+        if batch:
+            yield batch, sizes
+
+    def index(self, sections) -> tuple:
+        futures = [self._executor.submit(self._upload_batch, batch, sizes) for batch, sizes in self.batches(sections)]
+        results = [future.result() for future in futures]
+        return sum(r[0] for r in results), sum(r[1] for r in results)
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+            if self.started is None:
+                self.started = time.time()
+            delay = self.delay
+        if delay:
+            time.sleep(delay)
+
+    def _release(self, throttled: bool, rejected: bool = False, retry_after: float = None):
+        # throttled: 429/503 を受け取った。rejected: リクエスト全体が断られた
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.metrics["throttled"] += 1
+                self.limit = max(1, self.limit // 2)
+                if rejected:
+                    self.delay = min(max(self.delay * 2, 1.0, retry_after or 0), self.MAX_DELAY)
+                self.successes = 0
+                if args.verbose: print(f"\tSearch service is throttling, sending {self.limit} batches at a time with {self.delay:.1f} s delay")
+            else:
+                # 同時に送っている数だけ続けて成功したら、同時に送る数を1つ増やして間隔を縮める
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.successes = 0
+                    self.limit = min(self.concurrency, self.limit + 1)
+                    self.delay = self.delay / 2 if self.delay > 0.1 else 0
+            self._condition.notify_all()
+
+    def _upload_batch(self, batch: list, sizes: dict) -> tuple:
+        pending = batch
+        succeeded = 0
+        # スループットには登録できたセクションの分だけを数える
+        succeeded_bytes = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                with self._condition:
+                    self.metrics["retried"] += len(pending)
+                time.sleep(min(0.5 * 2 ** attempt, self.MAX_DELAY))
+            self._acquire()
+            try:
+                results = self.search_client.upload_documents(documents=pending)
+            except HttpResponseError as e:
+                throttled = e.status_code in self.THROTTLE_STATUS_CODES
+                retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+                self._release(throttled, True, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                if e.status_code not in self.RETRY_STATUS_CODES:
+                    raise
+                if args.verbose: print(f"\tIndexing request failed with {e.status_code}, retrying {len(pending)} sections")
+                continue
+            except (ServiceRequestError, ServiceResponseError) as e:
+                self._release(False)
+                if args.verbose: print(f"\tIndexing request failed: {str(e)}, retrying {len(pending)} sections")
+                continue
+
+            by_id = {section["id"]: section for section in pending}
+            retry = []
+            for r in results:
+                if r.succeeded:
+                    succeeded += 1
+                    succeeded_bytes += sizes.get(r.key, 0)
+                elif r.status_code in self.RETRY_STATUS_CODES:
+                    retry.append(by_id[r.key])
+                else:
+                    print(f"\tFailed to index section {r.key}: {r.status_code} {r.error_message}")
+                    with self._condition:
+                        self.metrics["failed"] += 1
+            self._release(any(not r.succeeded and r.status_code in self.THROTTLE_STATUS_CODES for r in results))
+            pending = retry
+            if not pending:
+                break
+
+        with self._condition:
+            if pending:
+                print(f"\tGave up indexing {len(pending)} sections after {self.max_retries} retries")
+                self.metrics["failed"] += len(pending)
+            self.metrics["sections"] += succeeded
+            self.metrics["bytes"] += succeeded_bytes
+            self.metrics["batches"] += 1
+            self.finished = time.time()
+        return succeeded, len(batch) - succeeded
+
+    def report(self):
+        if self.started is None:
+            return
+        elapsed = max(self.finished - self.started, 1e-6)
+        megabytes = self.metrics["bytes"] / (1024 * 1024)
+        print(f"Indexed {self.metrics['sections']} sections ({megabytes:.1f} MB) in {elapsed:.1f} s: "
+              f"{self.metrics['sections'] / elapsed:.1f} sections/s, {megabytes / elapsed:.2f} MB/s, "
+              f"{self.metrics['batches']} batches, {self.metrics['retried']} retried, {self.metrics['throttled']} throttled, {self.metrics['failed']} failed")
 
 def index_sections(filename, sections):
     if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
+    succeeded, failed = indexer.index(sections)
+    if args.verbose: print(f"\tIndexed {succeeded + failed} sections, {succeeded} succeeded")
+    return failed
+
+def delete_sections(ids):
+    # 消すセクションの id が分かっている場合はまとめて削除する(検索し直して待つ必要が無い)
+    ids = list(ids)
+    if not ids:
+        return
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
                                     credential=search_creds)
-    i = 0
-    batch = []
-    for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-            batch = []
-
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    for i in range(0, len(ids), 1000):
+        r = search_client.delete_documents(documents=[{ "id": id } for id in ids[i:i + 1000]])
+        if args.verbose: print(f"\tRemoved {len(r)} sections from index")
 
 def remove_from_index(filename):
     if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
@@ -297,25 +634,234 @@ def remove_from_index(filename):
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
 
+class IngestManifest:
+    """
+      取り込みが終わったファイルを記録するローカルのチェックポイント。
+      ファイルの内容のハッシュと一緒に記録するので、途中で止まった実行をやり直すと終わったファイルは飛ばし、内容が変わったファイルは取り込み直す。
+      取り込みの結果を変える設定(settings: --category や埋め込みの設定)も記録し、設定が変わったファイルは内容が同じでも取り込み直す。
+      Methods:
+          is_done(self, filename: str, file_hash: str): 同じ内容のファイルが同じ設定で取り込み済みかを返す。
+          mark_done(self, filename: str, file_hash: str, **info): 取り込み済みとして記録し、ファイルに書き出す。
+          get(self, filename: str): ファイルの記録(前回のページとセクションのハッシュなど)を返す。
+          remove(self, filename: str): ファイルの記録を消す。
+          clear(self): すべての記録を消す。
+      """
+
+    def __init__(self, path: str, index: str, settings: dict = None):
+        self.path = path
+        self.index = index
+        self.settings = settings or {}
+        self.files = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            # 別のインデックス向けの記録は使わない
+            if data.get("index") == index:
+                self.files = data.get("files", {})
+            elif args.verbose: print(f"Manifest '{path}' was written for index '{data.get('index')}', ignoring it")
+
+    def is_done(self, filename: str, file_hash: str) -> bool:
+        entry = self.files.get(os.path.basename(filename))
+        return entry is not None and entry.get("hash") == file_hash and entry.get("settings") == self.settings
+
+    def get(self, filename: str) -> dict:
+        return self.files.get(os.path.basename(filename)) or {}
+
+    def mark_done(self, filename: str, file_hash: str, **info):
+        with self._lock:
+            self.files[os.path.basename(filename)] = dict(info, hash=file_hash, settings=self.settings, indexed=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+            self.save()
+
+    def remove(self, filename: str):
+        with self._lock:
+            if self.files.pop(os.path.basename(filename), None) is not None:
+                self.save()
+
+    def clear(self):
+        with self._lock:
+            self.files = {}
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # 書き込み中に止まっても前の記録が壊れないように、一時ファイルに書いてから置き換える
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"index": self.index, "files": self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# 取り込みの結果(インデックスのドキュメント)を変える設定。manifest に記録し、変わったファイルは取り込み直す
+def ingest_settings():
+    return {"category": args.category,
+            "embedding": [args.openaideployment, args.embeddingdimensions, args.vectorfield] if args.openaiservice else None}
+
+# --incremental で登録し直さなくてよい、前回登録したセクションの id
+def known_section_ids(filename):
+    previous = manifest.get(filename)
+    # カテゴリはセクションごとに保存しているので、変わった場合は前回のセクションも登録し直す
+    if "settings" not in previous or previous["settings"].get("category") != args.category:
+        return set()
+    # 前回ベクトル無しで(または別の埋め込みの設定で)登録したセクションは、ベクトルを作って登録し直す
+    embedding = ingest_settings()["embedding"]
+    if embedding is not None and previous["settings"].get("embedding") != embedding:
+        return set()
+    return set(previous.get("section_ids", []))
+
+def pending_files(filenames):
+    for filename in filenames:
+        item = {"filename": filename, "hash": file_hash(filename)}
+        if manifest.is_done(filename, item["hash"]):
+            if args.verbose: print(f"Skipping '{filename}', already indexed")
+            continue
+        yield item
+
+# 取り込みのステージ。item は {"filename", "hash", ...} の dict で、各ステージが結果を足して次に渡す
+def extract_stage(item):
+    filename = item["filename"]
+    if args.verbose: print(f"Processing '{filename}'")
+    # PDF は1回だけ読み込み、ページ単位の Blob への分割とテキストの抽出(--localpdfparser)で同じページを使う
+    reader = PdfReader(filename) if is_pdf(filename) and (args.localpdfparser or not args.skipblobs) else None
+    if not args.skipblobs:
+        known_pages = manifest.get(filename).get("pages") if args.incremental else None
+        item["pages"] = upload_blobs(filename, known_pages, reader)
+    item["page_map"] = get_document_text(filename, reader)
+    return item
+
+def split_stage(item):
+    item["sections"] = list(create_sections(os.path.basename(item["filename"]), item.pop("page_map")))
+    return item
+
+def embed_stage(item):
+    sections = item["sections"]
+    if args.verbose: print(f"Embedding sections from '{item['filename']}'")
+    # --incremental では前回登録したセクション(id が本文のハッシュ)は登録し直さないので、ベクトルも作らない
+    known_ids = known_section_ids(item["filename"]) if args.incremental else set()
+    embedder.embed_sections([s for s in sections if s["id"] not in known_ids])
+    return item
+
+def index_stage(item):
+    filename = item["filename"]
+    sections = item["sections"]
+    if not args.incremental:
+        failed = index_sections(os.path.basename(filename), sections)
+        mark_index_version(filename)
+        if failed:
+            print(f"{failed} sections of '{filename}' could not be indexed, it will be processed again in the next run")
+        else:
+            manifest.mark_done(filename, item["hash"], sections=len(sections))
+        return item
+
+    previous = manifest.get(filename)
+    if "section_ids" in previous:
+        known_ids = known_section_ids(filename)
+    else:
+        # 前回の id が分からない(初めての取り込みか、--incremental 無しで取り込んだ)ファイルは一度すべて消してから入れ直す
+        remove_from_index(filename)
+        known_ids = set()
+    section_ids = [s["id"] for s in sections]
+    changed = [s for s in sections if s["id"] not in known_ids]
+    orphaned = set(previous.get("section_ids", [])).difference(section_ids)
+    if args.verbose: print(f"\t{len(changed)} of {len(sections)} sections changed, {len(orphaned)} to remove")
+    # 先に新しいセクションを入れてから古いものを消すので、途中で検索結果が空になることは無い
+    failed = index_sections(os.path.basename(filename), changed)
+    delete_sections(orphaned)
+    mark_index_version(filename)
+    # 登録できなかったセクションがあるファイルは記録しないので、次の実行で取り込み直す
+    if failed:
+        print(f"{failed} sections of '{filename}' could not be indexed, it will be processed again in the next run")
+        return item
+    manifest.mark_done(filename, item["hash"], sections=len(sections), section_ids=section_ids, pages=item.get("pages", previous.get("pages")))
+    return item
+
+def stage_worker(name, func, inbox, outbox):
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        try:
+            item = func(item)
+        except Exception as e:
+            # 失敗したファイルはマニフェストに記録されないので、次の実行で取り込み直す
+            print(f"Error in {name} stage for '{item['filename']}': {str(e)}")
+            continue
+        if outbox is not None:
+            outbox.put(item)
+
+def run_pipeline(items, stages):
+    # stages は (名前, 関数, ワーカー数) のリスト。ステージの間は上限付きのキューでつなぐので、
+    # 後ろのステージが遅いと前のステージが待ち、抽出済みのページがメモリに溜まり続けることは無い
+    inboxes = [queue.Queue(maxsize=args.queuesize) for _ in stages]
+    workers = []
+    for i, (name, func, count) in enumerate(stages):
+        outbox = inboxes[i + 1] if i + 1 < len(stages) else None
+        workers.append([threading.Thread(target=stage_worker, args=(name, func, inboxes[i], outbox), name=f"prepdocs-{name}-{n}", daemon=True) for n in range(count)])
+    for stage_workers in workers:
+        for t in stage_workers:
+            t.start()
+    for item in items:
+        inboxes[0].put(item)
+    # 前のステージのワーカーがすべて終わってから、次のステージに終わり(None)を伝える
+    for i, stage_workers in enumerate(workers):
+        for _ in stage_workers:
+            inboxes[i].put(None)
+        for t in stage_workers:
+            t.join()
+
+manifest = IngestManifest(args.manifest, args.index, ingest_settings())
+# SDK の再試行を無効にして 429/503 を SectionIndexer が直接受け取り、同時に送る数を調整する
+indexer = SectionIndexer(SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
+                                      index_name=args.index,
+                                      credential=search_creds,
+                                      transport=pooled_transport(args.indexconcurrency),
+                                      retry_total=0),
+                         args.indexbatchsize, args.indexbatchbytes, args.indexconcurrency, args.indexretries)
+embedder = SectionEmbedder(args.openaideployment, args.embeddingbatchsize, args.embeddingconcurrency,
+                           EmbeddingCache(args.embeddingcache, args.embeddingdimensions) if args.embeddingcache else None) if args.openaiservice else None
+
 if args.removeall:
     remove_blobs(None)
     remove_from_index(None)
-else:
-    if not args.remove:
-        create_search_index()
-    
+    bump_index_version()
+    manifest.clear()
+elif args.remove:
     print("Processing files...")
     for filename in glob.glob(args.files):
         if args.verbose: print(f"Processing '{filename}'")
-        if args.remove:
-            remove_blobs(filename)
-            remove_from_index(filename)
-        elif args.removeall:
-            remove_blobs(None)
-            remove_from_index(None)
+        remove_blobs(filename)
+        if "section_ids" in manifest.get(filename):
+            delete_sections(manifest.get(filename)["section_ids"])
         else:
-            if not args.skipblobs:
-                upload_blobs(filename)
-            page_map = get_document_text(filename)
-            sections = create_sections(os.path.basename(filename), page_map)
-            index_sections(os.path.basename(filename), sections)
\ No newline at end of file
+            remove_from_index(filename)
+        mark_index_version(filename, removed=True)
+        manifest.remove(filename)
+else:
+    create_search_index()
+
+    print("Processing files...")
+    started = time.time()
+    stages = [("extract", extract_stage, max(1, args.workers)),
+              ("split", split_stage, 1),
+              ("embed", embed_stage, 1),
+              ("index", index_stage, 1)]
+    if embedder is None:
+        stages = [stage for stage in stages if stage[0] != "embed"]
+    items = pending_files(glob.glob(args.files))
+    if args.workers > 1:
+        run_pipeline(items, stages)
+    else:
+        for item in items:
+            for _, func, _ in stages:
+                item = func(item)
+    if embedder is not None:
+        embedder.report()
+    indexer.report()
+    if args.verbose: print(f"Finished in {time.time() - started:.1f} s")
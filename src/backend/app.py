@@ -1,28 +1,32 @@
 import os
 import time
-import mimetypes
-import urllib.parse
-import jwt
-import jwt.algorithms
-import requests 
+import threading
 from flask import Flask, request, jsonify, Response, session, redirect
 
-import tiktoken
 import openai
 
-from core.messagebuilder import MessageBuilder
+from core.jwks import JwksKeyStore, OPENID_CONFIGURATION_URL
+from core.querycache import QueryRewriteCache, CosmosCacheBackend
+from core.answercache import AnswerCache, IndexVersionStore
+from core.clients import get_session, azure_transport, prewarm, get_pool_stats, LazyClient
+from core.modelhelper import get_token_metrics, preload_encodings
+from core.historysummary import history_summarizer
+from core.usage import usage_totals
+from core.blobcontent import BlobContentProxy, ContentCache, CONTENT_CHUNK_SIZE, CONTENT_CACHE_ENABLED, CONTENT_CACHE_DIR
 
 from dotenv import load_dotenv
 
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.storage.blob import BlobServiceClient
 from approaches.chatlogging import get_user_name, write_error
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatread import ChatReadApproach
-from approaches.chatlogging import select_user_conversations, select_conversation_content, delete_conversation_content
+from approaches.getcontent import embedding_service
+from approaches.chatlogging import select_user_conversations, select_conversation_content, delete_conversation_content, conversation_store, chatlog_writer, title_service, database, HISTORY_PAGE_SIZE
 
-from azure.monitor.opentelemetry import configure_azure_monitor
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 
 # .envファイルの内容を読み込見込む
@@ -39,6 +43,7 @@ AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX")
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "vector"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "chunk"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "title"
+KB_FIELDS_SOURCEFILE = os.environ.get("KB_FIELDS_SOURCEFILE") or "sourcefile"
 SEMANTIC_CONFIGURATION_NAME = os.environ.get("SEMANTIC_CONFIGURATION_NAME")
 
 AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE")
@@ -53,6 +58,19 @@ AZURE_OPENAI_GPT_4O_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_4O_DEPLOYMENT"
 
 AZURE_CLIENT_ID = os.environ.get("AZURE_CLIENT_ID")
 
+AZURE_COSMOSDB_CACHE_CONTAINER = os.environ.get("AZURE_COSMOSDB_CACHE_CONTAINER")
+QUERY_REWRITE_CACHE_SIZE = int(os.environ.get("QUERY_REWRITE_CACHE_SIZE", 1000))
+QUERY_REWRITE_CACHE_TTL = int(os.environ.get("QUERY_REWRITE_CACHE_TTL", 24 * 60 * 60))
+# true にすると履歴の無い最初の質問は検索クエリを生成せず、質問文をそのまま検索する
+QUERY_REWRITE_SKIP_FIRST_TURN = os.environ.get("QUERY_REWRITE_SKIP_FIRST_TURN", "false").lower() == "true"
+# 似た質問への回答のキャッシュ（既定では無効）
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))                  # これ以上のコサイン類似度なら同じ質問とみなす
+ANSWER_CACHE_REPLACE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_REPLACE_THRESHOLD", 0.98))  # これ以上似た質問の回答は上書きする
+INDEX_VERSION_REFRESH_INTERVAL = float(os.environ.get("INDEX_VERSION_REFRESH_INTERVAL", 60))
+
 # 現在のユーザー ID を使用して、Azure OpenAI、Cognitive Search、Blob Storage で認証します (シークレットは不要です。
 # ローカルでは 'az login' を使用し、Azure にデプロイする場合はマネージド ID を使用します)。
 # キーを使用する必要がある場合は、各サービスのキーを持つ個別の AzureKeyCredential インスタンスを使用します。
@@ -62,39 +80,100 @@ azure_credential = DefaultAzureCredential()
 
 # Used by the OpenAI SDK
 openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+# AZURE_OPENAI_ENDPOINT を指定するとそのエンドポイントを使う（負荷試験で benchmarks/fakeopenai.py に向ける場合など）
+openai.api_base = os.environ.get("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
 openai.api_version = AZURE_OPENAI_API_VERSION
+# OpenAI SDK も共有の接続プールを使う
+openai.requestssession = get_session()
 
 # キーを使用する場合は、これらの2行をコメントアウトし、代わりにOPENAI_API_KEY環境変数にAPIキーを設定します。
 openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-openai.api_key = openai_token.token
+# トークンは最初のリクエスト(またはウォームアップ)で ensure_openai_token() が取得する
+openai_token = None
+openai_token_lock = threading.Lock()
 # openai.api_key = os.environ.get("AZURE_OPENAI_KEY")
 
 # Cognitive SearchとStorageのクライアントを設定する
 search_client = SearchClient(
     endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
     index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential)
+    credential=azure_credential,
+    transport=azure_transport())
+# ASGI(asgi.py)で使う非同期クライアント。HTTPセッションは最初の呼び出し時にイベントループ上で作られる
+async_search_client = AsyncSearchClient(
+    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+    index_name=AZURE_SEARCH_INDEX,
+    credential=AsyncDefaultAzureCredential())
 blob_client = BlobServiceClient(
     account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
-    credential=azure_credential)
+    credential=azure_credential,
+    transport=azure_transport(),
+    # /content は最初の要求からチャンクごとに読む(既定では最初の要求で 32MB まで読み込む)
+    max_single_get_size=CONTENT_CHUNK_SIZE,
+    max_chunk_get_size=CONTENT_CHUNK_SIZE)
 blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+# よく引用されるページの Blob はメモリ(と CONTENT_CACHE_DIR)にキャッシュし、ETag で確認して返す
+content_cache = ContentCache(directory=CONTENT_CACHE_DIR) if CONTENT_CACHE_ENABLED else None
+content_proxy = BlobContentProxy(blob_container, cache=content_cache)
+
+# 検索クエリ生成(ステップ1)の結果のキャッシュ
+# AZURE_COSMOSDB_CACHE_CONTAINER を指定すると、そのコンテナーを介して他のインスタンスとも共有する(CosmosClient は最初の利用時に作る)
+query_cache = QueryRewriteCache(
+    max_entries=QUERY_REWRITE_CACHE_SIZE,
+    ttl=QUERY_REWRITE_CACHE_TTL,
+    backend=CosmosCacheBackend(LazyClient(lambda: database.get_container_client(AZURE_COSMOSDB_CACHE_CONTAINER))) if AZURE_COSMOSDB_CACHE_CONTAINER else None)
+
+# 回答のキャッシュ。prepdocs.py がファイルを登録し直すと、そのファイルを根拠にした回答を無効にする
+answer_cache = None
+index_versions = None
+if ANSWER_CACHE_ENABLED:
+    index_versions = IndexVersionStore(blob_container, refresh_interval=INDEX_VERSION_REFRESH_INTERVAL)
+    answer_cache = AnswerCache(
+        max_entries=ANSWER_CACHE_SIZE,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        replace_threshold=ANSWER_CACHE_REPLACE_THRESHOLD,
+        ttl=ANSWER_CACHE_TTL,
+        version_store=index_versions)
+    index_versions.on_change = answer_cache.invalidate
 
 chat_approaches = {
     "rrr": ChatReadRetrieveReadApproach(
         search_client, 
         KB_FIELDS_SOURCEPAGE, 
         KB_FIELDS_CONTENT,
-        SEMANTIC_CONFIGURATION_NAME
+        SEMANTIC_CONFIGURATION_NAME,
+        async_search_client,
+        query_cache,
+        QUERY_REWRITE_SKIP_FIRST_TURN,
+        answer_cache,
+        KB_FIELDS_SOURCEFILE
     ),
     "r": ChatReadApproach()
 }
 
-configure_azure_monitor()
+# IDトークン検証用の公開鍵ストア（start_background() 以降はバックグラウンドで更新）
+jwks_store = JwksKeyStore(session=get_session())
+
+# ウォームアップで先に接続を開いておくサービス
+PREWARM_URLS = [
+    openai.api_base,
+    f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+    f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+    os.environ.get("AZURE_COSMOSDB_ENDPOINT"),
+    OPENID_CONFIGURATION_URL
+]
 
 app = Flask(__name__)
-FlaskInstrumentor().instrument_app(app)
+
+# Azure Monitor の設定は読み込みも含めて時間がかかるので、起動を待たせずにバックグラウンドで行う。
+# Flask の計装はプロバイダーの設定が済んでから行う
+def configure_telemetry():
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        configure_azure_monitor()
+    except Exception as e:
+        print(f"Error in configure_azure_monitor: {str(e)}")
+    FlaskInstrumentor().instrument_app(app)
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
@@ -103,24 +182,8 @@ def static_file(path):
 
 def validate_token(token):
     try:
-        # 1.公開鍵の一覧を取得
-        key_url = requests.get("https://login.microsoftonline.com/common/v2.0/.well-known/openid-configuration").json()["jwks_uri"]
-        keys = requests.get(key_url).json()["keys"]
-        # 2.IDトークンの署名を検証する公開鍵を抽出
-        header = jwt.get_unverified_header(token)
-        for key in keys:
-            # kidが一致している公開鍵を抽出
-            if key["kid"] == header["kid"]:
-                public_key = jwt.algorithms.RSAAlgorithm.from_jwk(key)
-                break
-        # 3.IDトークンを検証
-        decoded_token = jwt.decode(
-            token,
-            public_key,
-            audience=AZURE_CLIENT_ID,
-            algorithms=["RS256"]
-        )
-        return decoded_token
+        # 公開鍵はjwks_storeでキャッシュし、検証済みトークンはexpまで再利用する
+        return jwks_store.validate(token, AZURE_CLIENT_ID)
     # 検証に失敗した場合
     except Exception as e:
         print(f"Token validation error: {e}")
@@ -146,38 +209,36 @@ def logout():
 
 
 
+# 運用監視用の統計情報
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "conversation_store": conversation_store.get_metrics(),
+        "chatlog_writer": chatlog_writer.get_metrics() if chatlog_writer else None,
+        "title_service": title_service.get_metrics(),
+        "http_pools": get_pool_stats(),
+        "query_rewrite_cache": query_cache.get_metrics(),
+        "answer_cache": answer_cache.get_metrics() if answer_cache else None,
+        "content_cache": content_cache.get_metrics() if content_cache else None,
+        "embeddings": embedding_service.get_metrics(),
+        "tokens": get_token_metrics(),
+        "history_summary": history_summarizer.get_metrics() if history_summarizer else None,
+        "usage": usage_totals.get_metrics()
+    })
+
 # 例を自己完結型に保つために、アプリ内から BLOB ストレージからコンテンツ ファイルを提供します。
 # *** 注意 *** これは、コンテンツ ファイルが公開されているか、少なくともアプリのすべてのユーザーが
-# すべてのファイルにアクセスできることを前提としています。これもまた遅く、メモリを大量に消費します。
+# すべてのファイルにアクセスできることを前提としています。
+# ファイルはチャンクごとにストリーミングし、Range と ETag による条件付きリクエストに対応する(core/blobcontent.py)
 @app.route("/content/<path>")
 def content_file(path):
     try:
-        path = path.strip()
-
-        blob = blob_client.get_blob_client(container=AZURE_STORAGE_CONTAINER, blob=path)
-        properties = blob.get_blob_properties()
-
-        if properties.size < 2 * 1024 * 1024: # 2MB
-            blob = blob_container.get_blob_client(path).download_blob()
-
-            mime_type = blob.properties["content_settings"]["content_type"]
-            if mime_type == "application/octet-stream":
-                mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-
-            _, ext = os.path.splitext(path)
-            ext = ext[1:].lower()
-            extensions = ["doc", "docs", "xls", "xlsx", "ppt", "pptx"]
-            if ext in extensions:
-                # ダウンロードすべき
-                mode = "attachment"
-            else:
-                # ページの一部として表示可能
-                mode = "inline"
-            
-            return blob.readall(), 200, {"Content-Type": mime_type, "Content-Disposition": f"{mode}; filename={urllib.parse.quote(path)}"}
-        else:
-            html = f"<!DOCTYPE html><html><head><title>oversize file</title></head><body><p>Subject file cannot be previewed due to the size limit, {properties.size} bytes. See [Supporting content] tab.</p></body></html>"
-            return html, 403, {"Content-Type": "text/html"}
+        status, headers, body = content_proxy.get(
+            path.strip(),
+            range_header=request.headers.get("Range"),
+            if_none_match=request.headers.get("If-None-Match"),
+            if_modified_since=request.if_modified_since)
+        return Response(body, status=status, headers=headers, direct_passthrough=True)
 
     except Exception as e:
         user_name = get_user_name(request)
@@ -227,36 +288,99 @@ def docsearch():
 
 def ensure_openai_token():
     global openai_token
-    if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-        openai.api_key = openai_token.token
+    # 期限の60秒前になったら取り直す
+    if openai_token is None or openai_token.expires_on - 60 < int(time.time()):
+        with openai_token_lock:
+            if openai_token is None or openai_token.expires_on - 60 < int(time.time()):
+                openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
+                openai.api_key = openai_token.token
+
+# 最初のリクエストまで遅らせている初期化を先に済ませる
+def warmup() -> dict:
+    timings = {}
+    for name, func in [("connections", lambda: prewarm(PREWARM_URLS)),
+                       ("openai_token", ensure_openai_token),
+                       ("encodings", preload_encodings),
+                       ("cosmos", conversation_store.container.get_client)]:
+        started = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f"Warmup failed for {name}: {str(e)}")
+        timings[name] = round((time.perf_counter() - started) * 1000)
+    return timings
+
+# App Service のウォームアップ(WEBSITE_WARMUP_PATH=/warmup)などから呼び出す
+@app.route("/warmup", methods=["GET"])
+def warmup_route():
+    return jsonify(warmup())
+
+# WARMUP_ON_START=false にすると起動時のバックグラウンドでのウォームアップを行わない
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "true").lower() != "false"
+background_started = False
+background_lock = threading.Lock()
+
+# import では何も始めず、ASGI の起動時(asgi.py の lifespan)か最初のリクエストでバックグラウンドの処理を1回だけ始める
+def start_background():
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    jwks_store.start()
+    if index_versions is not None:
+        index_versions.start()
+    threading.Thread(target=configure_telemetry, name="telemetry-init", daemon=True).start()
+    if WARMUP_ON_START:
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+@app.before_request
+def start_background_on_first_request():
+    if not background_started:
+        start_background()
 
 # get Conversation History
 @app.route("/", methods=["POST"])
 def get_conversation_history():
     user_name = request.json.get("loginUser", "anonymous")
     try:
-        # ユーザーの会話履歴をクエリ
-        conversation_data = select_user_conversations(user_name)
-        if conversation_data is None:
+        # ユーザーの会話履歴を新しい順に1ページ分クエリする。続きは continuationToken で取得する
+        page = select_user_conversations(
+            user_name,
+            page_size=int(request.json.get("pageSize") or HISTORY_PAGE_SIZE),
+            continuation_token=request.json.get("continuationToken"))
+        if page is None:
             return jsonify(None)
         else:
+            conversation_data, continuation_token = page
             conversations = []
             for conv in conversation_data:
                 # "messages" キーが存在するかどうか
                 if "conversation_id" in conv:
+                    title = conv["conversation_title"] if "conversation_title" in conv and conv["conversation_title"] is not None else "No Title"
+                    title_pending = conv.get("title_pending", False)
+                    if title_pending:
+                        # 生成済みでまだ保存されていないタイトルがあればそれを返す
+                        ready_title = title_service.get_title(conv["conversation_id"])
+                        if ready_title:
+                            title = ready_title
+                            title_pending = False
                     conversation = {
                         "conversation_id": conv["conversation_id"],
                         "approach":conv["approach"],
-                        "title": conv["conversation_title"] if "conversation_title" in conv and conv["conversation_title"] is not None else "No Title",
+                        "title": title,
+                        "title_pending": title_pending,
                         "timestamp": conv["timestamp"]
                     }
                     conversations.append(conversation)
             response_data = {
                 "user_id": user_name,
-                "conversations": conversations
+                "conversations": conversations,
+                "continuation_token": continuation_token
             }
             return jsonify(response_data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error in get_conversation_history: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -270,7 +394,7 @@ def get_conversation_content():
     try:
         # ユーザーの会話内容をクエリ
         content_data = select_conversation_content(conversation_id, approach)
-        if content_data is None:
+        if not content_data:
             return jsonify(None)
         # "messages" キーが存在するかどうか
         if "messages" in content_data[0]:
@@ -293,26 +417,6 @@ def get_conversation_content():
         print(f"Error in get_conversation_content: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-def creat_title(input):
-    system_prompt_for_title = """Your assistant will come up with a title for your question.
-                Answer in the customer's language.
-                Titles should be easy to understand and no more than 20 characters.
-                Please use the words you have used as much as possible.
-                Don't end your sentences with a "?"."""
-    prompt = input
-    message_builder_for_title = MessageBuilder(system_prompt_for_title)
-    messages_for_title = message_builder_for_title.get_messages_from_history(
-        [], 
-        prompt
-        )
-    conversation_title = openai.ChatCompletion.create(
-        engine=AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT, 
-        messages=messages_for_title,
-        temperature=0.5, 
-        n=1)
-    title = conversation_title.choices[0]["message"]["content"]
-    return title
-
 # delete Conversation Content
 @app.route("/delete", methods=["POST"])
 def delete_conversation():
@@ -1,6 +1,8 @@
 # TODO:CosmosDB化
 import os
 import json
+import uuid
+import atexit
 import jwt
 import logging
 import traceback
@@ -9,8 +11,11 @@ from opencensus.ext.azure.log_exporter import AzureLogHandler
 
 from enum import Enum
 from azure.cosmos import CosmosClient
-from azure.cosmos.exceptions import CosmosResourceNotFoundError
-from azure.identity import DefaultAzureCredential
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError
+from approaches.conversationstore import ConversationStore, WRITE_MODE_PATCH
+from approaches.chatlogwriter import ChatLogWriter
+from core.titleservice import TitleService
+from core.clients import azure_transport, LazyClient
 
 from dotenv import load_dotenv
 # .envファイルの内容を読み込見込む
@@ -24,11 +29,47 @@ database_name = os.environ.get("AZURE_COSMOSDB_DATABASE")
 container_name = os.environ.get("AZURE_COSMOSDB_CONTAINER")
 account_key = os.environ.get("AZURE_COSMOS_ACCOUNT_KEY")
 # CosmosDB Initialization
-credential = DefaultAzureCredential()
-database = CosmosClient(endpoint, account_key).get_database_client(database_name)
-container = database.get_container_client(container_name)
+# CosmosClient は作成時にアカウント情報を取得するので、最初に使うときに作る
+database = LazyClient(lambda: CosmosClient(endpoint, account_key, transport=azure_transport()).get_database_client(database_name))
+container = LazyClient(lambda: database.get_container_client(container_name))
+# 会話ドキュメントは conversation_id をID・パーティションキーとしてポイント操作で扱う
+# 旧形式の検索は、既定(auto)では migrate_all の完了が記録されるまで行う。true / false で常に行う・行わないを指定できる
+LEGACY_LOOKUP = os.environ.get("AZURE_COSMOSDB_LEGACY_LOOKUP", "auto").lower()
+conversation_store = ConversationStore(
+    container,
+    legacy_lookup=None if LEGACY_LOOKUP == "auto" else LEGACY_LOOKUP != "false",
+    # 追記方法: patch(既定) / turns(ターンを別ドキュメントに保存) / document(全体をETag付きで置換)
+    write_mode=os.environ.get("AZURE_COSMOSDB_WRITE_MODE") or WRITE_MODE_PATCH)
 
 A3B_FAQ_BOT_NAME = os.environ.get("A3B_FAQ_BOT_NAME")
+# 会話履歴の一覧(サイドバー)で1回に返す件数と、リクエストで指定できる上限
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 200))
+
+# 生成したタイトルを会話ドキュメントに保存する
+def save_title(conversationId: str, title: str, usage: dict = None) -> bool:
+    # 会話ドキュメントの作成がまだキューに残っている場合は False を返し、TitleService に後で再試行させる
+    try:
+        conversation_store.set_title(conversationId, title, usage)
+    except CosmosResourceNotFoundError:
+        return False
+    return True
+
+# 会話タイトルの生成（複数の会話をまとめて1回のリクエストで生成する）
+title_service = TitleService(
+    os.environ.get("AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT"),
+    on_title=lambda conversationId, title, usage: save_title(conversationId, title, usage))
+
+# チャットログの書き込みワーカー（CHATLOG_ASYNC=false または CHATLOG_WORKERS=0 で同期書き込みに戻す）
+CHATLOG_WORKERS = int(os.environ.get("CHATLOG_WORKERS", 2))
+chatlog_writer = None
+if os.environ.get("CHATLOG_ASYNC", "true").lower() != "false" and CHATLOG_WORKERS > 0:
+    chatlog_writer = ChatLogWriter(
+        lambda conversationId, entries: write_chatlog_entries(conversationId, entries),
+        workers=CHATLOG_WORKERS,
+        queue_size=int(os.environ.get("CHATLOG_QUEUE_SIZE", 1000)))
+    # 終了時にキューに残ったログを書き込む
+    atexit.register(chatlog_writer.close)
 
 logger = logging.getLogger(__name__)
 logger.addHandler(AzureLogHandler(connection_string=os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING")))
@@ -55,92 +96,94 @@ def get_user_name(req: request):
 
     return user_name
 
-# 特定のconversation_idを持つドキュメントを取得する
+# 特定のconversation_idを持つドキュメントを取得する（ポイント読み取り）
 def get_conversation(conversation_id):
     try:
-        query = "SELECT * FROM c WHERE c.conversation_id = @conversation_id"
-        parameters = [{"name": "@conversation_id", "value": conversation_id}]
-        items = list(container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
-        if items:
-            return items[0]  # 最初の1件を返す
-        else:
-            return None
+        return conversation_store.get_transcript(conversation_id)
     except Exception as e:  
         print(f"Error in get_conversation: {str(e)}")  
         return None  
 
-def write_chatlog(approach: ApproachType, user_name: str, total_tokens: int, input: str, response: str, conversationId: str, timestamp: str, conversation_title: str, query: str=""):
-    # 既存の会話データを取得
-    conversation = get_conversation(conversationId)
-    # 既存の会話があればmessagesに追加
-    if conversation:
-        # 新しいメッセージを作成
-        new_message = [
+# usage はステージ(rewrite / answer)ごとのトークン使用量
+def write_chatlog(approach: ApproachType, user_name: str, total_tokens: int, input: str, response: str, conversationId: str, timestamp: str, conversation_title: str, query: str="", usage: dict=None):
+    entry = {
+        # 再試行しても同じログを2回追記しないように、ログごとのIDを付ける
+        "entry_id": uuid.uuid4().hex,
+        "approach": approach,
+        "user_name": user_name,
+        "total_tokens": total_tokens,
+        "usage": usage or {},
+        "input": input,
+        "response": response,
+        "timestamp": timestamp,
+        "conversation_title": conversation_title,
+        "query": query
+    }
+    # 書き込みはバックグラウンドで行い、応答のストリームを待たせない
+    if chatlog_writer is not None:
+        chatlog_writer.submit(conversationId, entry)
+    else:
+        try:
+            write_chatlog_entries(conversationId, [entry])
+        except Exception as e:
+            print(f"Error in write_chatlog: {str(e)}")
+
+# 同じ会話のログをまとめて書き込む（失敗時は例外を送出し、ライターが再試行する）
+def write_chatlog_entries(conversationId: str, entries: list[dict]):
+    # 新しいメッセージをログごとに作成
+    turns = []
+    for entry in entries:
+        turns.append((entry.get("entry_id"), [
             {
                 "role" : "user",
-                "content" : input
+                "content" : entry["input"]
             }, 
             {
                 "role" : "assistant",
-                "content" : response
+                "content" : entry["response"],
+                "usage" : entry.get("usage", {})
             }
-        ]
-        
-        # 既存のmessagesリストに新しいメッセージを追加
-        if "messages" in conversation:  
-            conversation["messages"].extend(new_message)  
-        else:  
-            print("No 'messages' field found in the conversation document.")  
-            return  
-          
-        # データベースにドキュメントを更新  
-        try:  
-            container.upsert_item(conversation)  
-        except Exception as e:  
-            print(f"Error in upsert_item: {str(e)}")  
-        
-        # データベースにドキュメントを更新
-        container.upsert_item(conversation)
+        ]))
+    new_message = [message for _, messages in turns for message in messages]
+
+    # 既存の会話があればメッセージだけを追記する（patch/turns では会話全体を読み書きしない）
+    # 追記済みの entry_id は飛ばされるので、途中で失敗して全体を再試行しても重複しない
+    if conversation_store.append_messages(conversationId, turns[0][1], turns[0][0]):
+        for entry_id, messages in turns[1:]:
+            conversation_store.append_messages(conversationId, messages, entry_id)
+        return
+
     # 初めての会話なら全体を保存
-    else:
-        from app import creat_title
-        title = ""
-        if conversation_title is None :
-            title = creat_title(input)
-        else:
-            title = conversation_title
-
-        properties = {
-            "approach" : approach.value,
-            "user" : user_name, 
-            "tokens" : total_tokens,
-            "conversation_id" : conversationId,
-            "timestamp" : timestamp,
-            "conversation_title": title,
-            "bot_name": A3B_FAQ_BOT_NAME,
-            "messages" : [
-                {
-                    "role" : "user",
-                    "content" : input
-                },
-                {
-                    "role" : "assistant",
-                    "content" : response
-                }
-            ]
-        }
-
-        if query != "":
-            properties["query"] = query
-        try:  
-            container.create_item(body=properties, enable_automatic_id_generation=True)  
-        except Exception as e:  
-            print(f"Error in create_item: {str(e)}")  
-    
+    first = entries[0]
+    title = first["conversation_title"] or title_service.get_title(conversationId)
+    title_pending = False
+    if title is None :
+        # 仮タイトルで保存し、本来のタイトルはバックグラウンドで生成して後から更新する
+        title = title_service.request(conversationId, first["input"])
+        title_pending = True
+
+    properties = {
+        "approach" : first["approach"].value,
+        "user" : first["user_name"], 
+        "tokens" : first["total_tokens"],
+        "usage" : dict(first.get("usage", {})),
+        "conversation_id" : conversationId,
+        "timestamp" : first["timestamp"],
+        "conversation_title": title,
+        "title_pending": title_pending,
+        "bot_name": A3B_FAQ_BOT_NAME,
+        "messages" : new_message,
+        "entry_ids": [entry_id for entry_id, _ in turns if entry_id]
+    }
+
+    if first["query"] != "":
+        properties["query"] = first["query"]
+    try:  
+        conversation_store.create(conversationId, properties)  
+    except CosmosResourceExistsError:
+        # 同じ会話の最初のターンが同時に書き込まれた場合(または作成後に失敗して再試行した場合)は追記に切り替える
+        for entry_id, messages in turns:
+            conversation_store.append_messages(conversationId, messages, entry_id)
 
 def write_error(category: str, user_name: str, error: str):
     properties = {
@@ -154,74 +197,55 @@ def write_error(category: str, user_name: str, error: str):
     traceback.print_exc()
     logger.error(log_data)
 
-def select_user_conversations(user_name: str):
+# ユーザーの会話の概要を新しい順に1ページ分取得し、(会話のリスト, 次のページの継続トークン) を返す。最後のページなら継続トークンは None
+# 継続トークンが不正な場合は ValueError を送出する
+def select_user_conversations(user_name: str, page_size: int = HISTORY_PAGE_SIZE, continuation_token: str = None):
     try: 
-        query = """
-            SELECT c.approach, c.user, c.tokens, c.conversation_id, c.timestamp, c.conversation_title
-            FROM c
-            WHERE c.user = @user
-            AND c.bot_name = @bot_name
-        """
-        parameters = [
-            {
-                "name": "@user", "value": user_name
-            }, {
-                "name": "@bot_name", "value": A3B_FAQ_BOT_NAME
-            }
-        ]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
-        return items
+        page_size = max(1, min(page_size, HISTORY_MAX_PAGE_SIZE))
+        return conversation_store.list_conversations(user_name, A3B_FAQ_BOT_NAME, page_size, continuation_token)
+    except ValueError:
+        raise
     except Exception as e:  
         print(f"Error in select_user_conversations: {str(e)}")
         return None
     
 def select_conversation_content(conversation_id: str, approach: str):
     try: 
-        query = """
-            SELECT c.approach, c.user, c.tokens, c.conversation_id, c.messages
-            FROM c
-            WHERE c.conversation_id = @conversation_id
-            AND c.approach = @approach
-            AND c.bot_name = @bot_name
-        """
-        parameters = [
-            {
-                "name": "@conversation_id", "value": conversation_id
-            }, {
-                "name": "@approach", "value": approach
-            }, {
-                "name": "@bot_name", "value": A3B_FAQ_BOT_NAME
-            }
-        ]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
-        return items
+        item = conversation_store.get_transcript(conversation_id)
+        if item is None or item.get("approach") != approach or item.get("bot_name") != A3B_FAQ_BOT_NAME:
+            return []
+        return [{
+            "approach": item["approach"],
+            "user": item.get("user"),
+            "tokens": item.get("tokens"),
+            "conversation_id": item["conversation_id"],
+            "messages": item.get("messages", [])
+        }]
     except Exception as e:  
         print(f"Error in select_conversation_content: {str(e)}")
         return None
     
 def delete_conversation_content(conversation_id: str):
     try: 
-        query = """
-            SELECT *
-            FROM c
-            WHERE c.conversation_id = @conversation_id
-            AND c.bot_name = @bot_name
-        """
-        parameters = [
-            {
-                "name": "@conversation_id", "value": conversation_id
-            }, {
-                "name": "@bot_name", "value": A3B_FAQ_BOT_NAME
-            }
-        ]
-        items = list(container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True))
-        if not items:
+        if not conversation_store.delete(conversation_id):
             print(f"No items found for conversation_id: {conversation_id}")
             return False
-        for item in items:
-            container.delete_item(item['id'], partition_key=item['id'])
         return True
     except Exception as e:  
         print(f"Error in delete_conversation_content: {str(e)}")
         return False
-    
+
+if __name__ == "__main__":
+    import sys
+    if "--history-index" in sys.argv:
+        # 会話履歴の一覧用の複合インデックス (user, bot_name, timestamp) をコンテナーに追加する
+        # 実行方法: cd src/backend && python -m approaches.chatlogging --history-index
+        if conversation_store.ensure_history_index(database):
+            print("Added the composite index for conversation history (it is built in the background)")
+        else:
+            print("The composite index for conversation history already exists")
+    else:
+        # 自動生成IDで保存された既存の会話ドキュメントを新しいID形式に移行する
+        # 実行方法: cd src/backend && python -m approaches.chatlogging
+        print(f"Migrated {conversation_store.migrate_all()} conversations")
+    print(conversation_store.get_metrics())
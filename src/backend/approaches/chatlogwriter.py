@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+import queue
+import threading
+
+_STOP = object()
+
+class ChatLogWriter:
+    """
+      チャットログをバックグラウンドで書き込むライター。
+      ストリーミング応答の最後で Cosmos DB への書き込みやタイトル生成を待たないように、
+      ログはサイズ上限付きのキューに積んでワーカースレッドで書き込む。
+      同じ会話のログは常に同じワーカーに振り分けるので順序が保たれ、
+      キューに溜まった同じ会話のログはまとめて1回で書き込む。
+      キューが一杯の場合はログを捨てて dropped として数える。
+      Methods:
+          submit(self, key: str, entry: dict): ログをキューに積む。
+          close(self, timeout: float): キューに残ったログを書き込んでワーカーを止める。
+          get_metrics(self): キューの深さや書き込み・破棄の件数を返す。
+      """
+
+    def __init__(self, write_batch, workers: int = 2, queue_size: int = 1000, max_batch: int = 50,
+                 max_retries: int = 3, backoff: float = 0.5):
+        # write_batch(key, entries) は同じキー(会話)のログをまとめて書き込む関数
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1: {workers}")
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._metrics = {"submitted": 0, "written": 0, "batches": 0, "coalesced": 0, "retries": 0, "failed": 0, "dropped": 0}
+        self._metrics_lock = threading.Lock()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"chatlog-writer-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _count(self, name: str, value: int = 1):
+        with self._metrics_lock:
+            self._metrics[name] += value
+
+    def submit(self, key: str, entry: dict) -> bool:
+        if self._closed:
+            self._count("dropped")
+            return False
+        q = self._queues[hash(key) % len(self._queues)]
+        try:
+            q.put_nowait((key, entry))
+        except queue.Full:
+            self._count("dropped")
+            print(f"Chat log queue is full, dropped log for conversation: {key}")
+            return False
+        self._count("submitted")
+        return True
+
+    def _run(self, q: queue.Queue):
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            # 溜まっているログをまとめて取り出す
+            while len(batch) < self.max_batch:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            # 会話ごとにまとめる（dict は挿入順を保つので会話内の順序も保たれる）
+            groups = {}
+            for key, entry in batch:
+                groups.setdefault(key, []).append(entry)
+            for key, entries in groups.items():
+                self._write(key, entries)
+
+    def _write(self, key: str, entries: list):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write_batch(key, entries)
+                self._count("written", len(entries))
+                self._count("batches")
+                self._count("coalesced", len(entries) - 1)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self._count("failed", len(entries))
+                    print(f"Error in chat log writer: {str(e)}")
+                    return
+                self._count("retries")
+                time.sleep(self.backoff * (2 ** attempt))
+
+    def close(self, timeout: float = 10.0):
+        if self._closed:
+            return
+        self._closed = True
+        deadline = time.time() + timeout
+        for q in self._queues:
+            try:
+                q.put(_STOP, timeout=max(0.0, deadline - time.time()))
+            except queue.Full:
+                pass
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.time()))
+
+    def get_metrics(self) -> dict:
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics["queue_depth"] = sum(q.qsize() for q in self._queues)
+        metrics["queue_capacity"] = sum(q.maxsize for q in self._queues)
+        return metrics
@@ -1,5 +1,6 @@
-from typing import Any
+from typing import Any, AsyncGenerator
 
+import asyncio
 import openai
 import openai.error
 # To uncomment when enabling asynchronous support.
@@ -7,8 +8,9 @@ import openai.error
 from approaches.approach import Approach
 from approaches.chatlogging import write_chatlog, write_error, ApproachType
 from core.messagebuilder import MessageBuilder
+from core.historysummary import history_summarizer
 from core.modelhelper import get_gpt_model, get_max_token_from_messages
-import tiktoken
+from core.usage import UsageTracker, stream_options
 # OpenAI APIを直接使用するシンプルな読み取り実装。OpenAIを使用して補完を生成します
 # (answer) with that prompt.
 class ChatReadApproach(Approach):
@@ -16,23 +18,32 @@ class ChatReadApproach(Approach):
     If you are asked to write a report, daily report do not reply and tell them you cannot do so.
     For tabular information, return it as Markdown, not HTML. 
 """
-    def run(self, user_name: str, history: list[dict[str, str]], overrides: dict[str, Any], conversationId: str, timestamp: str, title: str) -> Any:
-        try:
-            chat_model = overrides.get("gptModel")
-            chat_gpt_model = get_gpt_model(chat_model)
-            chat_deployment = chat_gpt_model.get("deployment")
+    def build_messages(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> tuple:
+        chat_model = overrides.get("gptModel")
+        chat_gpt_model = get_gpt_model(chat_model)
+        chat_deployment = chat_gpt_model.get("deployment")
 
-            systemPrompt =  overrides.get("systemPrompt")
-            concatenatedSystemPrompt = self.system_message_chat_conversation + systemPrompt
-            temaperature = float(overrides.get("temperature"))
+        systemPrompt =  overrides.get("systemPrompt")
+        concatenatedSystemPrompt = self.system_message_chat_conversation + systemPrompt
 
-            user_q = history[-1]["user"]
-            message_builder = MessageBuilder(concatenatedSystemPrompt)
-            messages = message_builder.get_messages_from_history(
-                history, 
-                user_q
-                )
+        user_q = history[-1]["user"]
+        message_builder = MessageBuilder(concatenatedSystemPrompt, chat_model, history_summarizer)
+        messages = message_builder.get_messages_from_history(
+            history, 
+            user_q
+            )
+        return chat_model, chat_deployment, messages
 
+    def log_response(self, user_name: str, history: list[dict[str, str]], usage: UsageTracker, response_text: str, conversationId: str, timestamp: str, title: str):
+        # トークン数は API が返した使用量（返さない場合はチャンクごとに数えた推定値）
+        # logging
+        input_text = history[-1]["user"]
+        write_chatlog(ApproachType.Chat, user_name, usage.total_tokens(), input_text, response_text, conversationId, timestamp, title, usage=usage.to_dict())
+
+    def run(self, user_name: str, history: list[dict[str, str]], overrides: dict[str, Any], conversationId: str, timestamp: str, title: str) -> Any:
+        try:
+            chat_model, chat_deployment, messages = self.build_messages(history, overrides)
+            temaperature = float(overrides.get("temperature"))
             max_tokens = get_max_token_from_messages(messages, chat_model)
 
             chat_completion = openai.ChatCompletion.create(
@@ -41,25 +52,19 @@ class ChatReadApproach(Approach):
                 temperature=temaperature, 
                 max_tokens=max_tokens,
                 n=1,
-                stream=True
+                stream=True,
+                **stream_options()
             )
             # 返答を受け取り、逐次yield
-            response_text = ""
+            usage = UsageTracker(chat_model)
+            answer = usage.stream("answer", messages)
             for chunk in chat_completion:
-                if chunk:
-                    content = chunk['choices'][0]['delta'].get('content')
-                    if content:
-                        response_text += content
-                        yield content
+                content = answer.add(chunk)
+                if content:
+                    yield content
+            answer.finish()
 
-            # トークン数を推定（レスポンスの文字数から算出しているだけあまり意味はない）
-            # 新しいバージョンのopenaiならストリームでも最後にトークン数を出してくれるみたい
-            encoding_name = tiktoken.encoding_for_model(chat_model).name
-            encoding = tiktoken.get_encoding(encoding_name)
-            total_tokens = len(encoding.encode(response_text))
-            # logging
-            input_text = history[-1]["user"]
-            write_chatlog(ApproachType.Chat, user_name, total_tokens, input_text, response_text, conversationId, timestamp, title)
+            self.log_response(user_name, history, usage, answer.text(), conversationId, timestamp, title)
 
             yield "\n[END OF RESPONSE]"
         except openai.error.InvalidRequestError as e:
@@ -70,3 +75,38 @@ class ChatReadApproach(Approach):
             # その他のエラーもキャッチ
             write_error("chat", user_name, str(e))
             yield "\n[ERROR]"
+
+    # ASGI(asgi.py)から使う非同期版。ストリーミング中にワーカースレッドを占有しない
+    async def run_async(self, user_name: str, history: list[dict[str, str]], overrides: dict[str, Any], conversationId: str, timestamp: str, title: str) -> AsyncGenerator[str, None]:
+        try:
+            chat_model, chat_deployment, messages = self.build_messages(history, overrides)
+            temaperature = float(overrides.get("temperature"))
+            max_tokens = get_max_token_from_messages(messages, chat_model)
+
+            chat_completion = await openai.ChatCompletion.acreate(
+                engine=chat_deployment, 
+                messages=messages,
+                temperature=temaperature, 
+                max_tokens=max_tokens,
+                n=1,
+                stream=True,
+                **stream_options()
+            )
+            usage = UsageTracker(chat_model)
+            answer = usage.stream("answer", messages)
+            async for chunk in chat_completion:
+                content = answer.add(chunk)
+                if content:
+                    yield content
+            answer.finish()
+
+            # CHATLOG_ASYNC=false のときは Cosmos DB に同期で書き込むので、イベントループを止めないようにスレッドで実行する
+            await asyncio.to_thread(self.log_response, user_name, history, usage, answer.text(), conversationId, timestamp, title)
+
+            yield "\n[END OF RESPONSE]"
+        except openai.error.InvalidRequestError as e:
+            write_error("chat", user_name, f"InvalidRequestError: {e}")
+            yield "\n[InvalidRequestError]"
+        except Exception as e:
+            write_error("chat", user_name, str(e))
+            yield "\n[ERROR]"
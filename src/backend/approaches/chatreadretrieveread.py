@@ -2,15 +2,45 @@ from text import nonewlines
 
 import openai
 import openai.error
-from approaches.getcontent import generate_embeddings
+from typing import AsyncGenerator
+from approaches.getcontent import generate_embeddings, generate_embeddings_async
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.models import QueryType
 from approaches.approach import Approach
 from approaches.chatlogging import write_chatlog, write_error, ApproachType
 from core.messagebuilder import MessageBuilder
+from core.historysummary import history_summarizer
 from core.modelhelper import get_gpt_model, get_max_token_from_messages
-import tiktoken
+from core.usage import UsageTracker, stream_options
+from core.querycache import QueryRewriteCache
+from core.answercache import AnswerCache
 import json
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# 検索前の処理(クエリ生成とベクトル算出)を並行して実行するためのスレッドプール
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("RETRIEVAL_WORKERS", 16)), thread_name_prefix="retrieval")
+
+# キャッシュした回答をストリームとして返すときの1チャンクの文字数
+ANSWER_REPLAY_CHUNK_SIZE = 20
+
+# 処理にかかった時間(ms)を timings に記録する
+def timed(timings: dict, stage: str, func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[stage] = (time.perf_counter() - started) * 1000
+
+async def timed_async(timings: dict, stage: str, coroutine):
+    started = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        timings[stage] = (time.perf_counter() - started) * 1000
 
 # Cognitive Search と OpenAI API を直接使用する、取得してから読み取るシンプルな実装。
 # まず検索から上位のドキュメントを取得し、それらを使用してプロンプトを作成し、
@@ -51,28 +81,56 @@ source quesion: {user_question}
         {'role' : ASSISTANT, 'content' : 'Health plan cardio coverage' }
     ]
 
-    def __init__(self, search_client: SearchClient, sourcepage_field: str, content_field: str, semantic_conf_name: str):
+    def __init__(self, search_client: SearchClient, sourcepage_field: str, content_field: str, semantic_conf_name: str, async_search_client: AsyncSearchClient = None,
+                 query_cache: QueryRewriteCache = None, skip_rewrite_first_turn: bool = False, answer_cache: AnswerCache = None, sourcefile_field: str = "sourcefile"):
         self.search_client = search_client
+        self.query_cache = query_cache
+        self.answer_cache = answer_cache
+        self.sourcefile_field = sourcefile_field
+        self.skip_rewrite_first_turn = skip_rewrite_first_turn
+        self.async_search_client = async_search_client
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.semantic_conf_name = semantic_conf_name
-    
-    def run(self, user_name: str, history: list[dict], overrides: dict, conversationId: str, timestamp: str, title: str) -> any:
-        try:
-            chat_model = overrides.get("gptModel")
-            chat_gpt_model = get_gpt_model(chat_model)
-            chat_deployment = chat_gpt_model.get("deployment")
 
-            # ステップ 1: チャット履歴と最後の質問に基づいて、最適化されたキーワード検索クエリを生成します
-            user_q = 'Generate search query for: ' + history[-1]["user"]
-            query_prompt = self.query_prompt_template.format(user_question=history[-1]["user"])
-            message_builder = MessageBuilder(query_prompt)
-            messages = message_builder.get_messages_from_history(
-                history,
-                user_q,
-                self.query_prompt_few_shots
-                )
+    # ステップ 1: チャット履歴と最後の質問に基づいて、最適化されたキーワード検索クエリを生成するためのメッセージ
+    def build_query_messages(self, history: list[dict], chat_model: str) -> list:
+        user_q = 'Generate search query for: ' + history[-1]["user"]
+        query_prompt = self.query_prompt_template.format(user_question=history[-1]["user"])
+        message_builder = MessageBuilder(query_prompt, chat_model)
+        return message_builder.get_messages_from_history(
+            history,
+            user_q,
+            self.query_prompt_few_shots
+            )
+
+    # 生成済みの検索クエリがあれば返す。履歴の無い最初の質問は設定によりクエリ生成を省略して質問文をそのまま使う
+    def lookup_query(self, history: list[dict], chat_model: str) -> tuple:
+        if self.skip_rewrite_first_turn and len(history) == 1:
+            if self.query_cache:
+                self.query_cache.count("skipped")
+            return history[-1]["user"], None
+        if not self.query_cache:
+            return None, None
+        key = self.query_cache.make_key(history, chat_model)
+        return self.query_cache.get(key), key
+
+    def store_query(self, key: str, query_text: str):
+        if self.query_cache and key:
+            self.query_cache.set(key, query_text)
+
+    def get_query_text(self, chat_completion, history: list[dict]) -> str:
+        # クエリ取り出し
+        query_text = chat_completion.choices[0].message.content
+        if query_text.strip() == "0":
+            query_text = history[-1]["user"] # より良いクエリを生成できなかった場合は、最後のユーザー入力を使用します
+        return query_text
 
+    # ステップ 1 の実行（キャッシュに無ければクエリを生成する）
+    def rewrite_query(self, history: list[dict], chat_model: str, chat_deployment: str, usage: UsageTracker = None) -> str:
+        query_text, cache_key = self.lookup_query(history, chat_model)
+        if query_text is None:
+            messages = self.build_query_messages(history, chat_model)
             max_tokens =  get_max_token_from_messages(messages, chat_model)
 
             # クエリ生成
@@ -82,51 +140,191 @@ source quesion: {user_question}
                 temperature=0.0,
                 max_tokens=max_tokens,
                 n=1)
-            # クエリ取り出し
-            query_text = chat_completion.choices[0].message.content
-            if query_text.strip() == "0":
-                query_text = history[-1]["user"] # より良いクエリを生成できなかった場合は、最後のユーザー入力を使用します
+            if usage:
+                usage.record_completion("rewrite", chat_completion, messages)
+            query_text = self.get_query_text(chat_completion, history)
+            self.store_query(cache_key, query_text)
+        return query_text
 
-            total_tokens = chat_completion.usage.total_tokens
+    # キャッシュの共有先(Cosmos DB)は同期クライアントなので、読み書きはスレッドで実行する
+    async def rewrite_query_async(self, history: list[dict], chat_model: str, chat_deployment: str, usage: UsageTracker = None) -> str:
+        query_text, cache_key = await asyncio.to_thread(self.lookup_query, history, chat_model)
+        if query_text is None:
+            messages = self.build_query_messages(history, chat_model)
+            max_tokens =  get_max_token_from_messages(messages, chat_model)
+
+            chat_completion = await openai.ChatCompletion.acreate(
+                engine=chat_deployment, 
+                messages=messages,
+                temperature=0.0,
+                max_tokens=max_tokens,
+                n=1)
+            if usage:
+                usage.record_completion("rewrite", chat_completion, messages)
+            query_text = self.get_query_text(chat_completion, history)
+            await asyncio.to_thread(self.store_query, cache_key, query_text)
+        return query_text
 
-            # 質問文のベクトルを算出
-            query_vector = generate_embeddings(history[-1]["user"]) # ベクトルクエリ
+    # 検索(ステップ 2)はクエリ生成(ステップ 1)と質問文のベクトルの両方に依存するが、
+    # ベクトルは生の質問文だけから求まるのでクエリ生成と同時に実行する。
+    # ベクトルはセマンティック検索のときだけ使うので、それ以外では算出しない。
+    # 回答キャッシュを引くときに求めたクエリとベクトルがあれば(query_text / question_vector)、それをそのまま使う。
+    def retrieve(self, history: list[dict], overrides: dict, chat_model: str, chat_deployment: str, timings: dict, usage: UsageTracker,
+                 query_text: str = None, question_vector: list = None) -> tuple:
+        started = time.perf_counter()
+        embedding = None
+        if overrides.get("semanticRanker") and question_vector is None:
+            embedding = retrieval_executor.submit(timed, timings, "embedding", generate_embeddings, history[-1]["user"])
+        if query_text is None:
+            query_text = timed(timings, "rewrite", self.rewrite_query, history, chat_model, chat_deployment, usage)
+        query_vector = None
+        if overrides.get("semanticRanker"):
+            query_vector = embedding.result() if embedding else question_vector
 
-            # ステップ 2: GPT 最適化クエリを使用して検索インデックスから関連ドキュメントを取得する
-            use_semantic_captions = True if overrides.get("semanticCaptions") else False
-            top = overrides.get("top")
-            exclude_category = overrides.get("excludeCategory") or None
-            #インデックスで設定したtitleフィールドの中で除外するものを選ぶ（本来ならドキュメントをカテゴリごとに仕分けしてそれを指定するようにする）
-            #neは演算子<>の意味でオペランドが等しくない場合に真、またeqは＝でオペランドが等しい場合に真という意味かも知れない
-            filter = "title ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-            semantic_ranker = overrides.get("semanticRanker")
-
-            if semantic_ranker:
-                r = self.search_client.search(query_text,
-                                            filter=filter,
-                                            query_type=QueryType.SEMANTIC,
-                                            query_language="en-us",
-                                            query_speller="lexicon",
-                                            semantic_configuration_name=self.semantic_conf_name,
-                                            query_answer='extractive',
-                                            top=top,
-                                            query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                            vector=query_vector,
-                                            top_k=5,      #上から5つのデータ
-                                            vector_fields=self.content_field
-                                            )
-            else:
-                r = self.search_client.search(query_text,
-                                            filter=filter,
-                                            top=top
-                                            )
-                
+        def search():
+            r = self.search_client.search(**self.build_search_args(overrides, query_text, query_vector))
             # 検索結果をtopの件数取得してresultsに入れる
-            if use_semantic_captions:
-                #@search.captions.textにクエリのコンテキストに応じた要約が入っている
-                results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            docs = list(r)
+            return [self.format_result(doc, overrides) for doc in docs], self.get_sourcefiles(docs)
+        results, sourcefiles = timed(timings, "search", search)
+        timings["retrieval"] = (time.perf_counter() - started) * 1000
+        return query_text, results, sourcefiles
+
+    async def retrieve_async(self, history: list[dict], overrides: dict, chat_model: str, chat_deployment: str, timings: dict, usage: UsageTracker,
+                             query_text: str = None, question_vector: list = None) -> tuple:
+        started = time.perf_counter()
+        rewrite = None
+        if query_text is None:
+            rewrite = timed_async(timings, "rewrite", self.rewrite_query_async(history, chat_model, chat_deployment, usage))
+        if overrides.get("semanticRanker") and question_vector is None:
+            embedding = timed_async(timings, "embedding", generate_embeddings_async(history[-1]["user"]))
+            if rewrite:
+                query_text, question_vector = await asyncio.gather(rewrite, embedding)
             else:
-                results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+                question_vector = await embedding
+        elif rewrite:
+            query_text = await rewrite
+        query_vector = question_vector if overrides.get("semanticRanker") else None
+
+        async def search():
+            r = await self.async_search_client.search(**self.build_search_args(overrides, query_text, query_vector))
+            docs = [doc async for doc in r]
+            return [self.format_result(doc, overrides) for doc in docs], self.get_sourcefiles(docs)
+        results, sourcefiles = await timed_async(timings, "search", search())
+        timings["retrieval"] = (time.perf_counter() - started) * 1000
+        return query_text, results, sourcefiles
+
+    # ステップ 2: GPT 最適化クエリを使用して検索インデックスから関連ドキュメントを取得するための検索条件
+    def build_search_args(self, overrides: dict, query_text: str, query_vector: list) -> dict:
+        use_semantic_captions = True if overrides.get("semanticCaptions") else False
+        top = overrides.get("top")
+        exclude_category = overrides.get("excludeCategory") or None
+        #インデックスで設定したtitleフィールドの中で除外するものを選ぶ（本来ならドキュメントをカテゴリごとに仕分けしてそれを指定するようにする）
+        #neは演算子<>の意味でオペランドが等しくない場合に真、またeqは＝でオペランドが等しい場合に真という意味かも知れない
+        filter = "title ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+        semantic_ranker = overrides.get("semanticRanker")
+
+        if semantic_ranker:
+            return dict(search_text=query_text,
+                        filter=filter,
+                        query_type=QueryType.SEMANTIC,
+                        query_language="en-us",
+                        query_speller="lexicon",
+                        semantic_configuration_name=self.semantic_conf_name,
+                        query_answer='extractive',
+                        top=top,
+                        query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                        vector=query_vector,
+                        top_k=5,      #上から5つのデータ
+                        vector_fields=self.content_field
+                        )
+        return dict(search_text=query_text,
+                    filter=filter,
+                    top=top
+                    )
+
+    def format_result(self, doc: dict, overrides: dict) -> str:
+        if overrides.get("semanticCaptions"):
+            #@search.captions.textにクエリのコンテキストに応じた要約が入っている
+            return doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']]))
+        return doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+
+    # 回答の根拠になったファイル。インデックスに sourcefile が無い場合は sourcepage で代用する
+    def get_sourcefiles(self, docs: list[dict]) -> list[str]:
+        return sorted({doc.get(self.sourcefile_field) or doc.get(self.sourcepage_field) for doc in docs} - {None})
+
+    # 回答キャッシュの対象と範囲。履歴に依存する2問目以降の質問はキャッシュしない
+    def answer_cache_scope(self, history: list[dict], overrides: dict, chat_model: str) -> str:
+        if not self.answer_cache or len(history) != 1:
+            return None
+        return json.dumps([chat_model, overrides.get("top"), overrides.get("excludeCategory") or None,
+                           bool(overrides.get("semanticRanker")), bool(overrides.get("semanticCaptions"))])
+
+    def store_answer(self, scope: str, question_vector: list, response_text: str, query_text: str, results: list, sourcefiles: list[str]):
+        # 検索結果が無い回答は、文書が追加されても無効にできないのでキャッシュしない
+        if scope and response_text and sourcefiles:
+            self.answer_cache.store(question_vector, scope, {"answer": response_text, "data_points": results, "query_text": query_text}, sourcefiles)
+
+    # キャッシュした回答を通常の回答と同じようにチャンクに分けて返す
+    def replay_answer(self, response_text: str):
+        for i in range(0, len(response_text), ANSWER_REPLAY_CHUNK_SIZE):
+            yield response_text[i:i + ANSWER_REPLAY_CHUNK_SIZE]
+
+    # STEP 3: 検索結果とチャット履歴を使用して、コンテキストとコンテンツに応じた回答を生成するためのメッセージ
+    def build_answer_messages(self, history: list[dict], content: str, chat_model: str) -> list:
+        # 履歴はモデルのトークン数の上限に収まる分だけ新しい順に入れ、溢れた分は要約(有効な場合)にまとめる
+        message_builder = MessageBuilder(self.system_message_chat_conversation, chat_model, history_summarizer)
+        return message_builder.get_messages_from_history(
+            history,
+            history[-1]["user"]+ "\n\nSources:\n" + content[:1024], # モデルは長いシステム メッセージを適切に処理しません。ソースを最新のユーザー会話に移動して、フォローアップの質問プロンプトを解決します。
+            )
+
+    def finish(self, user_name: str, history: list[dict], usage: UsageTracker, response_text: str, conversationId: str, timestamp: str, title: str, query_text: str, results: list, messages: list, timings: dict, cache_similarity: float = None) -> str:
+        # トークン数はステージ(rewrite / answer)ごとに API が返した使用量（返さない場合はチャンクごとに数えた推定値）
+        # logging
+        # Azure Cosmos DBのコンテナーにプロンプトを登録
+        input_text = history[-1]["user"]
+        write_chatlog(ApproachType.DocSearch, user_name, usage.total_tokens(), input_text, response_text, conversationId, timestamp, title, query_text, usage=usage.to_dict())
+        msg_to_display = '\n\n'.join([str(message) for message in messages])
+        timings_to_display = '<br>'.join([f"{stage}: {elapsed:.0f} ms" for stage, elapsed in timings.items()])
+        if cache_similarity is not None:
+            timings_to_display += f"<br><br>Answer cache hit (similarity: {cache_similarity:.3f})"
+        for stage, stage_usage in usage.stages.items():
+            timings_to_display += f"<br>{stage} tokens: {stage_usage['prompt_tokens']} + {stage_usage['completion_tokens']}"
+        # マークダウン形式の水平線を入れ込む
+        response_text += "***"
+        return json.dumps({
+            "data_points": results,  # 検索結果など
+            "answer": response_text,  # 最終的な応答
+            "thoughts": f"Searched for:<br>{query_text}<br><br>Timings:<br>{timings_to_display}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')
+        })
+
+    def run(self, user_name: str, history: list[dict], overrides: dict, conversationId: str, timestamp: str, title: str) -> any:
+        try:
+            chat_model = overrides.get("gptModel")
+            chat_gpt_model = get_gpt_model(chat_model)
+            chat_deployment = chat_gpt_model.get("deployment")
+
+            # 似た質問の回答がキャッシュにあればそれを返す
+            timings = {}
+            usage = UsageTracker(chat_model)
+            scope = self.answer_cache_scope(history, overrides, chat_model)
+            question_vector = None
+            if scope:
+                # キャッシュを引くためのベクトルは、キャッシュに無ければ検索にも使う。
+                # 検索クエリの生成はヒットしたときに無駄になるので、キャッシュに無いと分かってから行う
+                question_vector = timed(timings, "embedding", generate_embeddings, history[-1]["user"])
+                entry, similarity = timed(timings, "answer_cache", self.answer_cache.lookup, question_vector, scope)
+                if entry:
+                    for content in self.replay_answer(entry["answer"]):
+                        yield content
+                    yield self.finish(user_name, history, usage, entry["answer"], conversationId, timestamp, title, entry["query_text"], entry["data_points"], [], timings, similarity)
+                    yield "\n[END OF RESPONSE]"
+                    return
+
+            # ステップ 1: チャット履歴と最後の質問に基づいて、最適化されたキーワード検索クエリを生成します
+            # ステップ 2: GPT 最適化クエリを使用して検索インデックスから関連ドキュメントを取得する
+            query_text, results, sourcefiles = self.retrieve(history, overrides, chat_model, chat_deployment, timings, usage, question_vector=question_vector)
             content = "\n".join(results)
 
             # STEP 3: 検索結果とチャット履歴を使用して、コンテキストとコンテンツに応じた回答を生成します。
@@ -135,50 +333,34 @@ source quesion: {user_question}
             completion_gpt_model = get_gpt_model(completion_model)
             completion_deployment = completion_gpt_model.get("deployment")
 
-            message_builder = MessageBuilder(self.system_message_chat_conversation)
-            messages = message_builder.get_messages_from_history(
-                history,
-                history[-1]["user"]+ "\n\nSources:\n" + content[:1024], # モデルは長いシステム メッセージを適切に処理しません。ソースを最新のユーザー会話に移動して、フォローアップの質問プロンプトを解決します。
-                )
+            messages = self.build_answer_messages(history, content, chat_model)
 
             temaperature = float(overrides.get("temperature"))
-            max_tokens = get_max_token_from_messages(messages, completion_model)
 
             # 回答生成
+            answer_started = time.perf_counter()
             response = openai.ChatCompletion.create(
                 engine=completion_deployment, 
                 messages=messages,
                 temperature=temaperature, 
                 max_tokens=1024,
                 n=1,
-                stream=True
+                stream=True,
+                **stream_options()
             )
             # 返答を受け取り、逐次yield
-            response_text = ""
+            answer = usage.stream("answer", messages)
             for chunk in response:
-                if chunk:
-                    content = chunk['choices'][0]['delta'].get('content')
-                    if content:
-                        response_text += content
-                        yield content # 各チャンクをフロントに送信
-
-            # トークン数を推定（レスポンスの文字数から算出しているだけあまり意味はない）
-            # 新しいバージョンのopenaiならストリームでも最後にトークン数を出してくれるみたい
-            encoding_name = tiktoken.encoding_for_model(chat_model).name
-            encoding = tiktoken.get_encoding(encoding_name)
-            total_tokens = len(encoding.encode(response_text))
-            # logging
-            # Azure Cosmos DBのコンテナーにプロンプトを登録
-            input_text = history[-1]["user"]
-            write_chatlog(ApproachType.DocSearch, user_name, total_tokens, input_text, response_text, conversationId, timestamp, title, query_text)
-            msg_to_display = '\n\n'.join([str(message) for message in messages])
-            # マークダウン形式の水平線を入れ込む
-            response_text += "***"
-            yield json.dumps({
-                "data_points": results,  # 検索結果など
-                "answer": response_text,  # 最終的な応答
-                "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')
-            })
+                content = answer.add(chunk)
+                if content:
+                    yield content # 各チャンクをフロントに送信
+            answer.finish()
+            response_text = answer.text()
+
+            timings["answer"] = (time.perf_counter() - answer_started) * 1000
+            yield self.finish(user_name, history, usage, response_text, conversationId, timestamp, title, query_text, results, messages, timings)
+            if scope:
+                self.store_answer(scope, question_vector, response_text, query_text, results, sourcefiles)
 
             yield "\n[END OF RESPONSE]"
         except openai.error.InvalidRequestError as e:
@@ -190,3 +372,61 @@ source quesion: {user_question}
             write_error("docsearch", user_name, str(e))
             yield "\n[ERROR]"
 
+    # ASGI(asgi.py)から使う非同期版。OpenAI と Cognitive Search は非同期クライアントで呼び出す
+    async def run_async(self, user_name: str, history: list[dict], overrides: dict, conversationId: str, timestamp: str, title: str) -> AsyncGenerator[str, None]:
+        try:
+            chat_model = overrides.get("gptModel")
+            chat_gpt_model = get_gpt_model(chat_model)
+            chat_deployment = chat_gpt_model.get("deployment")
+
+            timings = {}
+            usage = UsageTracker(chat_model)
+            scope = self.answer_cache_scope(history, overrides, chat_model)
+            question_vector = None
+            if scope:
+                question_vector = await timed_async(timings, "embedding", generate_embeddings_async(history[-1]["user"]))
+                entry, similarity = await timed_async(timings, "answer_cache", asyncio.to_thread(self.answer_cache.lookup, question_vector, scope))
+                if entry:
+                    for content in self.replay_answer(entry["answer"]):
+                        yield content
+                    # ログの書き込み(CHATLOG_ASYNC=false のときは Cosmos DB への同期書き込み)はスレッドで実行する
+                    yield await asyncio.to_thread(self.finish, user_name, history, usage, entry["answer"], conversationId, timestamp, title, entry["query_text"], entry["data_points"], [], timings, similarity)
+                    yield "\n[END OF RESPONSE]"
+                    return
+
+            query_text, results, sourcefiles = await self.retrieve_async(history, overrides, chat_model, chat_deployment, timings, usage, question_vector=question_vector)
+            content = "\n".join(results)
+
+            messages = self.build_answer_messages(history, content, chat_model)
+
+            temaperature = float(overrides.get("temperature"))
+            answer_started = time.perf_counter()
+            response = await openai.ChatCompletion.acreate(
+                engine=chat_deployment, 
+                messages=messages,
+                temperature=temaperature, 
+                max_tokens=1024,
+                n=1,
+                stream=True,
+                **stream_options()
+            )
+            answer = usage.stream("answer", messages)
+            async for chunk in response:
+                content = answer.add(chunk)
+                if content:
+                    yield content
+            answer.finish()
+            response_text = answer.text()
+
+            timings["answer"] = (time.perf_counter() - answer_started) * 1000
+            yield await asyncio.to_thread(self.finish, user_name, history, usage, response_text, conversationId, timestamp, title, query_text, results, messages, timings)
+            if scope:
+                await asyncio.to_thread(self.store_answer, scope, question_vector, response_text, query_text, results, sourcefiles)
+
+            yield "\n[END OF RESPONSE]"
+        except openai.error.InvalidRequestError as e:
+            write_error("docsearch", user_name, f"InvalidRequestError: {e}")
+            yield "\n[InvalidRequestError]"
+        except Exception as e:
+            write_error("docsearch", user_name, str(e))
+            yield "\n[ERROR]"
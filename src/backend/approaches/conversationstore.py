@@ -0,0 +1,491 @@
+from __future__ import annotations
+
+import re
+import json
+import time
+import base64
+import threading
+from collections import OrderedDict
+from azure.core import MatchConditions
+from azure.cosmos import ContainerProxy, PartitionKey
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError, CosmosAccessConditionFailedError, CosmosHttpResponseError
+
+# Cosmos DB のドキュメントIDに使えない文字
+_INVALID_ID_CHARS = re.compile(r"[/\\?#]")
+# 移行時にコピーしないシステムプロパティ
+_SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts")
+# 1回のパッチ操作に含められる操作数の上限
+_MAX_PATCH_OPERATIONS = 10
+# 追記の単位(チャットログの1件)のID。パッチの条件式に埋め込むので英数字とハイフンだけを許す
+_ENTRY_ID = re.compile(r"^[0-9A-Za-z-]+$")
+# ETag 不一致時の再試行回数
+_MAX_CONCURRENCY_RETRIES = 5
+# migrate_all が完了したことを示すドキュメントのID。これがあれば旧形式のドキュメントは残っていない
+_MIGRATION_MARKER_ID = "_migration:conversation_store"
+# 移行の完了を確認し直す間隔(秒)。別のプロセスで migrate_all を実行した場合に、再起動しなくても旧形式の検索を止める
+_MIGRATION_RECHECK_SECONDS = 10 * 60
+# 旧形式のドキュメントが無いと分かった会話IDを覚えておく数
+_NO_LEGACY_MAX_ENTRIES = 10000
+# 旧形式のドキュメントが無いと分かった結果を使う時間(秒)。ローリングデプロイ中は古いインスタンスが旧形式で書き込むので、短い間だけ覚える
+_NO_LEGACY_TTL_SECONDS = 60
+
+# 会話への追記方法
+WRITE_MODE_DOCUMENT = "document"  # ドキュメント全体を読み込み、ETag 付きで置き換える
+WRITE_MODE_PATCH = "patch"        # 部分更新(配列への追加)でメッセージだけを送る
+WRITE_MODE_TURNS = "turns"        # 2ターン目以降を別の小さなドキュメントとして保存する
+WRITE_MODES = (WRITE_MODE_DOCUMENT, WRITE_MODE_PATCH, WRITE_MODE_TURNS)
+
+# 会話履歴の一覧で返す項目(メッセージは含めない)
+_SUMMARY_FIELDS = ("conversation_id", "approach", "conversation_title", "title_pending", "timestamp")
+# 会話履歴の一覧に推奨する複合インデックス。ユーザー・ボットで絞り込み、timestamp の降順に並べたまま読み出せる
+HISTORY_COMPOSITE_INDEX = [
+    {"path": "/user", "order": "ascending"},
+    {"path": "/bot_name", "order": "ascending"},
+    {"path": "/timestamp", "order": "descending"}
+]
+
+class ConversationStore:
+    """
+      会話ドキュメントの永続化レイヤー。
+      ドキュメントID = パーティションキー = conversation_id とすることで、
+      会話の取得・更新・削除をクロスパーティションクエリではなくポイント操作1回で行う。
+      (コンテナーのパーティションキーは /id を前提とする)
+      自動生成IDで保存された既存ドキュメントは、ポイント読み取りで見つからない場合に
+      従来のクエリで探し、見つかれば新しいIDへ移行する。
+      legacy_lookup=None(既定)の場合は、migrate_all が完了時に保存するマーカーのドキュメントがあればこのクエリを行わない。
+      True / False で常に行う・行わないを指定できる。旧形式が無いと分かった会話IDは覚えておき、同じIDでは再び探さない。
+      追記は write_mode で選ぶ。entry_id を付けた追記は会話ドキュメントの entry_ids に記録し、同じ entry_id の追記は
+      (失敗後の再試行でも)1回しか反映しない。パッチの場合はメッセージと entry_id を1回のパッチで追加し、条件式で重複を防ぐ。
+      turns の場合、ターンのドキュメントIDは "<会話ID>:<entry_id>" で、会話ドキュメントの turn_entries の順に読み出して
+      get_transcript で組み立てる(以前の "<会話ID>:<連番>" のターンは turn_count まで読み出す)。
+      Methods:
+          get(self, conversation_id: str): 会話ドキュメントを取得する。
+          get_transcript(self, conversation_id: str): 別ドキュメントのターンも含めた会話を取得する。
+          append_messages(self, conversation_id: str, messages: list, entry_id: str): 既存の会話にメッセージを追記する。
+          set_title(self, conversation_id: str, title: str): 会話タイトルを更新する。
+          create(self, conversation_id: str, body: dict): 会話ドキュメントを作成する。
+          replace(self, conversation: dict): 会話ドキュメントを書き戻す。
+          delete(self, conversation_id: str): 会話ドキュメントを削除する。
+          migrate_all(self): 既存ドキュメントをすべて移行する。
+          list_conversations(self, user: str, bot_name: str, page_size: int, continuation_token: str): 会話の概要を新しい順に1ページ分返す。
+          ensure_history_index(self, database): 会話履歴の一覧用の複合インデックスをコンテナーに追加する。
+          get_metrics(self): 操作ごとの回数・RU・レイテンシを返す。
+      """
+
+    def __init__(self, container: ContainerProxy, legacy_lookup: bool = None, migrate_on_read: bool = True,
+                 write_mode: str = WRITE_MODE_PATCH):
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode: {write_mode}")
+        self.container = container
+        self.write_mode = write_mode
+        self.legacy_lookup = legacy_lookup
+        self.migrate_on_read = migrate_on_read
+        self._migrated = None
+        self._migrated_checked_at = 0.0
+        self._no_legacy = OrderedDict()
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+        # 複合インデックスが無いコンテナーでは、インデックスを使わない並べ方に切り替える
+        self._history_indexed = True
+
+    @staticmethod
+    def document_id(conversation_id: str) -> str:
+        return _INVALID_ID_CHARS.sub("_", str(conversation_id))
+
+    @classmethod
+    def turn_id(cls, conversation_id: str, turn: int) -> str:
+        return f"{cls.document_id(conversation_id)}:{turn}"
+
+    # ---- 計測 ----
+
+    def _record(self, operation: str, started: float, headers: dict = None):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        request_charge = 0.0
+        if headers:
+            try:
+                request_charge = float(headers.get("x-ms-request-charge", 0))
+            except (TypeError, ValueError):
+                request_charge = 0.0
+        with self._metrics_lock:
+            m = self._metrics.setdefault(operation, {"count": 0, "request_units": 0.0, "latency_ms": 0.0})
+            m["count"] += 1
+            m["request_units"] += request_charge
+            m["latency_ms"] += elapsed_ms
+
+    def _call(self, operation: str, func, *args, **kwargs):
+        captured = {}
+        def hook(headers, _):
+            captured.update(headers or {})
+        started = time.perf_counter()
+        try:
+            return func(*args, response_hook=hook, **kwargs)
+        finally:
+            self._record(operation, started, captured)
+
+    def _query(self, operation: str, query: str, parameters: list) -> list:
+        # クエリは複数のリクエスト(クエリプラン・パーティションごとのページ)になるので、各応答の RU を合計する。
+        # client_connection.last_response_headers は他のスレッドの操作で上書きされるため、応答ごとのフックで集める
+        request_charge = [0.0]
+        def hook(pipeline_response):
+            try:
+                request_charge[0] += float(pipeline_response.http_response.headers.get("x-ms-request-charge", 0))
+            except (TypeError, ValueError):
+                pass
+        started = time.perf_counter()
+        try:
+            return list(self.container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True,
+                                                   raw_response_hook=hook))
+        finally:
+            self._record(operation, started, {"x-ms-request-charge": request_charge[0]})
+
+    def get_metrics(self) -> dict:
+        with self._metrics_lock:
+            return {
+                op: {
+                    "count": m["count"],
+                    "request_units": round(m["request_units"], 2),
+                    "avg_request_units": round(m["request_units"] / m["count"], 2) if m["count"] else 0,
+                    "avg_latency_ms": round(m["latency_ms"] / m["count"], 2) if m["count"] else 0,
+                }
+                for op, m in self._metrics.items()
+            }
+
+    # ---- 読み書き ----
+
+    def get(self, conversation_id: str):
+        doc_id = self.document_id(conversation_id)
+        try:
+            return self._call("read", self.container.read_item, item=doc_id, partition_key=doc_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+        # 移行前のドキュメント(自動生成ID)を探す
+        legacy = self._find_legacy(conversation_id)
+        if not legacy:
+            return None
+        if self.migrate_on_read:
+            return self.migrate(legacy[0], legacy[1:])
+        return legacy[0]
+
+    def create(self, conversation_id: str, body: dict) -> dict:
+        body["id"] = self.document_id(conversation_id)
+        body["conversation_id"] = conversation_id
+        body.setdefault("entry_ids", [])
+        return self._call("create", self.container.create_item, body=body)
+
+    def replace(self, conversation: dict) -> dict:
+        return self._call("upsert", self.container.upsert_item, body=conversation)
+
+    def delete(self, conversation_id: str) -> bool:
+        doc_id = self.document_id(conversation_id)
+        deleted = False
+        try:
+            conversation = self._call("read", self.container.read_item, item=doc_id, partition_key=doc_id)
+            for turn_id in self._turn_ids(conversation_id, conversation):
+                try:
+                    self._call("delete", self.container.delete_item, item=turn_id, partition_key=turn_id)
+                except CosmosResourceNotFoundError:
+                    pass
+        except CosmosResourceNotFoundError:
+            pass
+        try:
+            self._call("delete", self.container.delete_item, item=doc_id, partition_key=doc_id)
+            deleted = True
+        except CosmosResourceNotFoundError:
+            pass
+        # 移行前のドキュメントが残っていれば一緒に削除する
+        for item in self._find_legacy(conversation_id):
+            self._call("delete", self.container.delete_item, item=item["id"], partition_key=item["id"])
+            deleted = True
+        return deleted
+
+    def get_transcript(self, conversation_id: str):
+        conversation = self.get(conversation_id)
+        if conversation is None:
+            return None
+        # 別ドキュメントに保存したターンを順に読み出して messages に連結する
+        for turn_id in self._turn_ids(conversation_id, conversation):
+            try:
+                item = self._call("read", self.container.read_item, item=turn_id, partition_key=turn_id)
+            except CosmosResourceNotFoundError:
+                # 連番の採番後に書き込みが失敗したターン
+                continue
+            conversation.setdefault("messages", []).extend(item.get("messages", []))
+        return conversation
+
+    def _turn_ids(self, conversation_id: str, conversation: dict) -> list:
+        # 連番のターン(以前の形式)の後に entry_id のターンが続く
+        return ([self.turn_id(conversation_id, turn) for turn in range(1, conversation.get("turn_count", 0) + 1)]
+                + [self.turn_id(conversation_id, entry_id) for entry_id in conversation.get("turn_entries", [])])
+
+    def set_title(self, conversation_id: str, title: str, usage: dict = None):
+        doc_id = self.document_id(conversation_id)
+        operations = [
+            {"op": "set", "path": "/conversation_title", "value": title},
+            {"op": "set", "path": "/title_pending", "value": False}
+        ]
+        # タイトル生成のトークン使用量（usage は会話の作成時に必ず保存している）
+        if usage is not None:
+            operations.append({"op": "set", "path": "/usage/title", "value": usage})
+        return self._call("patch", self.container.patch_item, item=doc_id, partition_key=doc_id, patch_operations=operations)
+
+    # ---- 追記 ----
+
+    def append_messages(self, conversation_id: str, messages: list, entry_id: str = None) -> bool:
+        """
+        既存の会話にメッセージを追記する。会話がまだ存在しない場合は False を返す。
+        entry_id を指定すると、同じ entry_id で追記済みの場合は何もせずに True を返す。
+        """
+        if entry_id is not None and not _ENTRY_ID.match(entry_id):
+            raise ValueError(f"Invalid entry id: {entry_id}")
+        append = {
+            WRITE_MODE_DOCUMENT: self._append_document,
+            WRITE_MODE_PATCH: self._append_patch,
+            WRITE_MODE_TURNS: self._append_turn,
+        }[self.write_mode]
+        try:
+            return append(conversation_id, messages, entry_id)
+        except CosmosResourceNotFoundError:
+            # 移行前のドキュメントがあれば移行してから追記し直す
+            if self.get(conversation_id) is None:
+                return False
+            return append(conversation_id, messages, entry_id)
+
+    def _append_document(self, conversation_id: str, messages: list, entry_id: str = None) -> bool:
+        doc_id = self.document_id(conversation_id)
+        for _ in range(_MAX_CONCURRENCY_RETRIES):
+            conversation = self._call("read", self.container.read_item, item=doc_id, partition_key=doc_id)
+            if entry_id is not None:
+                if entry_id in conversation.get("entry_ids", []):
+                    return True
+                conversation.setdefault("entry_ids", []).append(entry_id)
+            conversation.setdefault("messages", []).extend(messages)
+            try:
+                # 読み込んでから他のリクエストが更新していれば 412 になるので読み直す
+                self._call("replace", self.container.replace_item, item=doc_id, body=conversation,
+                           etag=conversation["_etag"], match_condition=MatchConditions.IfNotModified)
+                return True
+            except CosmosAccessConditionFailedError:
+                continue
+        raise RuntimeError(f"Too many concurrent updates for conversation: {conversation_id}")
+
+    def _append_patch(self, conversation_id: str, messages: list, entry_id: str = None) -> bool:
+        doc_id = self.document_id(conversation_id)
+        # 配列の末尾への追加はサーバー側でアトミックに行われるので ETag は不要
+        operations = [{"op": "add", "path": "/messages/-", "value": m} for m in messages]
+        if entry_id is None:
+            for i in range(0, len(operations), _MAX_PATCH_OPERATIONS):
+                self._call("patch", self.container.patch_item, item=doc_id, partition_key=doc_id,
+                           patch_operations=operations[i:i + _MAX_PATCH_OPERATIONS])
+            return True
+        operations.append({"op": "add", "path": "/entry_ids/-", "value": entry_id})
+        if len(operations) > _MAX_PATCH_OPERATIONS:
+            # 1回のパッチに収まらない場合は、途中まで反映されないようにドキュメントごと置き換える
+            return self._append_document(conversation_id, messages, entry_id)
+        return self._patch_entry(doc_id, entry_id, operations)
+
+    def _patch_entry(self, doc_id: str, entry_id: str, operations: list) -> bool:
+        # entry_id が未記録の場合だけ反映する。記録済み(再試行で2回目)なら条件を満たさず 412 になる
+        predicate = f"FROM c WHERE NOT IS_DEFINED(c.entry_ids) OR NOT ARRAY_CONTAINS(c.entry_ids, '{entry_id}')"
+        for attempt in range(2):
+            try:
+                self._call("patch", self.container.patch_item, item=doc_id, partition_key=doc_id,
+                           patch_operations=operations, filter_predicate=predicate)
+                return True
+            except CosmosAccessConditionFailedError:
+                return True
+            except CosmosHttpResponseError as e:
+                # entry_ids などの配列が無い以前のドキュメントには配列を作ってからやり直す
+                if e.status_code != 400 or attempt > 0:
+                    raise
+                arrays = {op["path"][:-2] for op in operations if op["path"].endswith("/-") and op["path"] != "/messages/-"}
+                for path in arrays:
+                    try:
+                        self._call("patch", self.container.patch_item, item=doc_id, partition_key=doc_id,
+                                   patch_operations=[{"op": "add", "path": path, "value": []}],
+                                   filter_predicate=f"FROM c WHERE NOT IS_DEFINED(c.{path[1:]})")
+                    except CosmosAccessConditionFailedError:
+                        pass
+
+    def _append_turn(self, conversation_id: str, messages: list, entry_id: str = None) -> bool:
+        doc_id = self.document_id(conversation_id)
+        if entry_id is not None:
+            # ターンのドキュメントを先に作り(同じIDなら作成済み)、会話ドキュメントへの登録を条件付きのパッチで1回だけ行う。
+            # 登録の前に失敗したターンのドキュメントは参照されないだけで、再試行すると同じものが使われる
+            turn_id = self.turn_id(conversation_id, entry_id)
+            try:
+                self._call("create", self.container.create_item, body={
+                    "id": turn_id,
+                    "doc_type": "turn",
+                    "conversation_id": conversation_id,
+                    "entry_id": entry_id,
+                    "messages": messages
+                })
+            except CosmosResourceExistsError:
+                pass
+            return self._patch_entry(doc_id, entry_id, [
+                {"op": "add", "path": "/entry_ids/-", "value": entry_id},
+                {"op": "add", "path": "/turn_entries/-", "value": entry_id}
+            ])
+        # 連番の採番はインクリメントのパッチで行い、戻り値の turn_count をそのまま使う
+        conversation = self._call("patch", self.container.patch_item, item=doc_id, partition_key=doc_id,
+                                  patch_operations=[{"op": "incr", "path": "/turn_count", "value": 1}])
+        turn = conversation["turn_count"]
+        turn_id = self.turn_id(conversation_id, turn)
+        self._call("create", self.container.create_item, body={
+            "id": turn_id,
+            "doc_type": "turn",
+            "conversation_id": conversation_id,
+            "turn": turn,
+            "messages": messages
+        })
+        return True
+
+    # ---- 移行 ----
+
+    def _legacy_lookup_enabled(self) -> bool:
+        if self.legacy_lookup is not None:
+            return self.legacy_lookup
+        if self._migrated:
+            return False
+        now = time.time()
+        if self._migrated is None or now - self._migrated_checked_at >= _MIGRATION_RECHECK_SECONDS:
+            try:
+                self._call("read", self.container.read_item, item=_MIGRATION_MARKER_ID, partition_key=_MIGRATION_MARKER_ID)
+                self._migrated = True
+            except CosmosResourceNotFoundError:
+                self._migrated = False
+            except Exception as e:
+                # 確認できない場合は旧形式も探す(次の呼び出しで確認し直す)
+                print(f"Error in migration marker read: {str(e)}")
+                return True
+            self._migrated_checked_at = now
+        return not self._migrated
+
+    def _find_legacy(self, conversation_id: str) -> list:
+        checked_at = self._no_legacy.get(conversation_id)
+        if checked_at is not None and time.time() - checked_at < _NO_LEGACY_TTL_SECONDS:
+            return []
+        if not self._legacy_lookup_enabled():
+            return []
+        query = "SELECT * FROM c WHERE c.conversation_id = @conversation_id AND c.id != @id AND NOT IS_DEFINED(c.doc_type)"
+        parameters = [
+            {"name": "@conversation_id", "value": conversation_id},
+            {"name": "@id", "value": self.document_id(conversation_id)}
+        ]
+        legacy = self._query("legacy_query", query, parameters)
+        if not legacy:
+            # 古いインスタンスが後から旧形式で書き込むこともあるので、_NO_LEGACY_TTL_SECONDS の間だけ探し直さない
+            with self._metrics_lock:
+                self._no_legacy.pop(conversation_id, None)
+                self._no_legacy[conversation_id] = time.time()
+                if len(self._no_legacy) > _NO_LEGACY_MAX_ENTRIES:
+                    self._no_legacy.popitem(last=False)
+        return legacy
+
+    def migrate(self, item: dict, duplicates: list = None) -> dict:
+        duplicates = duplicates or []
+        conversation = {k: v for k, v in item.items() if k not in _SYSTEM_PROPERTIES}
+        # 同じ会話が複数ドキュメントに分かれている場合はメッセージをつなげる
+        for duplicate in duplicates:
+            conversation.setdefault("messages", []).extend(duplicate.get("messages", []))
+        conversation["id"] = self.document_id(item["conversation_id"])
+        migrated = self._call("upsert", self.container.upsert_item, body=conversation)
+        for old in [item] + list(duplicates):
+            if old["id"] == conversation["id"]:
+                continue
+            self._call("delete", self.container.delete_item, item=old["id"], partition_key=old["id"])
+        return migrated
+
+    def migrate_all(self) -> int:
+        query = "SELECT * FROM c WHERE IS_DEFINED(c.conversation_id) AND c.id != c.conversation_id AND NOT IS_DEFINED(c.doc_type)"
+        groups = {}
+        for item in self._query("legacy_query", query, []):
+            groups.setdefault(item["conversation_id"], []).append(item)
+        for items in groups.values():
+            self.migrate(items[0], items[1:])
+        # 完了を記録する。以降は legacy_lookup=None のインスタンスが旧形式の検索を止める
+        self._call("upsert", self.container.upsert_item, body={
+            "id": _MIGRATION_MARKER_ID,
+            "doc_type": "marker",
+            "migrated": len(groups),
+            "completed_at": time.time()
+        })
+        self._migrated = True
+        return len(groups)
+
+    # ---- 会話履歴の一覧 ----
+
+    @staticmethod
+    def encode_continuation(cursor: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_continuation(token: str) -> dict:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        except Exception:
+            raise ValueError("Invalid continuation token")
+        if not isinstance(cursor, dict) or not isinstance(cursor.get("seen"), list):
+            raise ValueError("Invalid continuation token")
+        return cursor
+
+    def list_conversations(self, user: str, bot_name: str, page_size: int, continuation_token: str = None) -> tuple:
+        # 継続トークンは前のページの最後の timestamp と、その timestamp で返した会話のID(同じ時刻の会話を飛ばさないため)。
+        # パーティションキーが /id なのでクロスパーティションクエリになるが、TOP と複合インデックスにより
+        # 各パーティションで先頭から1ページ分を読むだけになり、履歴の件数に関わらず一定のコストで返せる。
+        # timestamp が無い(文字列でない)古い会話は最後に返す
+        cursor = self.decode_continuation(continuation_token) if continuation_token else None
+        parameters = [
+            {"name": "@user", "value": user},
+            {"name": "@bot_name", "value": bot_name},
+            {"name": "@top", "value": page_size + 1}
+        ]
+        condition = ""
+        if cursor is not None:
+            parameters.append({"name": "@seen", "value": cursor["seen"]})
+            if cursor.get("timestamp") is None:
+                condition = "AND NOT IS_STRING(c.timestamp) AND NOT ARRAY_CONTAINS(@seen, c.conversation_id)"
+            else:
+                parameters.append({"name": "@timestamp", "value": cursor["timestamp"]})
+                condition = ("AND (c.timestamp < @timestamp OR NOT IS_STRING(c.timestamp) "
+                             "OR (c.timestamp = @timestamp AND NOT ARRAY_CONTAINS(@seen, c.conversation_id)))")
+        fields = ", ".join(f"c.{field}" for field in _SUMMARY_FIELDS)
+        query = f"SELECT TOP @top {fields} FROM c WHERE c.user = @user AND c.bot_name = @bot_name {condition} ORDER BY "
+        try:
+            if self._history_indexed:
+                # 絞り込む項目を ORDER BY の先頭に含めると複合インデックスが使われる
+                items = self._query("list", query + "c.user ASC, c.bot_name ASC, c.timestamp DESC", parameters)
+            else:
+                items = self._query("list", query + "c.timestamp DESC", parameters)
+        except CosmosHttpResponseError as e:
+            if e.status_code != 400 or "composite index" not in str(e).lower():
+                raise
+            print("Composite index for conversation history is missing, run: python -m approaches.chatlogging --history-index")
+            self._history_indexed = False
+            items = self._query("list", query + "c.timestamp DESC", parameters)
+
+        if len(items) <= page_size:
+            return items, None
+        items = items[:page_size]
+        timestamp = lambda item: item["timestamp"] if isinstance(item.get("timestamp"), str) else None
+        last = timestamp(items[-1])
+        seen = [item["conversation_id"] for item in items if timestamp(item) == last]
+        if cursor is not None and cursor.get("timestamp") == last:
+            seen = cursor["seen"] + seen
+        return items, self.encode_continuation({"timestamp": last, "seen": seen})
+
+    def ensure_history_index(self, database) -> bool:
+        # コンテナーのインデックス ポリシーに複合インデックスを追加する。追加した場合は True(インデックスはバックグラウンドで作られる)
+        properties = self.container.read()
+        policy = properties["indexingPolicy"]
+        if HISTORY_COMPOSITE_INDEX in policy.get("compositeIndexes", []):
+            return False
+        policy.setdefault("compositeIndexes", []).append(HISTORY_COMPOSITE_INDEX)
+        partition_key = properties["partitionKey"]
+        database.replace_container(
+            self.container,
+            partition_key=PartitionKey(path=partition_key["paths"][0], kind=partition_key.get("kind", "Hash")),
+            indexing_policy=policy)
+        self._history_indexed = True
+        return True
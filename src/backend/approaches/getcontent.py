@@ -1,15 +1,272 @@
+
 import os
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
 import openai
 
 
 AZURE_OPENAI_TEXT_EMBEDDING_ADA_002_DEPLOYMENT = os.environ.get("AZURE_OPENAI_TEXT_EMBEDDING_ADA_002_DEPLOYMENT")
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 1000))
+# 指定するとベクトルをディスクにも保存し、再起動後も再利用する
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
+# 1回のリクエストで送るテキスト数の上限（Azure OpenAI の ada-002 は 16）
+EMBEDDING_MAX_BATCH = int(os.environ.get("EMBEDDING_MAX_BATCH", 16))
+# 他のリクエストが取得中のベクトルを待つ時間の上限(秒)
+EMBEDDING_WAIT_TIMEOUT = float(os.environ.get("EMBEDDING_WAIT_TIMEOUT", 60))
+
+class EmbeddingDiskStore:
+    """
+      ベクトルを float32 の配列としてファイルに追記し、メモリマップで読み出すストア。
+      vectors.f32 に行ごとのベクトル、keys.txt に同じ順序でキーを保存する。
+      書き込みは1プロセスからのみ行うこと。
+      """
+
+    def __init__(self, directory: str, dimensions: int = 1536):
+        os.makedirs(directory, exist_ok=True)
+        self.dimensions = dimensions
+        self.row_bytes = dimensions * np.dtype(np.float32).itemsize
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self._lock = threading.Lock()
+        self._rows = {}
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, encoding="utf-8") as f:
+                keys = f.read().splitlines()
+        # 書き込み中に止まった場合は、ベクトルとキーの両方が揃っている行までを使う(prepdocs の EmbeddingCache と同じ)
+        rows = min(len(keys), os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0)
+        if rows < len(keys) or (os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != rows * self.row_bytes):
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(rows * self.row_bytes)
+            with open(self.keys_path, "w", encoding="utf-8") as f:
+                f.write("".join(key + "\n" for key in keys[:rows]))
+        for row, key in enumerate(keys[:rows]):
+            self._rows[key] = row
+        self._map = None
+        self._map_rows = 0
+
+    def _remap(self):
+        rows = len(self._rows)
+        self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimensions)) if rows else None
+        self._map_rows = rows
+
+    def get(self, key: str):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        with self._lock:
+            if row >= self._map_rows:
+                self._remap()
+            return np.array(self._map[row])
+
+    def put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            if key in self._rows or len(vector) != self.dimensions:
+                return
+            # ベクトルを先に書き出すので、途中で止まってもキーがずれることは無い
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.asarray(vector, dtype=np.float32).tobytes())
+            with open(self.keys_path, "a", encoding="utf-8") as f:
+                f.write(key + "\n")
+            self._rows[key] = len(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+class EmbeddingService:
+    """
+      埋め込みベクトルの取得サービス。
+      プロセス内の LRU、ディスクストア(任意)の順に探し、無ければ OpenAI に問い合わせる。
+      同じテキストへの同時のリクエストは1回の API 呼び出しにまとめ、embed_many は複数のテキストを1回のリクエストで送る。
+      Methods:
+          embed(self, text: str): 1件のテキストのベクトルを返す。
+          embed_many(self, texts: list[str]): 複数のテキストのベクトルを返す。
+          embed_async(self, text: str): embed の非同期版。
+          get_metrics(self): ヒット数・ミス数などを返す。
+      """
+
+    def __init__(self, deployment: str, max_entries: int = 1000, disk_store: EmbeddingDiskStore = None, max_batch: int = 16,
+                 wait_timeout: float = 60):
+        self.deployment = deployment
+        self.max_entries = max_entries
+        self.disk_store = disk_store
+        self.max_batch = max_batch
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "api_calls": 0}
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.deployment}\n{text}".encode("utf-8")).hexdigest()
+
+    def _count(self, name: str, value: int = 1):
+        with self._metrics_lock:
+            self._metrics[name] += value
+
+    def _lookup(self, key: str):
+        # ロックを取った状態で呼び出す
+        vector = self._entries.get(key)
+        if vector is not None:
+            self._entries.move_to_end(key)
+            self._count("hits")
+        return vector
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _claim(self, keys: list[str]) -> tuple:
+        """
+        キャッシュにあるものはベクトルを、他のリクエストが取得中のものはその Future を、
+        それ以外はこのリクエストで取得する Future を返す。
+        """
+        found, waiting, owned = {}, {}, {}
+        missing = []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                vector = self._lookup(key)
+                if vector is not None:
+                    found[key] = vector
+                else:
+                    missing.append(key)
+        if not missing:
+            return found, waiting, owned
+
+        # ディスクの読み出しはロックの外で行う
+        if self.disk_store is not None:
+            from_disk = {}
+            for key in missing:
+                vector = self.disk_store.get(key)
+                if vector is not None:
+                    self._count("disk_hits")
+                    from_disk[key] = vector
+            if from_disk:
+                with self._lock:
+                    for key, vector in from_disk.items():
+                        self._remember(key, vector)
+                found.update(from_disk)
+
+        with self._lock:
+            for key in missing:
+                if key in found:
+                    continue
+                # ディスクを読んでいる間に他のリクエストが取得を終えた場合
+                vector = self._lookup(key)
+                if vector is not None:
+                    found[key] = vector
+                elif key in self._inflight:
+                    self._count("coalesced")
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._count("misses")
+                    owned[key] = self._inflight[key] = Future()
+        return found, waiting, owned
+
+    def _resolve(self, owned: dict, vectors: dict, error: Exception = None):
+        with self._lock:
+            for key in owned:
+                self._inflight.pop(key, None)
+                if error is None:
+                    self._remember(key, vectors[key])
+        # 待っているリクエストに先に結果を渡し、ディスクへの保存に失敗しても止めない
+        for key, future in owned.items():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(vectors[key])
+        if error is None and self.disk_store is not None:
+            try:
+                for key in owned:
+                    self.disk_store.put(key, vectors[key])
+            except Exception as e:
+                print(f"Error in embedding disk store: {str(e)}")
+
+    @staticmethod
+    def _as_error(e: BaseException) -> Exception:
+        # キャンセルなど Exception 以外で中断した場合も、待っている他のリクエストには通常の例外として渡す
+        return e if isinstance(e, Exception) else RuntimeError(f"Embedding request was interrupted: {type(e).__name__}")
+
+    def _request(self, texts: list[str]) -> list:
+        self._count("api_calls")
+        response = openai.Embedding.create(input=texts, engine=self.deployment)
+        data = sorted(response['data'], key=lambda d: d['index'])
+        return [np.asarray(d['embedding'], dtype=np.float32) for d in data]
+
+    def embed_many(self, texts: list[str]) -> list[np.ndarray]:
+        keys = [self.make_key(t) for t in texts]
+        found, waiting, owned = self._claim(keys)
+        if owned:
+            texts_by_key = {k: t for k, t in zip(keys, texts)}
+            owned_keys = list(owned.keys())
+            vectors = {}
+            try:
+                for i in range(0, len(owned_keys), self.max_batch):
+                    batch = owned_keys[i:i + self.max_batch]
+                    for key, vector in zip(batch, self._request([texts_by_key[k] for k in batch])):
+                        vectors[key] = vector
+            except BaseException as e:
+                self._resolve(owned, vectors, self._as_error(e))
+                raise
+            self._resolve(owned, vectors)
+            found.update(vectors)
+        for key, future in waiting.items():
+            found[key] = future.result(timeout=self.wait_timeout)
+        return [found[k] for k in keys]
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.embed_many([text])[0]
+
+    async def embed_async(self, text: str) -> np.ndarray:
+        key = self.make_key(text)
+        found, waiting, owned = self._claim([key])
+        if key in found:
+            return found[key]
+        if key in waiting:
+            # shield で、待っている側のキャンセルやタイムアウトが取得中の Future を取り消さないようにする
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiting[key])), self.wait_timeout)
+        try:
+            self._count("api_calls")
+            response = await openai.Embedding.acreate(input=text, engine=self.deployment)
+            vector = np.asarray(response['data'][0]['embedding'], dtype=np.float32)
+        except BaseException as e:
+            self._resolve(owned, {}, self._as_error(e))
+            raise
+        self._resolve(owned, {key: vector})
+        return vector
+
+    def get_metrics(self) -> dict:
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics["entries"] = len(self._entries)
+        metrics["disk_entries"] = len(self.disk_store) if self.disk_store is not None else 0
+        lookups = metrics["hits"] + metrics["disk_hits"] + metrics["misses"] + metrics["coalesced"]
+        metrics["hit_rate"] = round((lookups - metrics["misses"]) / lookups, 4) if lookups else 0.0
+        return metrics
+
+embedding_service = EmbeddingService(
+    AZURE_OPENAI_TEXT_EMBEDDING_ADA_002_DEPLOYMENT,
+    max_entries=EMBEDDING_CACHE_SIZE,
+    disk_store=EmbeddingDiskStore(EMBEDDING_CACHE_DIR) if EMBEDDING_CACHE_DIR else None,
+    max_batch=EMBEDDING_MAX_BATCH,
+    wait_timeout=EMBEDDING_WAIT_TIMEOUT)
 
 # ベクトル変換
 def generate_embeddings(text):
-    response = openai.Embedding.create(
-        input=text,
-        engine=AZURE_OPENAI_TEXT_EMBEDDING_ADA_002_DEPLOYMENT  # text-embedding-ada-002 のデプロイ名
-    )
-    embeddings = response['data'][0]['embedding']
-    return embeddings
-   
\ No newline at end of file
+    return embedding_service.embed(text).tolist()
+
+# ベクトル変換（複数のテキストをまとめて変換）
+def generate_embeddings_batch(texts):
+    return [v.tolist() for v in embedding_service.embed_many(texts)]
+
+# ベクトル変換（非同期版）
+async def generate_embeddings_async(text):
+    vector = await embedding_service.embed_async(text)
+    return vector.tolist()
@@ -0,0 +1,85 @@
+# ASGI エントリーポイント
+# ストリーミング応答の /chat と /docsearch は非同期で処理し、ストリーム中にワーカースレッドを占有しない。
+# それ以外のルートは既存の Flask アプリにそのまま渡す。
+# 実行例: uvicorn asgi:application --host 0.0.0.0 --port 5000
+import json
+import asyncio
+import openai
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app, chat_approaches, ensure_openai_token, async_search_client, start_background
+from approaches.chatlogging import write_error
+from core.clients import create_aiohttp_session
+
+# OpenAI の非同期呼び出しで共有する aiohttp セッション（起動時に作成）
+aiohttp_session = None
+
+async def read_json(receive) -> dict:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return json.loads(body or b"{}")
+
+async def send_json(send, status: int, payload):
+    body = json.dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+async def run_approach(category: str, receive, send):
+    # トークンの取得・更新は同期の HTTP 呼び出しなので、イベントループを止めないようにスレッドで実行する
+    await asyncio.to_thread(ensure_openai_token)
+    request_json = await read_json(receive)
+    approach = request_json["approach"]
+    user_name = request_json.get("loginUser", "anonymous")
+    overrides = request_json.get("overrides")
+    conversationId = request_json.get("conversationId")
+    timestamp = request_json.get("timestamp")
+    conversation_title = request_json["conversation_title"]
+    try:
+        impl = chat_approaches.get(approach)
+        if not impl:
+            return await send_json(send, 400, {"error": "unknown approach"})
+        generator = impl.run_async(user_name, request_json["history"], overrides, conversationId, timestamp, conversation_title)
+    except Exception as e:
+        write_error(category, user_name, str(e))
+        return await send_json(send, 500, {"error": str(e)})
+
+    # openai.aiosession はコンテキスト変数なので、ストリームを流すタスクの中で設定する
+    openai.aiosession.set(aiohttp_session)
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+    async for chunk in generator:
+        await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def lifespan(receive, send):
+    global aiohttp_session
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            aiohttp_session = create_aiohttp_session()
+            start_background()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_search_client.close()
+            await aiohttp_session.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# Chat / Document Search
+ASYNC_ROUTES = {
+    "/chat": "chat",
+    "/docsearch": "docsearch"
+}
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in ASYNC_ROUTES:
+        await run_approach(ASYNC_ROUTES[scope["path"]], receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
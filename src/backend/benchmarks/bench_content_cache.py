@@ -0,0 +1,99 @@
+"""
+/content のページ Blob キャッシュ(ContentCache)のベンチマーク。
+一部のページに引用が集中する(Zipf 分布)負荷で、毎回 Blob Storage から読む場合と、メモリだけ・メモリ+ディスクのキャッシュ、
+およびディスクだけが残った再起動後の状態を、偽の Blob Storage で比較する。途中で一部のページを更新し、ETag の確認で新しい内容を返すことも確かめる。
+
+    cd src/backend
+    python benchmarks/bench_content_cache.py --requests 2000 --pages 500
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.storage.blob import BlobServiceClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakeblob import FakeBlobStorage
+from core.blobcontent import BlobContentProxy, ContentCache
+
+CONTAINER = "content"
+
+def page_name(i: int) -> str:
+    return f"handbook{i // 50}-{i % 50 + 1}.pdf"
+
+def run(name: str, proxy: BlobContentProxy, paths: list, threads: int, fake: FakeBlobStorage, expected: dict):
+    fake.reset_counts()
+    latencies = []
+
+    def fetch(path):
+        start = time.perf_counter()
+        status, headers, body = proxy.get(path)
+        data = b"".join(body)
+        latencies.append(time.perf_counter() - start)
+        assert status == 200 and data == expected[path], f"unexpected content for {path}"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(fetch, paths))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{name:<16} {len(paths) / elapsed:8.1f} req/s  p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  "
+          f"blob GET {fake.requests['get']:5d}  304 {fake.requests['not_modified']:5d}  {fake.bytes_sent / 1024 / 1024:8.1f} MiB from blob")
+    if proxy.cache is not None:
+        print(f"{'':<16} {proxy.cache.get_metrics()}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf 分布の指数(大きいほど一部のページに集中する)")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--memory-mb", type=float, default=16, help="メモリのキャッシュの上限")
+    parser.add_argument("--revalidate-after", type=float, default=60)
+    args = parser.parse_args()
+    # 本文の無い 304 の応答ごとに出る azure-core の警告を抑える
+    logging.getLogger("azure").setLevel(logging.ERROR)
+
+    rng = random.Random(0)
+    fake = FakeBlobStorage(latency=args.latency).start()
+    expected = {}
+    for i in range(args.pages):
+        data = rng.randbytes(rng.randint(40, 300) * 1024)
+        fake.put(page_name(i), data)
+        expected[page_name(i)] = data
+    weights = [1 / (rank + 1) ** args.skew for rank in range(args.pages)]
+    paths = [page_name(i) for i in rng.choices(range(args.pages), weights=weights, k=args.requests)]
+    total = sum(len(data) for data in expected.values())
+    print(f"{args.pages} pages ({total / 1024 / 1024:.1f} MiB), {args.requests} requests, {len(set(paths))} distinct pages")
+
+    container = BlobServiceClient(account_url=fake.url).get_container_client(CONTAINER)
+    run("no cache", BlobContentProxy(container), paths, args.threads, fake, expected)
+
+    memory_bytes = int(args.memory_mb * 1024 * 1024)
+    run("memory", BlobContentProxy(container, cache=ContentCache(memory_bytes, revalidate_after=args.revalidate_after)),
+        paths, args.threads, fake, expected)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # メモリを小さくして、追い出したページをディスクから読む
+        tiered = ContentCache(memory_bytes // 4, directory=directory, revalidate_after=args.revalidate_after)
+        run("memory+disk", BlobContentProxy(container, cache=tiered), paths, args.threads, fake, expected)
+
+        # 一部のページを更新してから再起動した状態。ディスクのエントリは最初に ETag で確認する
+        for i in range(0, args.pages, 10):
+            data = rng.randbytes(len(expected[page_name(i)]))
+            fake.put(page_name(i), data)
+            expected[page_name(i)] = data
+        restarted = ContentCache(memory_bytes // 4, directory=directory, revalidate_after=args.revalidate_after)
+        run("disk (restart)", BlobContentProxy(container, cache=restarted), paths, args.threads, fake, expected)
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+埋め込みベクトル取得のベンチマーク。
+質問の一部が繰り返される負荷で、1件ずつ毎回 API を呼ぶ従来の方法と EmbeddingService(キャッシュ・同時リクエストの集約)、
+および embed_many による一括取得を偽の OpenAI エンドポイントで比較する。
+
+    cd src/backend
+    python benchmarks/bench_embeddings.py --requests 500 --distinct 100
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakeopenai import FakeOpenAI
+from approaches.getcontent import EmbeddingService, EmbeddingDiskStore
+
+DEPLOYMENT = "text-embedding-ada-002"
+
+def legacy_embedding(text: str):
+    response = openai.Embedding.create(input=text, engine=DEPLOYMENT)
+    return response['data'][0]['embedding']
+
+def run(name: str, func, questions: list, threads: int, fake: FakeOpenAI):
+    fake.requests["embeddings"] = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(func, questions))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} {len(questions) / elapsed:8.1f} texts/s, {fake.requests['embeddings']} API calls")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--distinct", type=int, default=100, help="異なる質問の数")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency).start()
+    random.seed(0)
+    questions = [f"有給休暇の申請方法 {random.randrange(args.distinct)}" for _ in range(args.requests)]
+
+    run("legacy", legacy_embedding, questions, args.threads, fake)
+
+    service = EmbeddingService(DEPLOYMENT)
+    run("service", service.embed, questions, args.threads, fake)
+    print(f"                 {service.get_metrics()}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        cold = EmbeddingService(DEPLOYMENT, disk_store=EmbeddingDiskStore(directory))
+        fake.requests["embeddings"] = 0
+        start = time.perf_counter()
+        cold.embed_many(questions)
+        elapsed = time.perf_counter() - start
+        print(f"{'embed_many':<16} {len(questions) / elapsed:8.1f} texts/s, {fake.requests['embeddings']} API calls")
+
+        # ディスクストアだけを使う再起動後の状態
+        warm = EmbeddingService(DEPLOYMENT, disk_store=EmbeddingDiskStore(directory))
+        run("disk (restart)", warm.embed, questions, args.threads, fake)
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+validate_token のベンチマーク。
+ローカルにOpenID構成とJWKSを返す偽のエンドポイントを立て、毎回2回HTTP取得する従来の検証と
+JwksKeyStore による検証を比較する。
+
+    cd src/backend
+    python benchmarks/bench_jwks.py --requests 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import jwt.algorithms
+import requests
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.jwks import JwksKeyStore
+
+AUDIENCE = "bench-client-id"
+KID = "bench-kid"
+
+def start_fake_oidc(jwk: dict):
+    hits = {"count": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            hits["count"] += 1
+            host = f"http://127.0.0.1:{self.server.server_port}"
+            if self.path == "/.well-known/openid-configuration":
+                body = json.dumps({"jwks_uri": f"{host}/keys"})
+                etag = None
+            else:
+                body = json.dumps({"keys": [jwk]})
+                etag = '"v1"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "max-age=3600")
+            if etag:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, hits
+
+def legacy_validate(token: str, openid_configuration_url: str):
+    key_url = requests.get(openid_configuration_url).json()["jwks_uri"]
+    keys = requests.get(key_url).json()["keys"]
+    header = jwt.get_unverified_header(token)
+    for key in keys:
+        if key["kid"] == header["kid"]:
+            public_key = jwt.algorithms.RSAAlgorithm.from_jwk(key)
+            break
+    return jwt.decode(token, public_key, audience=AUDIENCE, algorithms=["RS256"])
+
+def measure(name: str, func, n: int, hits: dict):
+    start_hits = hits["count"]
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {n} requests: {elapsed * 1000 / n:8.3f} ms/req, {hits['count'] - start_hits} HTTP fetches")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": KID, "use": "sig"})
+    token = jwt.encode({"aud": AUDIENCE, "exp": int(time.time()) + 3600, "preferred_username": "bench@example.com"},
+                       private_key, algorithm="RS256", headers={"kid": KID})
+
+    server, hits = start_fake_oidc(jwk)
+    url = f"http://127.0.0.1:{server.server_port}/.well-known/openid-configuration"
+    store = JwksKeyStore(url)
+
+    measure("legacy", lambda: legacy_validate(token, url), args.requests, hits)
+    measure("keystore", lambda: store.validate(token, AUDIENCE), args.requests, hits)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
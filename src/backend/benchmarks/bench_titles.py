@@ -0,0 +1,57 @@
+"""
+会話タイトル生成のベンチマーク。
+N件の新しい会話が同時に始まったときに、会話ごとに1回 ChatCompletion を呼ぶ従来の方法と
+TitleService でまとめて生成する方法のスループットを偽の OpenAI エンドポイントで比較する。
+
+    cd src/backend
+    python benchmarks/bench_titles.py --conversations 200 --latency 0.5
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakeopenai import FakeOpenAI
+from core.messagebuilder import MessageBuilder
+from core.titleservice import TitleService
+
+DEPLOYMENT = "gpt-35-turbo"
+
+def legacy_title(question: str) -> str:
+    messages = MessageBuilder("Your assistant will come up with a title for your question.").get_messages_from_history([], question)
+    completion = openai.ChatCompletion.create(engine=DEPLOYMENT, messages=messages, temperature=0.5, n=1)
+    return completion.choices[0]["message"]["content"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, default=16, help="従来方式で同時に呼び出すスレッド数")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency).start()
+    questions = [f"経費精算の申請方法を教えてください その{i}" for i in range(args.conversations)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        list(executor.map(legacy_title, questions))
+    elapsed = time.perf_counter() - start
+    print(f"legacy   : {args.conversations / elapsed:8.1f} titles/s, {fake.requests['chat']} completions")
+
+    fake.requests["chat"] = 0
+    service = TitleService(DEPLOYMENT, batch_wait=0.2)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as executor:
+        list(executor.map(lambda i: service.request(str(i), questions[i]), range(args.conversations)))
+    while service.get_metrics()["generated"] + service.get_metrics()["failed"] < args.conversations:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(f"batched  : {args.conversations / elapsed:8.1f} titles/s, {fake.requests['chat']} completions")
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+トークン数計算のベンチマーク。
+50ターンの日本語の会話を1ターンずつ進め、毎ターン json.dumps(messages) 全体をエンコードする従来の方法と、
+メッセージごとのトークン数をキャッシュする TokenCounter を比較する。
+
+    cd src/backend
+    python benchmarks/bench_tokens.py --turns 50 --conversations 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.modelhelper import TokenCounter
+
+SYSTEM_PROMPT = "Assistant helps the customer questions. keep your answers concise and in Japanese."
+PHRASES = ["有給休暇の申請は", "勤怠システムから", "上長の承認を得て", "経費精算の締め日は", "毎月25日です。",
+           "詳細は就業規則を", "ご確認ください。", "リモートワークの", "申請手順について", "教えてください。"]
+
+def sentence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(PHRASES) for _ in range(length))
+
+def conversation(seed: int, turns: int) -> list[dict]:
+    rng = random.Random(seed)
+    return [{"user": sentence(rng, 3), "assistant": sentence(rng, 12)} for _ in range(turns)]
+
+def to_messages(history: list[dict]) -> list[dict]:
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for h in history:
+        messages.append({"role": "user", "content": h["user"]})
+        messages.append({"role": "assistant", "content": h["assistant"]})
+    return messages
+
+def legacy_count(encoding, messages: list[dict]) -> int:
+    return len(encoding.encode(json.dumps(messages, ensure_ascii=False)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--encoding", default="cl100k_base")
+    args = parser.parse_args()
+
+    encoding = tiktoken.get_encoding(args.encoding)
+    conversations = [conversation(seed, args.turns) for seed in range(args.conversations)]
+    # 1ターン目から最終ターンまで、毎ターン会話全体のトークン数を求める
+    workload = [to_messages(c[:turn]) for c in conversations for turn in range(1, args.turns + 1)]
+
+    start = time.perf_counter()
+    legacy = [legacy_count(encoding, m) for m in workload]
+    legacy_elapsed = time.perf_counter() - start
+
+    counter = TokenCounter(encoding)
+    start = time.perf_counter()
+    counted = [counter.count_messages(m) for m in workload]
+    counter_elapsed = time.perf_counter() - start
+
+    calls = len(workload)
+    print(f"{'legacy':<14} {legacy_elapsed * 1000 / calls:8.3f} ms/call  (last turn: {legacy[-1]} tokens)")
+    print(f"{'TokenCounter':<14} {counter_elapsed * 1000 / calls:8.3f} ms/call  (last turn: {counted[-1]} tokens)")
+    print(f"speedup {legacy_elapsed / counter_elapsed:.1f}x, {counter.get_metrics()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+ベンチマーク用の偽の Blob Storage(Get Blob だけ)。
+Range(x-ms-range)、If-None-Match / If-Match / If-Modified-Since に Blob Storage と同じステータスで応答し、
+固定の遅延と帯域を模擬して、受け取ったリクエスト数と送った本文のバイト数を数える。
+BlobServiceClient(account_url=fake.url) の匿名アクセスで使う。
+
+    python benchmarks/fakeblob.py --port 10000
+"""
+import re
+import time
+import argparse
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_RANGE = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+class FakeBlobStorage:
+    def __init__(self, latency: float = 0.02, bandwidth: float = 50 * 1024 * 1024, port: int = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.blobs = {}
+        self.requests = {"get": 0, "not_modified": 0}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/account"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def put(self, name: str, data: bytes, content_type: str = "application/pdf"):
+        etag = '"0x' + hashlib.md5(data).hexdigest()[:16].upper() + '"'
+        with self._lock:
+            self.blobs[name] = (data, etag, formatdate(time.time(), usegmt=True), content_type)
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = {"get": 0, "not_modified": 0}
+            self.bytes_sent = 0
+
+    def _count(self, name: str, sent: int = 0):
+        with self._lock:
+            self.requests[name] += 1
+            self.bytes_sent += sent
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, headers: dict, body: bytes = b""):
+                self.send_response(status)
+                for name, value in dict(headers, **{"Content-Length": str(len(body)), "x-ms-version": "2021-08-06"}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if body:
+                    # 帯域の分だけ遅らせてから送る
+                    time.sleep(len(body) / fake.bandwidth)
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                name = self.path.split("?")[0].split("/")[-1]
+                blob = fake.blobs.get(name)
+                if blob is None:
+                    fake._count("get")
+                    return self.reply(404, {"x-ms-error-code": "BlobNotFound"})
+                data, etag, last_modified, content_type = blob
+                if_none_match = self.headers.get("If-None-Match")
+                if_match = self.headers.get("If-Match")
+                if_modified_since = self.headers.get("If-Modified-Since")
+                if if_match and if_match != etag:
+                    fake._count("get")
+                    return self.reply(412, {"x-ms-error-code": "ConditionNotMet"})
+                if (if_none_match and if_none_match == etag) or (
+                        not if_none_match and if_modified_since and parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)):
+                    fake._count("not_modified")
+                    return self.reply(304, {"ETag": etag, "Last-Modified": last_modified})
+
+                headers = {"ETag": etag, "Last-Modified": last_modified, "Content-Type": content_type, "x-ms-blob-type": "BlockBlob"}
+                status = 200
+                body = data
+                match = _RANGE.match(self.headers.get("x-ms-range") or self.headers.get("Range") or "")
+                if match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+                    if start >= len(data):
+                        fake._count("get")
+                        return self.reply(416, {"x-ms-error-code": "InvalidRange"})
+                    body = data[start:end + 1]
+                    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+                    status = 206
+                fake._count("get", len(body))
+                self.reply(status, headers, body)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+    fake = FakeBlobStorage(latency=args.latency, port=args.port)
+    print(f"listening on {fake.url}")
+    fake.server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+ベンチマーク用の偽の Azure OpenAI エンドポイント。
+chat/completions と embeddings に固定の遅延で応答し、受け取ったリクエスト数を数える。
+stream=True の chat/completions には stream_chunks 個のチャンクを stream_interval 秒間隔で返す。
+単体で起動してバックエンドの AZURE_OPENAI_ENDPOINT に指定することもできる。
+
+    python benchmarks/fakeopenai.py --port 8001
+"""
+import re
+import argparse
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+_NUMBERED_LINE = re.compile(r"^\d+\. ", re.MULTILINE)
+
+class FakeOpenAI:
+    def __init__(self, latency: float = 0.3, embedding_dimensions: int = 1536, port: int = 0,
+                 stream_chunks: int = 50, stream_interval: float = 0.05):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.stream_interval = stream_interval
+        self.embedding_dimensions = embedding_dimensions
+        self.requests = {"chat": 0, "embeddings": 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        # openai 0.27 のグローバル設定をこのサーバーに向ける
+        openai.api_type = "azure"
+        openai.api_base = self.url
+        openai.api_version = "2023-05-15"
+        openai.api_key = "fake"
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.requests[name] += 1
+
+    def chat_content(self, messages: list) -> str:
+        question = messages[-1]["content"]
+        count = len(_NUMBERED_LINE.findall(question))
+        if count:
+            return json.dumps([f"タイトル{i + 1}" for i in range(count)], ensure_ascii=False)
+        return "テスト用の応答です。" * 5
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep(fake.latency)
+                if "/embeddings" in self.path:
+                    fake._count("embeddings")
+                    inputs = body.get("input")
+                    inputs = inputs if isinstance(inputs, list) else [inputs]
+                    response = {
+                        "object": "list",
+                        "data": [
+                            {"object": "embedding", "index": i, "embedding": [((hash(t) >> (j % 32)) % 1000) / 1000.0 for j in range(fake.embedding_dimensions)]}
+                            for i, t in enumerate(inputs)
+                        ],
+                        "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}
+                    }
+                elif body.get("stream"):
+                    fake._count("chat")
+                    self._stream((body.get("stream_options") or {}).get("include_usage"))
+                    return
+                else:
+                    fake._count("chat")
+                    content = fake.chat_content(body.get("messages", []))
+                    response = {
+                        "id": "fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+                    }
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, include_usage: bool = False):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i in range(fake.stream_chunks):
+                    chunk = {
+                        "id": "fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "choices": [{"index": 0, "finish_reason": None, "delta": {"content": f"チャンク{i} "}}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(fake.stream_interval)
+                if include_usage:
+                    # stream_options.include_usage を指定した場合は、choices が空で usage だけのチャンクが最後に届く
+                    usage = {"prompt_tokens": 10, "completion_tokens": fake.stream_chunks, "total_tokens": 10 + fake.stream_chunks}
+                    chunk = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "choices": [], "usage": usage}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+    fake = FakeOpenAI(latency=args.latency, port=args.port, stream_chunks=args.chunks, stream_interval=args.interval)
+    print(f"Fake Azure OpenAI listening on {fake.url}")
+    fake.server.serve_forever()
@@ -0,0 +1,156 @@
+"""
+起動時間(import)のプロファイル。
+python -X importtime で app を読み込み、累積時間の大きいモジュールと、パッケージごとの合計を表示する。
+App Service の起動やワーカーの再起動が遅くなっていないかを確認するために使う。
+--baseline を指定すると、その git のリビジョンの src/backend でも同じように計測して比較する。
+import から起動後(start_background / warmup)に移した処理は、それぞれ別のプロセスで計測する。
+
+    cd src/backend
+    python benchmarks/importtime.py --top 30 --baseline <rev> --output benchmarks/importtime_app.txt
+"""
+import os
+import sys
+import time
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ローカルで計測する場合に、import 時に必須の設定が無くて止まらないようにするための値(通信はしない)
+LOCAL_DEFAULTS = {
+    "APPLICATIONINSIGHTS_CONNECTION_STRING": "InstrumentationKey=00000000-0000-0000-0000-000000000000",
+    "AZURE_SEARCH_SERVICE": "localhost",
+    "AZURE_SEARCH_INDEX": "index",
+    "AZURE_STORAGE_ACCOUNT": "localhost",
+    "AZURE_STORAGE_CONTAINER": "content",
+    "AZURE_COSMOSDB_ENDPOINT": "https://localhost:8081/",
+}
+
+# import から起動後に移した処理。import の計測には含まれないので別に計測する
+DEFERRED_STEPS = [
+    ("configure_azure_monitor", "from azure.monitor.opentelemetry import configure_azure_monitor; configure_azure_monitor()"),
+    ("tiktoken encodings", "from core.modelhelper import preload_encodings; preload_encodings()"),
+    ("openai token", "from azure.identity import DefaultAzureCredential; "
+                     "DefaultAzureCredential().get_token('https://cognitiveservices.azure.com/.default')"),
+]
+
+def profile(module: str, env: dict, cwd: str = BACKEND_DIR) -> tuple:
+    started = time.perf_counter()
+    # バックグラウンドの処理は start_background() まで始まらないので、import の計測には含まれない
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=cwd, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return rows, elapsed, result
+
+def error_line(result) -> str:
+    if result.returncode == 0:
+        return ""
+    errors = [line for line in result.stderr.splitlines() if line.strip() and not line.startswith("import time:")]
+    return errors[-1][:160] if errors else "failed"
+
+def package_times(rows: list) -> dict:
+    # パッケージ(先頭の名前)ごとの self 時間の合計
+    packages = defaultdict(int)
+    for name, self_us, _ in rows:
+        packages[name.strip().split(".")[0]] += self_us
+    return packages
+
+def checkout(revision: str, directory: str) -> str:
+    # 指定したリビジョンの src/backend を作業ツリーを変えずに取り出す
+    root = subprocess.run(["git", "rev-parse", "--show-toplevel"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    prefix = os.path.relpath(BACKEND_DIR, root)
+    archive = subprocess.run(["git", "archive", "--format=tar", revision, prefix], cwd=root, capture_output=True, check=True).stdout
+    archive_path = os.path.join(directory, "backend.tar")
+    with open(archive_path, "wb") as f:
+        f.write(archive)
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, prefix)
+
+def measure_deferred(env: dict) -> list:
+    results = []
+    for name, code in DEFERRED_STEPS:
+        started = time.perf_counter()
+        # 終了時に Azure Monitor のエクスポーターが送信を待たないように os._exit で終える
+        result = subprocess.run([sys.executable, "-c", f"{code}; import os; os._exit(0)"],
+                                cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+        results.append((name, time.perf_counter() - started, error_line(result)))
+    return results
+
+def comparison(module: str, baseline: str, current: tuple, previous: tuple, top: int) -> str:
+    rows, elapsed, result = current
+    base_rows, base_elapsed, base_result = previous
+    lines = [f"before/after: {baseline} -> working tree", ""]
+    lines.append(f"{'':<28} {'before':>10} {'after':>10}")
+    lines.append(f"{'process wall time (ms)':<28} {base_elapsed * 1000:10.0f} {elapsed * 1000:10.0f}")
+    lines.append(f"{'modules imported':<28} {len(base_rows):10d} {len(rows):10d}")
+    for label, r in (("before", base_result), ("after", result)):
+        if error_line(r):
+            lines.append(f"{label} import failed: {error_line(r)}")
+
+    before, after = package_times(base_rows), package_times(rows)
+    lines.append("")
+    lines.append(f"top {top} packages by change in self time (ms)")
+    lines.append(f"{'before':>10} {'after':>10} {'change':>10}  package")
+    for package in sorted(set(before) | set(after), key=lambda p: -abs(after.get(p, 0) - before.get(p, 0)))[:top]:
+        b, a = before.get(package, 0) / 1000, after.get(package, 0) / 1000
+        lines.append(f"{b:10.1f} {a:10.1f} {a - b:+10.1f}  {package}")
+    return "\n".join(lines) + "\n"
+
+def deferred_report(results: list) -> str:
+    lines = ["work moved out of import (each step in its own process, includes its imports)"]
+    for name, elapsed, error in results:
+        lines.append(f"{elapsed * 1000:14.0f} ms  {name}" + (f"  (failed: {error})" if error else ""))
+    return "\n".join(lines) + "\n"
+
+def report(module: str, rows: list, elapsed: float, top: int) -> str:
+    lines = [f"python -X importtime -c 'import {module}'", f"process wall time: {elapsed * 1000:.0f} ms", ""]
+
+    lines.append(f"top {top} imports by cumulative time")
+    lines.append(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, self_us, cumulative_us in sorted(rows, key=lambda r: -r[2])[:top]:
+        lines.append(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {name}")
+
+    packages = package_times(rows)
+    lines.append("")
+    lines.append(f"top {top} packages by total self time")
+    for package, self_us in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+        lines.append(f"{self_us / 1000:14.1f}  {package}")
+    return "\n".join(lines) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--baseline", help="比較する git のリビジョン(例: 変更前のコミット)")
+    parser.add_argument("--output", help="結果を書き込むファイル")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    for name, value in LOCAL_DEFAULTS.items():
+        env.setdefault(name, value)
+    rows, elapsed, result = profile(args.module, env)
+    if result.returncode != 0:
+        print(error_line(result) or "import failed", file=sys.stderr)
+    text = report(args.module, rows, elapsed, args.top)
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as directory:
+            previous = profile(args.module, env, checkout(args.baseline, directory))
+        text = comparison(args.module, args.baseline, (rows, elapsed, result), previous, args.top) + "\n" + text
+    text += "\n" + deferred_report(measure_deferred(env))
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+ストリーミング応答の負荷試験。
+/chat に同時に多数のリクエストを送り、最初のチャンクまでの時間(TTFT)と完了までの時間、失敗数を集計する。
+OpenAI の代わりに benchmarks/fakeopenai.py を使うと、モデルの速度に左右されずにサーバー側の同時接続数の上限を測れる。
+
+    cd src/backend
+    python benchmarks/fakeopenai.py --port 8001 --chunks 200 --interval 0.1 &
+    # WSGI (Flask) の場合
+    AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8001 python app.py
+    # ASGI の場合
+    AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8001 uvicorn asgi:application --port 5000
+    python benchmarks/loadtest_streams.py --url http://127.0.0.1:5000 --streams 1000
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+
+def build_request(i: int, model: str) -> dict:
+    return {
+        "history": [{"user": f"負荷試験の質問 {i}"}],
+        "approach": "r",
+        "overrides": {"gptModel": model, "temperature": "0.0", "systemPrompt": ""},
+        "conversationId": f"loadtest-{i}",
+        "timestamp": None,
+        "conversation_title": "loadtest",
+        "loginUser": "loadtest"
+    }
+
+async def open_stream(session: aiohttp.ClientSession, url: str, i: int, model: str) -> tuple:
+    start = time.perf_counter()
+    first_chunk = None
+    async with session.post(f"{url}/chat", json=build_request(i, model)) as response:
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}")
+        async for _ in response.content.iter_any():
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+    return first_chunk, time.perf_counter() - start
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--streams", type=int, default=500, help="同時に開くストリーム数")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    args = parser.parse_args()
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[open_stream(session, args.url, i, args.model) for i in range(args.streams)], return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if not isinstance(r, BaseException)]
+    errors = len(results) - len(ok)
+    ttft = [r[0] for r in ok if r[0] is not None]
+    total = [r[1] for r in ok]
+    print(f"streams : {args.streams} ({errors} failed) in {elapsed:.1f} s")
+    if ok:
+        print(f"TTFT    : p50 {statistics.median(ttft):.2f} s, p99 {percentile(ttft, 0.99):.2f} s")
+        print(f"total   : p50 {statistics.median(total):.2f} s, p99 {percentile(total, 0.99):.2f} s")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# prepdocs.py が登録したファイルごとに更新するマーカー BLOB の接頭辞
+INDEX_VERSION_PREFIX = "index-versions/"
+# どのファイルの回答が変わるか分からない変更(マーカーの無いファイルの削除など)で prepdocs.py が更新する、インデックス全体の版のマーカー BLOB
+INDEX_GLOBAL_VERSION_BLOB = "index-version"
+
+class IndexVersionStore:
+    """
+      prepdocs.py が sourcefile ごとに書き込むマーカー BLOB (index-versions/<sourcefile>) の ETag を、インデックスの版として扱うストア。
+      インデックス全体の版のマーカー (index-version) も読み、各ファイルの版の先頭に加える。
+      一定間隔で一覧を取り直し、追加・更新・削除されたファイルと、全体の版が変わったかどうかを on_change に渡す。
+      Methods:
+          refresh(self): マーカーの一覧を取り直し、変更があれば on_change を呼ぶ。
+          get(self, sourcefiles: list[str]): 全体の版と各ファイルの現在の版を返す。
+          start(self) / stop(self): バックグラウンドでの定期更新を開始・停止する。
+      """
+
+    def __init__(self, container_client, refresh_interval: float = 60, on_change=None):
+        self.container_client = container_client
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self._versions = None
+        self._global_version = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def refresh(self):
+        versions, global_version = {}, None
+        # index-version と index-versions/ の両方を1回の一覧で取得する
+        for blob in self.container_client.list_blobs(name_starts_with=INDEX_GLOBAL_VERSION_BLOB):
+            if blob.name == INDEX_GLOBAL_VERSION_BLOB:
+                global_version = blob.etag
+            elif blob.name.startswith(INDEX_VERSION_PREFIX):
+                versions[blob.name[len(INDEX_VERSION_PREFIX):]] = blob.etag
+        with self._lock:
+            previous, self._versions = self._versions, versions
+            previous_global, self._global_version = self._global_version, global_version
+        if previous is None or self.on_change is None:
+            return
+        added = set(versions) - set(previous)
+        changed = {f for f in previous if previous[f] != versions.get(f)}
+        everything = previous_global != global_version
+        if added or changed or everything:
+            self.on_change(added, changed, everything)
+
+    def get(self, sourcefiles: list[str]) -> tuple:
+        with self._lock:
+            versions = self._versions or {}
+            return (self._global_version,) + tuple(versions.get(f) for f in sourcefiles)
+
+    def known(self, sourcefile: str) -> bool:
+        with self._lock:
+            return self._versions is not None and sourcefile in self._versions
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="index-version-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Index version refresh error: {e}")
+            self._stop.wait(self.refresh_interval)
+
+class AnswerCache:
+    """
+      ChatReadRetrieveRead の回答のキャッシュ。
+      質問文の埋め込みベクトルを正規化して固定サイズの行列に保持し、内積(コサイン類似度)が threshold 以上の質問を同じ質問とみなす。
+      回答の根拠になった sourcefile の版を記録しておき、prepdocs.py がそのファイルを登録し直すと無効にする。
+      新しいファイルが追加された場合や全体の版が変わった場合は、どの回答が変わるか分からないのですべて無効にする。
+      Methods:
+          lookup(self, vector, scope: str): 似た質問の回答があれば (entry, 類似度) を返す。
+          store(self, vector, scope: str, entry: dict, sourcefiles: list[str]): 回答をキャッシュする。
+          invalidate(self, added: set, changed: set, everything: bool): インデックスの変更に合わせてエントリを無効にする。
+          get_metrics(self): ヒット率などを返す。
+      """
+
+    def __init__(self, dimensions: int = 1536, max_entries: int = 1000, threshold: float = 0.95, replace_threshold: float = 0.98,
+                 ttl: int = 24 * 60 * 60, version_store: IndexVersionStore = None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        # 既存の質問とこの値以上に似ている質問は新しい行を使わずに上書きする
+        self.replace_threshold = replace_threshold
+        self.ttl = ttl
+        self.version_store = version_store
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        # 行番号 -> エントリ（古い順）。空いている行は _free に入れて再利用する
+        self._entries = OrderedDict()
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "stored": 0, "replaced": 0, "evicted": 0, "expired": 0, "invalidated": 0}
+
+    @staticmethod
+    def normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _versions(self, sourcefiles: list[str]) -> tuple:
+        return self.version_store.get(sourcefiles) if self.version_store else ()
+
+    def _is_valid(self, entry: dict, now: float) -> bool:
+        return entry["expires"] > now and entry["versions"] == self._versions(entry["sourcefiles"])
+
+    def _release(self, row: int, metric: str):
+        # ロックを取った状態で呼び出す
+        del self._entries[row]
+        self._vectors[row] = 0
+        self._free.append(row)
+        self._metrics[metric] += 1
+
+    def _nearest(self, vector: np.ndarray, scope: str, threshold: float):
+        # ロックを取った状態で呼び出す。類似度の高い順に同じ scope の行を探す
+        scores = self._vectors @ vector
+        for row in np.argsort(-scores):
+            score = float(scores[row])
+            if score < threshold:
+                break
+            entry = self._entries.get(int(row))
+            if entry is not None and entry["scope"] == scope:
+                return int(row), score
+        return None, 0.0
+
+    def lookup(self, vector, scope: str) -> tuple:
+        vector = self.normalize(vector)
+        now = time.time()
+        with self._lock:
+            row, score = self._nearest(vector, scope, self.threshold)
+            if row is not None:
+                entry = self._entries[row]
+                if self._is_valid(entry, now):
+                    self._entries.move_to_end(row)
+                    self._metrics["hits"] += 1
+                    return entry, score
+                self._release(row, "expired")
+            self._metrics["misses"] += 1
+        return None, 0.0
+
+    def store(self, vector, scope: str, entry: dict, sourcefiles: list[str]):
+        vector = self.normalize(vector)
+        entry = dict(entry, scope=scope, sourcefiles=list(sourcefiles),
+                     versions=self._versions(sourcefiles), expires=time.time() + self.ttl)
+        with self._lock:
+            row, _ = self._nearest(vector, scope, self.replace_threshold)
+            if row is not None:
+                self._release(row, "replaced")
+            elif not self._free:
+                self._release(next(iter(self._entries)), "evicted")
+            row = self._free.pop()
+            self._vectors[row] = vector
+            self._entries[row] = entry
+            self._metrics["stored"] += 1
+
+    def invalidate(self, added: set, changed: set, everything: bool = False):
+        with self._lock:
+            for row in list(self._entries.keys()):
+                sourcefiles = self._entries[row]["sourcefiles"]
+                # 版の分からないファイル(インデックスに sourcefile が無い等)を参照する回答も無効にする
+                if everything or added or any(f in changed or not (self.version_store and self.version_store.known(f)) for f in sourcefiles):
+                    self._release(row, "invalidated")
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = round(metrics["hits"] / lookups, 4) if lookups else 0.0
+        return metrics
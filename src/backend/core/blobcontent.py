@@ -0,0 +1,371 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import mimetypes
+import urllib.parse
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
+
+# /content のブラウザーキャッシュの有効期間(秒)。期限が切れた後は ETag で確認する(変わっていなければ 304)
+CONTENT_CACHE_MAX_AGE = int(os.environ.get("CONTENT_CACHE_MAX_AGE", 3600))
+# Blob Storage から1回に読み込む大きさ。ファイルの大きさに関わらず、1つの応答で使うメモリはこの程度に収まる
+CONTENT_CHUNK_SIZE = int(os.environ.get("CONTENT_CHUNK_SIZE", 1024 * 1024))
+# true にすると小さい Blob(prepdocs が分割したページの PDF など)の内容をメモリ(と CONTENT_CACHE_DIR)にキャッシュする
+CONTENT_CACHE_ENABLED = os.environ.get("CONTENT_CACHE_ENABLED", "false").lower() == "true"
+CONTENT_CACHE_MEMORY_BYTES = int(os.environ.get("CONTENT_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+# 指定するとメモリから追い出した内容もディスクに残し、再起動後も使う
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR")
+CONTENT_CACHE_DISK_BYTES = int(os.environ.get("CONTENT_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+# これより大きい Blob はキャッシュせずにストリーミングする
+CONTENT_CACHE_MAX_ITEM_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_ITEM_BYTES", 4 * 1024 * 1024))
+# 最後に確認してからこの秒数を過ぎたエントリは、返す前に ETag で Blob Storage に変わっていないかを確認する(0 なら毎回確認する)
+CONTENT_CACHE_REVALIDATE_AFTER = float(os.environ.get("CONTENT_CACHE_REVALIDATE_AFTER", 60))
+# ダウンロードさせる(ページに表示しない)拡張子
+ATTACHMENT_EXTENSIONS = ["doc", "docs", "xls", "xlsx", "ppt", "pptx"]
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+def parse_range(value: str):
+    # "bytes=start-end" と "bytes=start-" だけを扱う。末尾からの範囲や複数の範囲は無視してファイル全体を返す(RFC 9110 で許されている)
+    if not value:
+        return None
+    match = RANGE_PATTERN.match(value.strip())
+    if not match:
+        return None
+    start = int(match.group(1))
+    if not match.group(2):
+        return start, None
+    end = int(match.group(2))
+    return (start, end - start + 1) if end >= start else None
+
+def parse_etag(value: str):
+    # Blob の ETag は1つなので、複数の ETag が指定された場合は条件を付けない
+    if not value or "," in value:
+        return None
+    value = value.strip()
+    return value[2:] if value.startswith("W/") else value
+
+def content_type(path: str, blob_content_type: str) -> str:
+    if not blob_content_type or blob_content_type == "application/octet-stream":
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return blob_content_type
+
+def content_disposition(path: str) -> str:
+    _, ext = os.path.splitext(path)
+    mode = "attachment" if ext[1:].lower() in ATTACHMENT_EXTENSIONS else "inline"
+    return f"{mode}; filename={urllib.parse.quote(path)}"
+
+class ContentCache:
+    """
+      Blob の内容のキャッシュ。メモリとディスク(任意)の2段の LRU で、それぞれバイト数の上限を超えると最も使われていないものから追い出す。
+      エントリは {"data", "etag", "last_modified", "content_type", "validated"} の dict で、validated は最後に Blob Storage で確認した時刻。
+      ディスクには <パスのハッシュ>.entry の1つのファイルに、1行目にそれ以外(JSON)、続けて内容を保存し、一時ファイルからまとめて置き換える。確認した時刻はディスクのエントリにも記録するが、起動時に読み込んだエントリは最初に使うときに確認する。
+      Methods:
+          get(self, path: str): エントリを返す。メモリ、ディスクの順に探し、無ければ None を返す。
+          put(self, path: str, entry: dict): エントリを保存する。
+          validated(self, path: str, entry: dict): Blob Storage で確認して変わっていなかったことを記録する。
+          remove(self, path: str): エントリを消す。
+          get_metrics(self): ヒット数・ミス数・節約したバイト数などを返す。
+      """
+
+    def __init__(self, memory_bytes: int = CONTENT_CACHE_MEMORY_BYTES, directory: str = None, disk_bytes: int = CONTENT_CACHE_DISK_BYTES,
+                 max_item_bytes: int = CONTENT_CACHE_MAX_ITEM_BYTES, revalidate_after: float = CONTENT_CACHE_REVALIDATE_AFTER):
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.max_item_bytes = max_item_bytes
+        self.revalidate_after = revalidate_after
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "disk_hits": 0, "misses": 0, "revalidated": 0, "changed": 0, "bytes_saved": 0, "evictions": 0, "disk_evictions": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    def _file(self, path: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(path.encode("utf-8")).hexdigest() + ".entry")
+
+    def _load_disk_index(self):
+        # 更新日時の古い順に並べて LRU の順序を復元する
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".entry"):
+                continue
+            file_path = os.path.join(self.directory, name)
+            try:
+                with open(file_path, "rb") as f:
+                    meta = json.loads(f.readline())
+                entries.append((os.path.getmtime(file_path), meta["path"], meta["size"]))
+            except Exception as e:
+                print(f"Error in content cache index: {str(e)}")
+        for _, path, size in sorted(entries):
+            self._disk[path] = [size, 0]
+            self._disk_used += size
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self._metrics[name] += value
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["validated"] < self.revalidate_after
+
+    def get(self, path: str):
+        with self._lock:
+            entry = self._memory.get(path)
+            if entry is not None:
+                self._memory.move_to_end(path)
+                self._metrics["hits"] += 1
+                return entry
+            on_disk = self._disk.get(path)
+            if on_disk:
+                self._disk.move_to_end(path)
+        entry = self._read_disk(path, on_disk[1]) if on_disk else None
+        with self._lock:
+            if entry is None:
+                self._metrics["misses"] += 1
+                return None
+            self._metrics["disk_hits"] += 1
+            self._remember(path, entry)
+        return entry
+
+    def _read_disk(self, path: str, validated: float):
+        try:
+            # メタデータと内容は同じファイルなので、書き換えと重なっても組み合わせがずれることは無い
+            file_path = self._file(path)
+            with open(file_path, "rb") as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+            if meta["path"] != path or len(data) != meta["size"]:
+                raise ValueError(f"incomplete cache entry for {path}")
+            os.utime(file_path)
+            return {"data": data, "etag": meta["etag"], "last_modified": meta["last_modified"], "content_type": meta["content_type"], "validated": validated}
+        except Exception as e:
+            print(f"Error in content cache read: {str(e)}")
+            with self._lock:
+                self._drop_disk(path)
+            return None
+
+    def _remember(self, path: str, entry: dict):
+        # ロックを取った状態で呼び出す
+        previous = self._memory.pop(path, None)
+        if previous is not None:
+            self._memory_used -= len(previous["data"])
+        self._memory[path] = entry
+        self._memory_used += len(entry["data"])
+        while self._memory_used > self.memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted["data"])
+            self._metrics["evictions"] += 1
+
+    def _drop_disk(self, path: str):
+        # ロックを取った状態で呼び出す
+        item = self._disk.pop(path, None)
+        if item is None:
+            return
+        self._disk_used -= item[0]
+        try:
+            os.remove(self._file(path))
+        except FileNotFoundError:
+            pass
+
+    def put(self, path: str, entry: dict):
+        if len(entry["data"]) > self.max_item_bytes:
+            return
+        with self._lock:
+            self._remember(path, entry)
+        if not self.directory:
+            return
+        try:
+            # 書き込み中の内容を読まないように、一時ファイルに書いてから置き換える。
+            # 同じページを同時に書く場合があるので、一時ファイルの名前はスレッドごとに分ける
+            file_path = self._file(path)
+            tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+            meta = {"path": path, "size": len(entry["data"]), "etag": entry["etag"], "last_modified": entry["last_modified"], "content_type": entry["content_type"]}
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta).encode("utf-8") + b"\n")
+                f.write(entry["data"])
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            print(f"Error in content cache write: {str(e)}")
+            return
+        with self._lock:
+            item = self._disk.pop(path, None)
+            if item is not None:
+                self._disk_used -= item[0]
+            self._disk[path] = [len(entry["data"]), entry["validated"]]
+            self._disk_used += len(entry["data"])
+            while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+                self._drop_disk(next(iter(self._disk)))
+                self._metrics["disk_evictions"] += 1
+
+    def validated(self, path: str, entry: dict):
+        entry["validated"] = time.time()
+        with self._lock:
+            self._metrics["revalidated"] += 1
+            item = self._disk.get(path)
+            if item is not None:
+                item[1] = entry["validated"]
+
+    def remove(self, path: str):
+        with self._lock:
+            entry = self._memory.pop(path, None)
+            if entry is not None:
+                self._memory_used -= len(entry["data"])
+            if self.directory:
+                self._drop_disk(path)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics.update({"entries": len(self._memory), "memory_bytes": self._memory_used,
+                            "disk_entries": len(self._disk), "disk_bytes": self._disk_used})
+        lookups = metrics["hits"] + metrics["disk_hits"] + metrics["misses"]
+        metrics["hit_rate"] = round((lookups - metrics["misses"]) / lookups, 4) if lookups else 0.0
+        return metrics
+
+class BlobContentProxy:
+    """
+      Blob Storage のファイルをブラウザーに返すプロキシ。
+      1回のダウンロード要求でプロパティと最初のチャンクを受け取り、残りは CONTENT_CHUNK_SIZE ごとに読みながら返すので、ファイル全体をメモリに載せない。
+      Range(206)、ETag / Last-Modified / Cache-Control、条件付きリクエスト(304)に対応する。条件の判定は Blob Storage に任せる。
+      cache(ContentCache)を指定すると、Range 無しで取得した小さい Blob の内容をキャッシュし、ETag で確認してから返す。
+      Methods:
+          get(self, path: str, range_header: str, if_none_match: str, if_modified_since): (ステータス, ヘッダー, 本文のイテレータ) を返す。
+      """
+
+    def __init__(self, container_client, max_age: int = CONTENT_CACHE_MAX_AGE, cache: ContentCache = None):
+        self.container_client = container_client
+        self.max_age = max_age
+        self.cache = cache
+
+    def cache_headers(self, etag: str) -> dict:
+        return {"ETag": etag, "Cache-Control": f"private, max-age={self.max_age}"}
+
+    def get(self, path: str, range_header: str = None, if_none_match: str = None, if_modified_since = None) -> tuple:
+        if self.cache is not None:
+            cached = self.cache.get(path)
+            entry = self.revalidate(path, cached) if cached is not None else None
+            if entry is not None:
+                # Blob が変わっていて読み直した場合は節約したバイト数に数えない
+                return self.from_entry(path, entry, range_header, if_none_match, if_modified_since, saved=entry is cached)
+        requested = parse_range(range_header)
+        offset, length = requested if requested else (None, None)
+        conditions = {}
+        etag = parse_etag(if_none_match)
+        if etag:
+            conditions = {"etag": etag, "match_condition": MatchConditions.IfModified}
+        elif if_modified_since and not if_none_match:
+            conditions = {"if_modified_since": if_modified_since}
+
+        blob = self.container_client.get_blob_client(path)
+        try:
+            downloader = blob.download_blob(offset=offset, length=length, **conditions)
+        except HttpResponseError as e:
+            # 304 は ResourceNotModifiedError ではなく HttpResponseError になる場合があるので、ステータスで判定する
+            if e.status_code == 304:
+                return 304, self.cache_headers(etag) if etag else {"Cache-Control": f"private, max-age={self.max_age}"}, []
+            if e.status_code == 404:
+                return 404, {"Content-Type": "text/plain"}, [b"Not Found"]
+            if e.status_code == 416:
+                # ファイルの外の範囲。まれなのでこの場合だけ大きさを問い合わせる
+                return 416, {"Content-Range": f"bytes */{blob.get_blob_properties().size}"}, []
+            raise
+
+        properties = downloader.properties
+        headers = self.cache_headers(properties.etag)
+        headers.update({
+            "Content-Type": content_type(path, properties.content_settings.content_type),
+            "Content-Disposition": content_disposition(path),
+            "Content-Length": str(downloader.size),
+            "Accept-Ranges": "bytes",
+        })
+        if properties.last_modified:
+            headers["Last-Modified"] = format_datetime(properties.last_modified, usegmt=True)
+        # Range 無しで取得した小さい Blob はすべて読み込んでキャッシュする(Blob Storage 側で条件を判定済みなので 200 になる)
+        if self.cache is not None and not requested and downloader.size <= self.cache.max_item_bytes:
+            entry = self.entry_from(downloader)
+            self.cache.put(path, entry)
+            return self.from_entry(path, entry, None, None, None, saved=False)
+        status = 200
+        if requested:
+            status = 206
+            total = properties.content_range.split("/")[-1] if properties.content_range else "*"
+            headers["Content-Range"] = f"bytes {offset}-{offset + downloader.size - 1}/{total}"
+        return status, headers, self.stream(path, downloader)
+
+    def entry_from(self, downloader) -> dict:
+        properties = downloader.properties
+        return {"data": downloader.readall(), "etag": properties.etag,
+                "last_modified": format_datetime(properties.last_modified, usegmt=True) if properties.last_modified else None,
+                "content_type": properties.content_settings.content_type, "validated": time.time()}
+
+    def revalidate(self, path: str, entry: dict):
+        # 確認してから時間が経っていれば、キャッシュの ETag を条件にして Blob Storage に問い合わせる。変わっていなければ 304 で本文は送られない
+        if self.cache.is_fresh(entry):
+            return entry
+        try:
+            downloader = self.container_client.get_blob_client(path).download_blob(etag=entry["etag"], match_condition=MatchConditions.IfModified)
+        except HttpResponseError as e:
+            if e.status_code == 304:
+                self.cache.validated(path, entry)
+                return entry
+            if e.status_code == 404:
+                self.cache.remove(path)
+                return None
+            raise
+        self.cache.count("changed")
+        if downloader.size > self.cache.max_item_bytes:
+            self.cache.remove(path)
+            return None
+        entry = self.entry_from(downloader)
+        self.cache.put(path, entry)
+        return entry
+
+    def from_entry(self, path: str, entry: dict, range_header: str, if_none_match: str, if_modified_since, saved: bool = True) -> tuple:
+        # Blob Storage に問い合わせる場合と同じく、If-None-Match があればそれだけで判定する
+        data = entry["data"]
+        headers = self.cache_headers(entry["etag"])
+        if if_none_match:
+            if parse_etag(if_none_match) == entry["etag"]:
+                return 304, headers, []
+        elif if_modified_since and entry["last_modified"] and parsedate_to_datetime(entry["last_modified"]) <= if_modified_since:
+            return 304, headers, []
+        requested = parse_range(range_header)
+        if requested and requested[0] >= len(data):
+            return 416, {"Content-Range": f"bytes */{len(data)}"}, []
+        headers.update({
+            "Content-Type": content_type(path, entry["content_type"]),
+            "Content-Disposition": content_disposition(path),
+            "Accept-Ranges": "bytes",
+        })
+        if entry["last_modified"]:
+            headers["Last-Modified"] = entry["last_modified"]
+        status = 200
+        if requested:
+            start, length = requested
+            end = len(data) if length is None else min(len(data), start + length)
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(data)}"
+            data = data[start:end]
+            status = 206
+        headers["Content-Length"] = str(len(data))
+        if saved:
+            self.cache.count("bytes_saved", len(data))
+        return status, headers, [data]
+
+    def stream(self, path: str, downloader):
+        # ヘッダーを送った後のエラーはステータスを変えられないので、ログに残して応答を打ち切る
+        try:
+            for chunk in downloader.chunks():
+                yield chunk
+        except Exception as e:
+            print(f"Error in content stream for {path}: {str(e)}")
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+
+# 接続プールの設定
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", 10))          # プールを保持するホスト数
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 50))      # ホストあたりの最大接続数
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 120))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 60))
+
+_session = None
+_session_lock = threading.Lock()
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+      タイムアウトが指定されていないリクエストに既定のタイムアウトを付けるアダプター。
+      """
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        return super().send(request, timeout=timeout, **kwargs)
+
+def get_session() -> requests.Session:
+    """
+    アプリ全体で共有する requests.Session を返す。
+    OpenAI(0.27)、Cognitive Search、Blob Storage、Cosmos DB、JWKS の取得はすべてこのセッションの
+    接続プールを使うので、同じホストへの TLS ハンドシェイクはプールが空のときにしか発生しない。
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = TimeoutHTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def azure_transport() -> RequestsTransport:
+    # Azure SDK のクライアントに渡すトランスポート。セッションは共有なのでクライアント側では閉じない
+    return RequestsTransport(session=get_session(), session_owner=False,
+                             connection_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT)
+
+def create_aiohttp_session():
+    # ASGI で使う OpenAI の非同期呼び出し用のセッション。イベントループ上で呼び出すこと
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_HOSTS * HTTP_POOL_MAXSIZE, limit_per_host=HTTP_POOL_MAXSIZE,
+                                     keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def prewarm(urls: list[str]):
+    """
+    起動時に各サービスへの接続を開いてプールに入れておく。応答の内容やステータスは問わない。
+    起動を遅らせないようにバックグラウンドで実行する。
+    """
+    def warm(url):
+        try:
+            get_session().head(url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_CONNECT_TIMEOUT))
+        except Exception as e:
+            print(f"Prewarm failed for {url}: {e}")
+
+    for url in urls:
+        if url:
+            threading.Thread(target=warm, args=(url,), name="http-prewarm", daemon=True).start()
+
+def get_pool_stats() -> list[dict]:
+    # ホストごとの接続プールの利用状況
+    stats = []
+    if _session is None:
+        return stats
+    seen = set()
+    for adapter in _session.adapters.values():
+        if id(adapter) in seen or not hasattr(adapter, "poolmanager"):
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # urllib3 のプールは空きスロットを None で埋めているので、None 以外が待機中の接続
+            slots = list(pool.pool.queue)
+            stats.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "maxsize": pool.pool.maxsize,
+                "in_use": pool.pool.maxsize - len(slots),
+                "idle": sum(1 for conn in slots if conn is not None),
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            })
+    return stats
+
+class LazyClient:
+    """
+      最初に属性が参照されたときに factory() でクライアントを作るプロキシ。
+      CosmosClient のようにコンストラクターで通信するクライアントの作成を、起動時ではなく最初の利用時まで遅らせる。
+      """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import openai
+
+from core.usage import usage_totals
+
+AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT")
+# true にするとトークン数の上限に収まらない古い履歴を要約してプロンプトに含める
+HISTORY_SUMMARY_ENABLED = os.environ.get("HISTORY_SUMMARY_ENABLED", "false").lower() == "true"
+HISTORY_SUMMARY_CACHE_SIZE = int(os.environ.get("HISTORY_SUMMARY_CACHE_SIZE", 1000))
+
+class HistorySummarizer:
+    """
+      プロンプトに入りきらない古い会話履歴の要約サービス。
+      要約は会話の先頭からのターンをキーに保持し、ターンが増えたら前回の要約と新しく溢れたターンから次の要約を作る(ローリング要約)。
+      要約の生成はバックグラウンドで行い、get_summary() は生成済みの要約だけを返すので応答が要約の生成を待つことは無い。
+      生成中は先頭から一部のターンだけの要約を返すことがあるので、要約が何ターン分かも一緒に返す。
+      Methods:
+          get_summary(self, turns: list[dict]): 生成済みの要約とそれが先頭から何ターン分かを返し、足りない分の要約の生成を予約する。
+          summarize(self, previous: str, turns: list[dict]): 前回の要約と続きのターンから要約を作る。
+          get_metrics(self): ヒット数・生成回数などを返す。
+      """
+
+    system_prompt_for_summary = """Summarize the conversation between the user and the assistant below in the customer's language.
+Keep facts, names, numbers, decisions and any unanswered questions. Do not add information that is not in the conversation.
+If a previous summary is given, merge it with the new turns into a single summary of no more than 400 words."""
+
+    def __init__(self, deployment: str, max_entries: int = 1000, workers: int = 2, max_tokens: int = 512):
+        self.deployment = deployment
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-summary")
+        self._metrics = {"hits": 0, "partial_hits": 0, "misses": 0, "generated": 0, "failed": 0}
+
+    @staticmethod
+    def prefix_keys(turns: list[dict]) -> list[str]:
+        # keys[i] は turns[:i + 1] を表すキー。前のキーに次のターンを連結してハッシュするので全体で線形時間
+        keys = []
+        digest = b""
+        for turn in turns:
+            payload = json.dumps([turn.get("user"), turn.get("assistant")], ensure_ascii=False).encode("utf-8")
+            digest = hashlib.sha256(digest + payload).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def get_summary(self, turns: list[dict]) -> tuple:
+        if not turns:
+            return None, 0
+        keys = self.prefix_keys(turns)
+        with self._lock:
+            covered = -1
+            for i in range(len(keys) - 1, -1, -1):
+                if keys[i] in self._entries:
+                    covered = i
+                    break
+            summary = self._entries[keys[covered]] if covered >= 0 else None
+            if covered >= 0:
+                self._entries.move_to_end(keys[covered])
+            if covered == len(keys) - 1:
+                self._metrics["hits"] += 1
+                return summary, covered + 1
+            self._metrics["partial_hits" if summary else "misses"] += 1
+            if keys[-1] in self._pending:
+                return summary, covered + 1
+            self._pending.add(keys[-1])
+        self._executor.submit(self._generate, keys[-1], summary, turns[covered + 1:])
+        return summary, covered + 1
+
+    def _generate(self, key: str, previous: str, turns: list[dict]):
+        try:
+            summary = self.summarize(previous, turns)
+        except Exception as e:
+            print(f"Error in history summary: {str(e)}")
+            summary = None
+        with self._lock:
+            self._pending.discard(key)
+            if not summary:
+                self._metrics["failed"] += 1
+                return
+            self._metrics["generated"] += 1
+            self._entries[key] = summary
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def summarize(self, previous: str, turns: list[dict]) -> str:
+        conversation = "\n".join(f"{role}: {turn[key]}" for turn in turns for role, key in (("User", "user"), ("Assistant", "assistant")) if turn.get(key))
+        content = f"Previous summary:\n{previous}\n\nNew turns:\n{conversation}" if previous else f"Conversation:\n{conversation}"
+        completion = openai.ChatCompletion.create(
+            engine=self.deployment,
+            messages=[{"role": "system", "content": self.system_prompt_for_summary}, {"role": "user", "content": content}],
+            temperature=0.0,
+            max_tokens=self.max_tokens,
+            n=1)
+        usage_totals.add("summary", completion.get("usage") or {})
+        return completion.choices[0]["message"]["content"].strip()
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+            metrics["pending"] = len(self._pending)
+        return metrics
+
+history_summarizer = HistorySummarizer(AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT, max_entries=HISTORY_SUMMARY_CACHE_SIZE) if HISTORY_SUMMARY_ENABLED else None
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import re
+import time
+import hashlib
+import threading
+import jwt
+import jwt.algorithms
+import requests
+
+OPENID_CONFIGURATION_URL = "https://login.microsoftonline.com/common/v2.0/.well-known/openid-configuration"
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+MIN_REFRESH_INTERVAL_SECONDS = 5 * 60
+TOKEN_CACHE_MAX_ENTRIES = 10000
+# 最小間隔内でも1回は再取得を試す未知の kid の数の上限(でたらめな kid を大量に送られても際限なく覚えない)
+TRIED_KIDS_MAX_ENTRIES = 1000
+# 未知の kid による強制的な再取得の間隔の下限(kid に関係なく全体で)。間隔内の未知の kid は取得せずに拒否する
+FORCED_REFRESH_INTERVAL_SECONDS = 10
+
+_MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+class JwksKeyStore:
+    """
+      IDトークン検証用の公開鍵ストア。
+      OpenID構成とJWKSを毎リクエスト取得する代わりに、パース済みの公開鍵を kid ごとに保持し、
+      Cache-Control(max-age) と ETag に従ってバックグラウンドで更新する。
+      未知の kid を受け取った場合はその場で再取得する(MIN_REFRESH_INTERVAL_SECONDS に1回まで。ただし初めて見る kid は間隔内でも1回だけ取得する)。
+      初めて見る kid による再取得も全体で FORCED_REFRESH_INTERVAL_SECONDS に1回までにし、でたらめな kid のトークンで外部への取得を繰り返させない。
+      検証済みトークンは audience とトークンのハッシュをキーにして exp まで保持する。
+      Methods:
+          get_key(self, kid: str): kid に対応する公開鍵を返す。
+          validate(self, token: str, audience: str): トークンを検証してクレームを返す。
+          start(self): バックグラウンド更新スレッドを開始する。
+      """
+
+    def __init__(self, openid_configuration_url: str = OPENID_CONFIGURATION_URL, session: requests.Session = None,
+                 default_ttl: int = DEFAULT_TTL_SECONDS, min_refresh_interval: int = MIN_REFRESH_INTERVAL_SECONDS,
+                 timeout: float = 10.0, forced_refresh_interval: float = FORCED_REFRESH_INTERVAL_SECONDS):
+        self.openid_configuration_url = openid_configuration_url
+        self.session = session or requests.Session()
+        self.default_ttl = default_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.forced_refresh_interval = forced_refresh_interval
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._keys = {}
+        self._jwks_uri = None
+        self._etag = None
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._last_forced = 0.0
+        self._tokens = {}
+        self._tried_kids = set()
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ---- 公開鍵 ----
+
+    def _fetch_jwks_uri(self) -> str:
+        if self._jwks_uri is None:
+            response = self.session.get(self.openid_configuration_url, timeout=self.timeout)
+            response.raise_for_status()
+            self._jwks_uri = response.json()["jwks_uri"]
+        return self._jwks_uri
+
+    def _ttl_from_headers(self, headers) -> int:
+        match = _MAX_AGE_PATTERN.search(headers.get("Cache-Control", ""))
+        return int(match.group(1)) if match else self.default_ttl
+
+    def refresh(self, force: bool = False) -> bool:
+        # 同時に複数のリクエストが未知の kid を受け取っても取得は1回だけにする
+        with self._refresh_lock:
+            now = time.time()
+            if not force and now - self._last_fetch < self.min_refresh_interval:
+                return False
+            headers = {"If-None-Match": self._etag} if self._etag else {}
+            response = self.session.get(self._fetch_jwks_uri(), headers=headers, timeout=self.timeout)
+            self._last_fetch = now
+            ttl = self._ttl_from_headers(response.headers)
+            if response.status_code == 304:
+                # 鍵セットは変わっていないので有効期限だけ延ばす
+                self._expires_at = now + ttl
+                return False
+            response.raise_for_status()
+
+            keys = {}
+            for key in response.json()["keys"]:
+                if key.get("kty") != "RSA" or "kid" not in key:
+                    continue
+                keys[key["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(key)
+            with self._lock:
+                self._keys = keys
+                self._etag = response.headers.get("ETag")
+                self._expires_at = now + ttl
+            return True
+
+    def get_key(self, kid: str):
+        if not self._keys or time.time() >= self._expires_at:
+            self.refresh(force=not self._keys)
+        key = self._keys.get(kid)
+        if key is None:
+            # 鍵のローテーション直後は未知の kid が来るので再取得する。直前に取得していても、初めて見る kid なら1回は取得する。
+            # ただし強制的な取得は kid に関係なく forced_refresh_interval に1回までで、間隔内の kid は試したことにしない
+            with self._lock:
+                now = time.time()
+                force = kid not in self._tried_kids and now - self._last_forced >= self.forced_refresh_interval
+                if force:
+                    if len(self._tried_kids) >= TRIED_KIDS_MAX_ENTRIES:
+                        self._tried_kids.clear()
+                    self._tried_kids.add(kid)
+                    self._last_forced = now
+            self.refresh(force=force)
+            key = self._keys.get(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Unknown kid: {kid}")
+        return key
+
+    # ---- トークン ----
+
+    def validate(self, token: str, audience: str) -> dict:
+        # 同じトークンでも audience が違えば検証結果が変わるので、キーに含める
+        token_hash = hashlib.sha256(f"{audience}\n{token}".encode("utf-8")).hexdigest()
+        now = time.time()
+        cached = self._tokens.get(token_hash)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        header = jwt.get_unverified_header(token)
+        public_key = self.get_key(header["kid"])
+        decoded_token = jwt.decode(
+            token,
+            public_key,
+            audience=audience,
+            algorithms=["RS256"]
+        )
+
+        expires_at = decoded_token.get("exp")
+        if expires_at:
+            with self._lock:
+                if len(self._tokens) >= TOKEN_CACHE_MAX_ENTRIES:
+                    self._evict_expired_tokens(now)
+                self._tokens[token_hash] = (float(expires_at), decoded_token)
+        return decoded_token
+
+    def _evict_expired_tokens(self, now: float):
+        self._tokens = {k: v for k, v in self._tokens.items() if v[0] > now}
+        if len(self._tokens) >= TOKEN_CACHE_MAX_ENTRIES:
+            self._tokens.clear()
+
+    # ---- バックグラウンド更新 ----
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="jwks-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh(force=True)
+            except Exception as e:
+                print(f"JWKS refresh error: {e}")
+            # 有効期限の少し前に更新する。取得に失敗した場合は最小間隔で再試行する
+            wait = max(self.min_refresh_interval, (self._expires_at - time.time()) * 0.9)
+            with self._lock:
+                self._evict_expired_tokens(time.time())
+            self._stop.wait(wait)
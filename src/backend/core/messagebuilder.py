@@ -1,3 +1,12 @@
+import os
+
+from core.modelhelper import get_gpt_model, get_token_counter, TOKENS_PER_REPLY
+
+# 応答用に残しておくトークン数。履歴はモデルの上限からこの分を引いた範囲に収める
+RESPONSE_TOKEN_RESERVE = int(os.environ.get("RESPONSE_TOKEN_RESERVE", 1024))
+# 要約メッセージの前置きとメッセージ自体の分
+SUMMARY_TOKEN_OVERHEAD = 16
+
 class MessageBuilder:
     """
       A class for building and managing messages in a chat conversation.
@@ -6,8 +15,9 @@ class MessageBuilder:
           model (str): The name of the ChatGPT model.
           token_count (int): The total number of tokens in the conversation.
       Methods:
-          __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
+          __init__(self, system_content: str, chatgpt_model: str, summarizer, response_reserve: int): Initializes the MessageBuilder instance.
           append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+          get_messages_from_history(self, history: list, user_conv: str, few_shots: list): Builds the messages, newest history first within the token budget of the model.
       """
 
     # Chat roles
@@ -15,27 +25,69 @@ class MessageBuilder:
     USER = "user"
     ASSISTANT = "assistant"
 
-    def __init__(self, system_content: str):
+    def __init__(self, system_content: str, chatgpt_model: str = None, summarizer = None, response_reserve: int = RESPONSE_TOKEN_RESERVE):
         self.messages = [{'role': 'system', 'content': system_content}]
+        # model を指定した場合だけ、モデルのトークン数の上限に合わせて履歴を切り詰める
+        self.model = chatgpt_model
+        self.summarizer = summarizer
+        self.response_reserve = response_reserve
+        self.token_count = 0
 
     def append_message(self, role: str, content: str, index: int = 1):
         self.messages.insert(index, {'role': role, 'content': content})
 
+    def get_history_budget(self, counter, fixed_messages: list) -> int:
+        if self.model is None:
+            return None
+        max_tokens = get_gpt_model(self.model).get("max_tokens")
+        return max(0, max_tokens - self.response_reserve - counter.count_messages(fixed_messages))
+
+    def select_turns(self, counter, past_turns: list, budget: int) -> tuple:
+        # 新しいターンから予算に収まるだけ選ぶ（選んだ順に追加して最後に1回だけ反転する）
+        selected = []
+        kept = 0
+        used = 0
+        for h in reversed(past_turns):
+            turn = []
+            if bot_msg := h.get(self.ASSISTANT):
+                turn.append({'role': self.ASSISTANT, 'content': bot_msg})
+            if user_msg := h.get(self.USER):
+                turn.append({'role': self.USER, 'content': user_msg})
+            if budget is not None:
+                cost = counter.count_messages(turn) - TOKENS_PER_REPLY
+                if used + cost > budget:
+                    break
+                used += cost
+            selected.extend(turn)
+            kept += 1
+        selected.reverse()
+        return selected, kept, used
+
     def get_messages_from_history(self, history: list[dict[str, str]], user_conv: str, few_shots = []) -> list:
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in few_shots:
-            self.append_message(shot.get('role'), shot.get('content'))
-
-        user_content = user_conv
-        append_index = len(few_shots) + 1
+        head = self.messages + [{'role': shot.get('role'), 'content': shot.get('content')} for shot in few_shots]
+        user_message = {'role': self.USER, 'content': user_conv}
 
-        self.append_message(self.USER, user_content, index=append_index)
+        counter = get_token_counter(self.model) if self.model else None
+        budget = self.get_history_budget(counter, head + [user_message])
+        past_turns = history[:-1]
+        selected, kept, used = self.select_turns(counter, past_turns, budget)
 
-        for h in reversed(history[:-1]):
-            if bot_msg := h.get(self.ASSISTANT):
-                self.append_message(self.ASSISTANT, bot_msg, index=append_index)
-            if user_msg := h.get(self.USER):
-                self.append_message(self.USER, user_msg, index=append_index)
+        # 収まらなかった古いターンは、要約があれば1件のメッセージにまとめて入れる。要約の分の余裕を空けて選び直し、
+        # 外したターンちょうどの要約がまだ無い(バックグラウンドで生成中の)場合は、間のターンが抜けないよう選び直す前の履歴をそのまま使う
+        summary_messages = []
+        if kept < len(past_turns) and self.summarizer is not None:
+            shrunk, shrunk_kept, shrunk_used = self.select_turns(counter, past_turns, max(0, budget - self.summarizer.max_tokens - SUMMARY_TOKEN_OVERHEAD))
+            dropped = len(past_turns) - shrunk_kept
+            summary, covered = self.summarizer.get_summary(past_turns[:dropped])
+            if summary and covered == dropped:
+                summary_message = {'role': self.SYSTEM, 'content': "Summary of the earlier conversation:\n" + summary}
+                if shrunk_used + counter.count_message(summary_message) <= budget:
+                    selected, kept, used = shrunk, shrunk_kept, shrunk_used
+                    summary_messages.append(summary_message)
 
+        self.messages = head + summary_messages + selected + [user_message]
+        if counter is not None:
+            self.token_count = counter.count_messages(self.messages)
         messages = self.messages
         return messages
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import os
-import json
-import tiktoken
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
 
 AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT")
 AZURE_OPENAI_GPT_35_TURBO_16K_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_35_TURBO_16K_DEPLOYMENT")
@@ -11,36 +13,37 @@ AZURE_OPENAI_GPT_4_32K_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_4_32K_DEPLO
 AZURE_OPENAI_GPT_4O_MINI_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_4O_MINI_DEPLOYMENT")
 AZURE_OPENAI_GPT_4O_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_4O_DEPLOYMENT")
 
+# encoding_model は tiktoken でエンコーディングを選ぶためのモデル名。エンコーダーは最初に使うときに読み込む
 gpt_models = {
     "gpt-3.5-turbo": {
         "deployment": AZURE_OPENAI_GPT_35_TURBO_DEPLOYMENT,
         "max_tokens": 4096,
-        "encoding": tiktoken.encoding_for_model("gpt-3.5-turbo")
+        "encoding_model": "gpt-3.5-turbo"
     },
     "gpt-3.5-turbo-16k": {
         "deployment": AZURE_OPENAI_GPT_35_TURBO_16K_DEPLOYMENT,
         "max_tokens": 16384,
-        "encoding": tiktoken.encoding_for_model("gpt-3.5-turbo")
+        "encoding_model": "gpt-3.5-turbo"
     },
     "gpt-4": {
         "deployment": AZURE_OPENAI_GPT_4_DEPLOYMENT,
         "max_tokens": 8192,
-        "encoding": tiktoken.encoding_for_model("gpt-4")
+        "encoding_model": "gpt-4"
     },
     "gpt-4-32k": {
         "deployment": AZURE_OPENAI_GPT_4_32K_DEPLOYMENT,
         "max_tokens": 32768,
-        "encoding": tiktoken.encoding_for_model("gpt-4-32k")
+        "encoding_model": "gpt-4-32k"
     },
     "gpt-4o-mini": {
         "deployment": AZURE_OPENAI_GPT_4O_MINI_DEPLOYMENT,
         "max_tokens": 16384,
-        "encoding": tiktoken.encoding_for_model("gpt-4o-mini")
+        "encoding_model": "gpt-4o-mini"
     },
     "gpt-4o": {
         "deployment": AZURE_OPENAI_GPT_4O_DEPLOYMENT,
         "max_tokens": 4096,
-        "encoding": tiktoken.encoding_for_model("gpt-4o")
+        "encoding_model": "gpt-4o"
     }
 }
 
@@ -94,17 +97,132 @@ gpt_models = {
 #         raise ValueError(message)
 #     return AOAI_2_OAI.get(aoaimodel) or aoaimodel
 
+# チャット形式のトークン数の計算（OpenAI の num_tokens_from_messages と同じ数え方）
+TOKENS_PER_MESSAGE = 3  # メッセージごとの <|start|>{role}<|message|>...<|end|>
+TOKENS_PER_NAME = 1     # name を指定したメッセージの追加分
+TOKENS_PER_REPLY = 3    # 応答の先頭に付く <|start|>assistant<|message|>
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+
+class TokenCounter:
+    """
+      チャット形式のメッセージのトークン数を数えるクラス。
+      文字列ごとのトークン数をハッシュをキーにした LRU に保持するので、会話が続いても新しいターンだけをエンコードすれば済む。
+      Methods:
+          count_text(self, text: str): 文字列のトークン数を返す。
+          count_message(self, message: dict): 1件のメッセージのトークン数を返す。
+          count_messages(self, messages: list[dict]): 応答の先頭分を含めたメッセージ全体のトークン数を返す。
+          get_metrics(self): ヒット数・ミス数などを返す。
+      """
+
+    def __init__(self, encoding, max_entries: int = 10000):
+        self.encoding = encoding
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _count_many(self, texts: list[str]) -> list[int]:
+        keys = [self.make_key(t) if t else None for t in texts]
+        counts = [0] * len(texts)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key is None:
+                    continue
+                count = self._entries.get(key)
+                if count is None:
+                    missing.append(i)
+                else:
+                    self._entries.move_to_end(key)
+                    counts[i] = count
+            self._metrics["hits"] += sum(1 for k in keys if k is not None) - len(missing)
+        if not missing:
+            return counts
+        # エンコードはロックの外で行う（同じ文字列を同時にエンコードしても結果は同じ）
+        for i in missing:
+            counts[i] = len(self.encoding.encode(texts[i], disallowed_special=()))
+        with self._lock:
+            self._metrics["misses"] += len(missing)
+            for i in missing:
+                self._entries[keys[i]] = counts[i]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return counts
+
+    def count_text(self, text: str) -> int:
+        return self._count_many([text])[0]
+
+    def count_message(self, message: dict) -> int:
+        return self.count_messages([message]) - TOKENS_PER_REPLY
+
+    def count_messages(self, messages: list[dict]) -> int:
+        texts = []
+        tokens = TOKENS_PER_REPLY
+        for message in messages:
+            tokens += TOKENS_PER_MESSAGE
+            for key, value in message.items():
+                texts.append(value)
+                if key == "name":
+                    tokens += TOKENS_PER_NAME
+        return tokens + sum(self._count_many(texts))
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = round(metrics["hits"] / lookups, 4) if lookups else 0.0
+        return metrics
+
+# エンコーディング名ごとの TokenCounter
+token_counters = {}
+token_counters_lock = threading.Lock()
+
 def get_gpt_model(model_name: str) -> dict:
     return gpt_models.get(model_name)
 
-def get_max_token_from_messages(messages: dict[str, str], model: str) -> int:
+@functools.lru_cache(maxsize=None)
+def _load_encoding(encoding_model: str):
+    # tiktoken の読み込み自体にも時間がかかるので、ここで import する
+    import tiktoken
+    return tiktoken.encoding_for_model(encoding_model)
+
+def get_encoding(model: str):
+    return _load_encoding(get_gpt_model(model).get("encoding_model"))
+
+def count_tokens(text: str, model: str) -> int:
+    # 応答のように一度しか数えない文字列はキャッシュせずに数える
+    return len(get_encoding(model).encode(text, disallowed_special=())) if text else 0
+
+def preload_encodings():
+    # 起動時のウォームアップ用。全モデルのエンコーダーを読み込んでおく
+    for model in gpt_models:
+        get_encoding(model)
+
+def get_token_counter(model: str) -> TokenCounter:
+    encoding = get_encoding(model)
+    counter = token_counters.get(encoding.name)
+    if counter is None:
+        with token_counters_lock:
+            counter = token_counters.setdefault(encoding.name, TokenCounter(encoding, TOKEN_CACHE_SIZE))
+    return counter
+
+def get_token_metrics() -> dict:
+    return {name: counter.get_metrics() for name, counter in token_counters.items()}
+
+def num_tokens_from_messages(messages: list[dict], model: str) -> int:
+    return get_token_counter(model).count_messages(messages)
+
+def get_max_token_from_messages(messages: list[dict], model: str) -> int:
     gpt_model = get_gpt_model(model)
-    encoding = gpt_model.get("encoding")
     max_tokens = gpt_model.get("max_tokens")
 
     # input tokens + output tokens < max tokens of the model
-    input_token = encoding.encode(json.dumps(messages, ensure_ascii=False))
-    token_length = len(input_token)
+    token_length = num_tokens_from_messages(messages, model)
     if max_tokens > token_length + 1:
         max_tokens = max_tokens - (token_length + 1)
 
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import time
+import json
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from azure.cosmos import ContainerProxy
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+def normalize_text(text: str) -> str:
+    # 全角・半角や大文字・小文字、空白の違いだけの質問は同じものとして扱う
+    return " ".join(unicodedata.normalize("NFKC", text or "").casefold().split())
+
+class CosmosCacheBackend:
+    """
+      複数のアプリインスタンスで共有するキャッシュの保存先。
+      Cosmos DB のコンテナー(パーティションキー /id、既定の TTL を有効にしておく)にキーをIDとして保存し、ポイント読み取りで引く。
+      """
+
+    def __init__(self, container: ContainerProxy):
+        self.container = container
+
+    def get(self, key: str):
+        try:
+            item = self.container.read_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            return None
+        return item.get("value")
+
+    def set(self, key: str, value, ttl: int):
+        self.container.upsert_item({"id": key, "value": value, "ttl": ttl})
+
+class QueryRewriteCache:
+    """
+      ChatReadRetrieveRead のステップ1(検索クエリ生成)の結果のキャッシュ。
+      キーは正規化した会話履歴・質問とモデル名のハッシュで、temperature=0 の生成結果なので同じ入力には同じクエリを返す。
+      プロセス内は LRU + TTL で保持し、backend を指定した場合は他のインスタンスとも共有する。
+      Methods:
+          make_key(self, history: list[dict], model: str): キャッシュキーを作る。
+          get(self, key: str): キャッシュされたクエリを返す（無ければ None）。
+          set(self, key: str, query: str): クエリをキャッシュする。
+          get_metrics(self): ヒット率などを返す。
+      """
+
+    def __init__(self, max_entries: int = 1000, ttl: int = 24 * 60 * 60, backend: CosmosCacheBackend = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "shared_hits": 0, "misses": 0, "skipped": 0, "backend_errors": 0}
+
+    @staticmethod
+    def make_key(history: list[dict], model: str) -> str:
+        turns = [[normalize_text(h.get("user")), normalize_text(h.get("assistant"))] for h in history[:-1]]
+        payload = json.dumps({"history": turns, "question": normalize_text(history[-1]["user"]), "model": model}, ensure_ascii=False)
+        return "rewrite-" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def count(self, name: str):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._metrics["hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+
+        if self.backend is not None:
+            try:
+                value = self.backend.get(key)
+            except Exception as e:
+                print(f"Error in query cache backend: {str(e)}")
+                self.count("backend_errors")
+                value = None
+            if value is not None:
+                self.count("shared_hits")
+                self._put(key, value, now)
+                return value
+
+        self.count("misses")
+        return None
+
+    def set(self, key: str, query: str):
+        self._put(key, query, time.time())
+        if self.backend is not None:
+            try:
+                self.backend.set(key, query, self.ttl)
+            except Exception as e:
+                print(f"Error in query cache backend: {str(e)}")
+                self.count("backend_errors")
+
+    def _put(self, key: str, value, now: float):
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+        lookups = metrics["hits"] + metrics["shared_hits"] + metrics["misses"]
+        metrics["hit_rate"] = round((metrics["hits"] + metrics["shared_hits"]) / lookups, 4) if lookups else 0.0
+        return metrics
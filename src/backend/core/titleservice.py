@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import json
+import time
+import heapq
+import queue
+import itertools
+import threading
+import openai
+from collections import OrderedDict
+
+from core.messagebuilder import MessageBuilder
+from core.usage import usage_totals, USAGE_FIELDS
+
+MAX_READY_TITLES = 10000
+
+class TitleService:
+    """
+      会話タイトルの生成サービス。
+      request() は質問の先頭を切り詰めた仮タイトルをすぐに返し、本来のタイトルはバックグラウンドで生成する。
+      batch_wait 秒の間に溜まった質問(最大 max_batch 件)は1回の ChatCompletion でまとめてタイトルを付ける。
+      生成したタイトルは on_title(conversation_id, title, usage) で保存し、get_title() でも参照できる。
+      生成待ちの会話を再び request() した場合(チャットログの書き込みの再試行など)は、予約を重ねない。
+      生成に失敗したまとまりは retry_delay 秒後に max_retries 回まで再試行し、件数が合わずに対応が取れない場合は1件ずつ生成し直す。
+      on_title が False を返した場合(会話ドキュメントがまだ無いなど)は、ワーカーを止めずに retry_delay 秒後に保存を再試行する。
+      usage はまとめて生成したときのトークン使用量を質問数で割った、1件あたりの使用量。
+      Methods:
+          request(self, conversation_id: str, question: str): 仮タイトルを返し、タイトル生成を予約する。
+          get_title(self, conversation_id: str): 生成済みのタイトルを返す（未生成なら None）。
+          get_metrics(self): 生成件数やリクエスト回数を返す。
+      """
+
+    system_prompt_for_title = """Your assistant will come up with a title for each of the numbered questions.
+                Answer in the customer's language.
+                Titles should be easy to understand and no more than 20 characters.
+                Please use the words you have used as much as possible.
+                Don't end your sentences with a "?".
+                Return only a JSON array of strings with one title per question, in the same order."""
+
+    def __init__(self, deployment: str, on_title=None, max_batch: int = 20, batch_wait: float = 1.0,
+                 max_length: int = 20, temperature: float = 0.5, max_retries: int = 3, retry_delay: float = 2.0):
+        self.deployment = deployment
+        self.on_title = on_title
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.max_length = max_length
+        self.temperature = temperature
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._queue = queue.Queue()
+        # 再試行を待つ処理 (実行時刻, 連番, 処理, 引数) のヒープ。ワーカースレッドだけが触る
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._ready = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._metrics = {"requested": 0, "generated": 0, "failed": 0, "retries": 0, "completions": 0}
+        self._thread = threading.Thread(target=self._run, name="title-service", daemon=True)
+        self._thread.start()
+
+    def provisional_title(self, question: str) -> str:
+        title = " ".join(question.split())
+        if len(title) > self.max_length:
+            title = title[:self.max_length] + "…"
+        return title
+
+    def request(self, conversation_id: str, question: str) -> str:
+        with self._lock:
+            if conversation_id in self._pending or conversation_id in self._ready:
+                return self.provisional_title(question)
+            self._pending.add(conversation_id)
+        self._count("requested")
+        self._queue.put((conversation_id, question, 0))
+        return self.provisional_title(question)
+
+    def get_title(self, conversation_id: str):
+        with self._lock:
+            title = self._ready.get(conversation_id)
+            if title is not None:
+                self._ready.move_to_end(conversation_id)
+            return title
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._metrics[name] += value
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["pending"] = self._queue.qsize() + len(self._delayed)
+        return metrics
+
+    def _later(self, action, *args):
+        heapq.heappush(self._delayed, (time.time() + self.retry_delay, next(self._sequence), action, args))
+
+    def _run_delayed(self):
+        while self._delayed and self._delayed[0][0] <= time.time():
+            _, _, action, args = heapq.heappop(self._delayed)
+            action(*args)
+
+    def _run(self):
+        while True:
+            self._run_delayed()
+            # 再試行を待つ処理があれば、その時刻までだけ新しい質問を待つ
+            timeout = max(0.0, self._delayed[0][0] - time.time()) if self._delayed else None
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                continue
+            # 少し待って同時期に始まった会話のタイトルをまとめて生成する
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self._generate_batch(batch)
+
+    def _generate_batch(self, batch: list):
+        try:
+            titles, usage = self.generate_with_usage([question for _, question, _ in batch])
+        except Exception as e:
+            print(f"Error in title generation: {str(e)}")
+            for conversation_id, question, attempt in batch:
+                if attempt < self.max_retries:
+                    self._count("retries")
+                    self._later(self._queue.put, (conversation_id, question, attempt + 1))
+                else:
+                    self._count("failed")
+                    self._done(conversation_id)
+            return
+
+        for (conversation_id, question, attempt), title in zip(batch, titles):
+            if not title and len(batch) > 1:
+                # まとめて生成したときに件数が合わなかった質問は1件ずつ生成し直す
+                self._generate_batch([(conversation_id, question, attempt)])
+                continue
+            if not title:
+                self._count("failed")
+                self._done(conversation_id)
+                continue
+            with self._lock:
+                self._ready[conversation_id] = title
+                self._ready.move_to_end(conversation_id)
+                while len(self._ready) > MAX_READY_TITLES:
+                    self._ready.popitem(last=False)
+            self._done(conversation_id)
+            self._count("generated")
+            self._save(conversation_id, title, usage, 0)
+
+    def _save(self, conversation_id: str, title: str, usage: dict, attempt: int):
+        if not self.on_title:
+            return
+        try:
+            saved = self.on_title(conversation_id, title, usage)
+        except Exception as e:
+            print(f"Error in saving title: {str(e)}")
+            return
+        if saved is False:
+            if attempt < self.max_retries:
+                self._later(self._save, conversation_id, title, usage, attempt + 1)
+            else:
+                print(f"Conversation not found for title: {conversation_id}")
+
+    def _done(self, conversation_id: str):
+        with self._lock:
+            self._pending.discard(conversation_id)
+
+    def generate(self, questions: list[str]) -> list:
+        return self.generate_with_usage(questions)[0]
+
+    def generate_with_usage(self, questions: list[str]) -> tuple:
+        prompt = "\n".join(f"{i + 1}. {' '.join(q.split())}" for i, q in enumerate(questions))
+        message_builder = MessageBuilder(self.system_prompt_for_title)
+        messages = message_builder.get_messages_from_history([], prompt)
+        self._count("completions")
+        completion = openai.ChatCompletion.create(
+            engine=self.deployment,
+            messages=messages,
+            temperature=self.temperature,
+            n=1)
+        usage = completion.get("usage") or {}
+        usage_totals.add("title", usage)
+        share = {field: usage.get(field, 0) // len(questions) for field in USAGE_FIELDS}
+        share["shared_by"] = len(questions)
+        content = completion.choices[0]["message"]["content"]
+        titles = self._parse_titles(content)
+        # 件数が合わない場合は順番の対応が取れないので仮タイトルのままにする
+        if len(titles) != len(questions):
+            return [None] * len(questions), share
+        return [str(t).strip().rstrip("?？")[:self.max_length] or None for t in titles], share
+
+    @staticmethod
+    def _parse_titles(content: str) -> list:
+        start = content.find("[")
+        end = content.rfind("]")
+        if start == -1 or end == -1:
+            # 1件だけの場合はそのままタイトルとして返ってくることがある
+            return [content.strip()] if content.strip() else []
+        try:
+            titles = json.loads(content[start:end + 1])
+        except json.JSONDecodeError:
+            return []
+        return titles if isinstance(titles, list) else []
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import os
+import threading
+
+from core.modelhelper import num_tokens_from_messages, count_tokens
+
+# true にするとストリーミングの最後に API からトークン使用量を受け取る(stream_options.include_usage)。
+# 対応していない API バージョンではエラーになるので既定では無効。無効な場合はチャンクごとに数える
+OPENAI_STREAM_USAGE = os.environ.get("OPENAI_STREAM_USAGE", "false").lower() == "true"
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+def stream_options() -> dict:
+    # ChatCompletion.create(stream=True) に追加する引数
+    return {"stream_options": {"include_usage": True}} if OPENAI_STREAM_USAGE else {}
+
+class UsageTotals:
+    """
+      プロセス全体のステージ(rewrite / answer / title など)ごとのトークン使用量の合計。
+      Methods:
+          add(self, stage: str, usage: dict, estimated: bool): 使用量を加算する。
+          get_metrics(self): ステージごとの合計を返す。
+      """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, usage: dict, estimated: bool = False):
+        with self._lock:
+            totals = self._stages.setdefault(stage, dict.fromkeys(USAGE_FIELDS + ("calls", "estimated_calls"), 0))
+            for field in USAGE_FIELDS:
+                totals[field] += usage.get(field, 0)
+            totals["calls"] += 1
+            if estimated:
+                totals["estimated_calls"] += 1
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {stage: dict(totals) for stage, totals in self._stages.items()}
+
+usage_totals = UsageTotals()
+
+class UsageTracker:
+    """
+      1回のリクエストのステージごとのトークン使用量。
+      API が返した usage をそのまま記録し、ストリーミングで usage が無い場合はチャンクごとに数えた推定値を記録する。
+      Methods:
+          record(self, stage: str, usage: dict, estimated: bool): 使用量を記録する。
+          record_completion(self, stage: str, completion, messages: list): ストリーミングでない応答の usage を記録する。
+          stream(self, stage: str, messages: list): ストリーミングの応答を受け取る StreamAccumulator を返す。
+          total_tokens(self): 全ステージの合計トークン数を返す。
+          to_dict(self): ステージごとの使用量を返す（Cosmos DB に保存する形式）。
+      """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.stages = {}
+
+    def record(self, stage: str, usage: dict, estimated: bool = False):
+        usage = {field: int(usage.get(field) or 0) for field in USAGE_FIELDS}
+        if not usage["total_tokens"]:
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        current = self.stages.setdefault(stage, dict.fromkeys(USAGE_FIELDS, 0))
+        for field in USAGE_FIELDS:
+            current[field] += usage[field]
+        if estimated:
+            current["estimated"] = True
+        usage_totals.add(stage, usage, estimated)
+
+    def record_completion(self, stage: str, completion, messages: list):
+        usage = completion.get("usage")
+        if usage:
+            self.record(stage, usage)
+        else:
+            content = completion.choices[0].message.get("content") or ""
+            self.record(stage, {"prompt_tokens": num_tokens_from_messages(messages, self.model),
+                                "completion_tokens": count_tokens(content, self.model)}, estimated=True)
+
+    def stream(self, stage: str, messages: list) -> StreamAccumulator:
+        return StreamAccumulator(self, stage, messages)
+
+    def total_tokens(self) -> int:
+        return sum(usage["total_tokens"] for usage in self.stages.values())
+
+    def to_dict(self) -> dict:
+        return {stage: dict(usage) for stage, usage in self.stages.items()}
+
+class StreamAccumulator:
+    """
+      ストリーミングの応答のチャンクをリストに溜め、トークン数をチャンクごとに数える。
+      最後のチャンクに usage があればそちらを正とする。
+      Methods:
+          add(self, chunk): チャンクを受け取り、本文があれば返す。
+          text(self): 受け取った本文を連結して返す。
+          finish(self): 使用量を UsageTracker に記録する。
+      """
+
+    def __init__(self, tracker: UsageTracker, stage: str, messages: list):
+        self.tracker = tracker
+        self.stage = stage
+        self.messages = messages
+        self.parts = []
+        self.completion_tokens = 0
+        self.usage = None
+
+    def add(self, chunk):
+        if not chunk:
+            return None
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        if not chunk.get("choices"):
+            return None
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            self.parts.append(content)
+            self.completion_tokens += count_tokens(content, self.tracker.model)
+        return content
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def finish(self):
+        if self.usage:
+            self.tracker.record(self.stage, self.usage)
+        else:
+            self.tracker.record(self.stage, {"prompt_tokens": num_tokens_from_messages(self.messages, self.tracker.model),
+                                             "completion_tokens": self.completion_tokens}, estimated=True)
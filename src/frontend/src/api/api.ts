@@ -189,14 +189,16 @@ export function getCitationFilePath(citation: string): string {
     return `/content/${citation}${queryParameters}`;
 }
 
-export async function getConversationsHistoryApi(loginUser: string): Promise<UserConversations> {
+// 会話履歴を新しい順に1ページ分取得する。続きは前の結果の continuation_token を渡して取得する
+export async function getConversationsHistoryApi(loginUser: string, continuationToken: string | null = null): Promise<UserConversations> {
     const response = await fetch("/", {
         method: "POST",
         headers: {
             "Content-Type": "application/json"
         },
         body:  JSON.stringify({
-            loginUser: loginUser
+            loginUser: loginUser,
+            continuationToken: continuationToken
         })
     });
     // レスポンスが成功していない場合にエラーをスローする
@@ -208,6 +210,20 @@ export async function getConversationsHistoryApi(loginUser: string): Promise<Use
     return parsedResponse;
 }
 
+// 会話ログの保存は非同期なので、今の会話が一覧に現れてタイトルが決まるまで(またはタイトル生成待ちの会話がある間は)、少し間隔を空けて履歴を取り直す
+export async function refreshConversationsHistoryApi(loginUser: string, conversationId: string | null, onUpdate: (result: UserConversations) => void, retries: number = 5, intervalMs: number = 2000): Promise<void> {
+    const result = await getConversationsHistoryApi(loginUser);
+    onUpdate(result);
+    const conversations = result?.conversations ?? [];
+    const current = conversationId ? conversations.find(c => c.conversation_id === conversationId) : undefined;
+    const waiting = (conversationId !== null && (!current || current.title_pending)) || conversations.some(c => c.title_pending);
+    if (waiting && retries > 0) {
+        setTimeout(() => {
+            refreshConversationsHistoryApi(loginUser, conversationId, onUpdate, retries - 1, intervalMs).catch(() => {});
+        }, intervalMs);
+    }
+}
+
 export async function getConversationContentApi(conversation_id: string, approach: string): Promise<ConversationContent> {
     const response = await fetch("/conversationcontent", {
         method: "POST",
@@ -101,12 +101,14 @@ export type Conversation = {
     conversation_id: string; // 会話のID
     approach: string;
     title: string;
+    title_pending?: boolean; // タイトルが生成待ち(仮タイトル)かどうか
     timestamp: string // メッセージの配列
 };
 
 export type UserConversations = {
     user_id: string; // ユーザーのID
     conversations: Conversation[]; // 会話の配列
+    continuation_token?: string | null; // 続きのページを取得するためのトークン(最後のページなら null)
     error?: string;
 }
 
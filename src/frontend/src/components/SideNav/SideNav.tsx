@@ -31,6 +31,7 @@ export const SideNav = ({ conversationId, onClick, clearChat,
     const prevScrollTop = useRef<number>(0);
     const [isOpenDeleteModal, setIsOpenDeleteModal] = useState(false);
     const [selectConversationTitle, setCelectConversationTitle] = useState<string | null>(null);
+    const [isLoadingMore, setIsLoadingMore] = useState<boolean>(false);
 
     useEffect(() => {
         if(loginUser) {
@@ -40,7 +41,8 @@ export const SideNav = ({ conversationId, onClick, clearChat,
 
     useEffect(() => {
         if (reupdateResult) {
-            setConversationsData(reupdateResult);
+            // 更新されるのは最初のページなので、読み込み済みの古いページは残す
+            setConversationsData(prev => mergeConversations(reupdateResult, prev));
         }
     }, [reupdateResult]);
 
@@ -131,6 +133,39 @@ export const SideNav = ({ conversationId, onClick, clearChat,
         }
     }
 
+    // 最初のページを取り直した結果に、読み込み済みの古いページの会話をつなげる
+    const mergeConversations = (firstPage: UserConversations, prev: UserConversations | undefined): UserConversations => {
+        if (!prev || !prev.conversations || prev.conversations.length <= firstPage.conversations.length) {
+            return firstPage;
+        }
+        const ids = new Set(firstPage.conversations.map(conv => conv.conversation_id));
+        return {
+            ...firstPage,
+            conversations: [...firstPage.conversations, ...prev.conversations.filter(conv => !ids.has(conv.conversation_id))],
+            continuation_token: prev.continuation_token
+        };
+    }
+
+    // 続きのページを読み込む
+    const loadMoreConversations = async () => {
+        if (!loginUser || !conversationsData?.continuation_token || isLoadingMore) {
+            return;
+        }
+        setIsLoadingMore(true);
+        try {
+            const result = await getConversationsHistoryApi(loginUser, conversationsData.continuation_token);
+            setConversationsData(prev => prev && {
+                ...prev,
+                conversations: [...prev.conversations, ...result.conversations],
+                continuation_token: result.continuation_token
+            });
+        } catch (e) {
+            console.error(e);
+        } finally {
+            setIsLoadingMore(false);
+        }
+    }
+
     // グループ名を取得する関数
     function getGroupName(dateString: string) {
         const inputDate = new Date(
@@ -401,6 +436,13 @@ export const SideNav = ({ conversationId, onClick, clearChat,
                                     ))}
                                 </div>
                             </details>
+                            {conversationsData?.continuation_token && (
+                                <div className={styles.LoadMoreContainer}>
+                                    <button onClick={loadMoreConversations} disabled={isLoadingMore}>
+                                        {isLoadingMore ? "読み込み中..." : "さらに表示"}
+                                    </button>
+                                </div>
+                            )}
                         </div>
                         {showMenu && (
                             <div
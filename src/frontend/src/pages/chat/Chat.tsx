@@ -5,7 +5,7 @@ import { useOutletContext, useLocation } from 'react-router-dom';
 
 import styles from "./Chat.module.css";
 import { UserConversations } from '../../api/models';
-import { chatApi, Approaches, ChatResponse, GptChatRequest, GptChatTurn, getConversationsHistoryApi, createJSTTimeStamp } from "../../api";
+import { chatApi, Approaches, ChatResponse, GptChatRequest, GptChatTurn, refreshConversationsHistoryApi, createJSTTimeStamp } from "../../api";
 import { AnswerChat, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { UserChatMessage } from "../../components/UserChatMessage";
@@ -115,8 +115,7 @@ const Chat = () => {
             setError(e);
         } finally {
             setIsLoading(false);
-            const reupdate_result: UserConversations = await getConversationsHistoryApi(userName);
-            updateReupdateResult(reupdate_result);
+            await refreshConversationsHistoryApi(userName, conversationId, updateReupdateResult);
         }
     };
 
@@ -5,7 +5,7 @@ import { useOutletContext, useLocation } from 'react-router-dom';
 
 import styles from "./DocSearch.module.css";
 import { UserConversations } from '../../api/models';
-import { searchdocApi, Approaches, AskResponse, ChatRequest, GptChatTurn, createJSTTimeStamp, getConversationsHistoryApi } from "../../api";
+import { searchdocApi, Approaches, AskResponse, ChatRequest, GptChatTurn, createJSTTimeStamp, refreshConversationsHistoryApi } from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { HowToUseList } from "../../components/HowToUse";
@@ -129,8 +129,7 @@ const DocSearch = () => {
             setError(e);
         } finally {
             setIsLoading(false);
-            const reupdate_result: UserConversations = await getConversationsHistoryApi(userName);
-            updateReupdateResult(reupdate_result);
+            await refreshConversationsHistoryApi(userName, conversationId, updateReupdateResult);
         }
     };
 